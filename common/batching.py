@@ -0,0 +1,259 @@
+import gc
+import metrics
+import numpy as np
+import os
+import sys
+from typing import Callable, Dict, List, Tuple
+
+# The batchers which have been created by `get_batcher`, keyed by name, so the
+# batch sizes they settle on are kept between calls
+_batchers = {}
+
+
+def get_num_tokens(inp: Dict) -> int:
+    """
+    Approximates the length of a metric input by the number of whitespace
+    tokens in its candidate, sources, and references
+    """
+    texts = [inp["candidate"]] + (inp.get("sources") or []) + (inp.get("references") or [])
+    return sum(len(text.split()) for text in texts)
+
+
+def make_batches(
+    lengths: List[int],
+    max_tokens: int,
+    max_batch_size: int = None,
+) -> List[List[int]]:
+    """
+    Sorts the items by length and packs them into batches so the padded size
+    of each batch, (batch size x longest item), is at most `max_tokens`. An
+    item which is longer than the budget is put in a batch by itself. Returns
+    the indices of the items in each batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    for i in order:
+        # The items are sorted, so the first item in the batch is the longest
+        longest = lengths[batch[0]] if len(batch) > 0 else lengths[i]
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if len(batch) > 0 and (full or (len(batch) + 1) * longest > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class PaddingReport(object):
+    """
+    Counts the number of real and padded tokens in each batch to report how
+    much of the computation is spent on padding
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.num_batches = 0
+        self.num_items = 0
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+
+    def add(self, lengths: List[int]) -> None:
+        self.num_batches += 1
+        self.num_items += len(lengths)
+        self.num_tokens += sum(lengths)
+        self.num_padded_tokens += len(lengths) * max(lengths, default=0)
+
+    def get_efficiency(self) -> float:
+        if self.num_padded_tokens == 0:
+            return 1.0
+        return self.num_tokens / self.num_padded_tokens
+
+    def print(self) -> None:
+        print(
+            f"{self.name}: {self.num_items} items in {self.num_batches} batches, "
+            f"{self.num_tokens} / {self.num_padded_tokens} real / padded tokens "
+            f"({self.get_efficiency() * 100:.1f}% padding efficiency)"
+        )
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    # PyTorch raises a RuntimeError for device and CPU allocation failures, and
+    # repro includes the error message of the model which it ran
+    return isinstance(error, MemoryError) or "out of memory" in str(error).lower()
+
+
+def _free_memory() -> None:
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _get_rss_gb() -> float:
+    """Returns the resident memory of this process in GB, or `None` if it is unknown"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            num_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return num_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 3
+
+
+class AdaptiveBatcher(object):
+    """
+    Splits items into length-sorted batches under a token budget which adapts
+    to the available memory. The budget starts at `max_tokens`. When a batch
+    runs out of memory (on the device, or the process exceeds `max_rss_gb`),
+    the budget is halved and the batch is retried with fewer items, and after
+    `grow_after` batches in a row succeed, it is doubled again up to
+    `max_tokens`. The same configuration can then be used on machines with
+    different amounts of memory. `max_rss_gb` defaults to the `MAX_RSS_GB`
+    environment variable so it can be set for every script at once.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_tokens: int,
+        grow_after: int = 10,
+        max_rss_gb: float = None,
+    ) -> None:
+        self.name = name
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.grow_after = grow_after
+        if max_rss_gb is None and "MAX_RSS_GB" in os.environ:
+            max_rss_gb = float(os.environ["MAX_RSS_GB"])
+        self.max_rss_gb = max_rss_gb
+        self.num_successes = 0
+        self.num_failures = 0
+        self.budgets = []
+        self.report = PaddingReport(name)
+
+    def _next_batch(self, order: List[int], start: int, lengths: List[int], max_batch_size: int) -> List[int]:
+        # The items are sorted, so the first item in the batch is the longest
+        longest = lengths[order[start]]
+        size = max(self.tokens // max(longest, 1), 1)
+        if max_batch_size is not None:
+            size = min(size, max_batch_size)
+        return order[start:start + size]
+
+    def _shrink(self) -> None:
+        self.tokens = max(self.tokens // 2, 1)
+        self.num_successes = 0
+        self.num_failures += 1
+        # Wait longer before growing again so a budget which is too large is
+        # not retried over and over
+        self.grow_after *= 2
+        print(f"{self.name}: out of memory, reducing the budget to {self.tokens} tokens")
+
+    def _grow(self) -> None:
+        self.num_successes += 1
+        if self.num_successes >= self.grow_after and self.tokens < self.max_tokens:
+            self.tokens = min(self.tokens * 2, self.max_tokens)
+            self.num_successes = 0
+            print(f"{self.name}: increasing the budget to {self.tokens} tokens")
+
+    def run(self, lengths: List[int], process_batch: Callable, max_batch_size: int = None) -> None:
+        """
+        Calls `process_batch` with the indices of the items in each batch,
+        longest first, until every item has been processed
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        start = 0
+        while start < len(order):
+            batch = self._next_batch(order, start, lengths, max_batch_size)
+            out_of_memory = False
+            try:
+                process_batch(batch)
+            except Exception as error:
+                # A single item which does not fit cannot be split any further
+                if not is_out_of_memory(error) or len(batch) == 1:
+                    raise
+                out_of_memory = True
+
+            if out_of_memory:
+                # The memory is freed outside of the except block so the
+                # traceback no longer references the batch's tensors
+                _free_memory()
+                self._shrink()
+                continue
+
+            start += len(batch)
+            self.report.add([lengths[i] for i in batch])
+            self.budgets.append(self.tokens)
+
+            rss_gb = _get_rss_gb() if self.max_rss_gb is not None else None
+            if rss_gb is not None and rss_gb > self.max_rss_gb:
+                # The batch finished, but the next one should be smaller
+                _free_memory()
+                self._shrink()
+            else:
+                self._grow()
+
+    def print(self) -> None:
+        self.report.print()
+        if len(self.budgets) > 0:
+            print(
+                f"{self.name}: settled on a budget of {self.budgets[-1]} tokens "
+                f"(min {min(self.budgets)}, max {max(self.budgets)}, {self.num_failures} reductions)"
+            )
+
+
+def get_batcher(name: str, max_tokens: int, **kwargs) -> AdaptiveBatcher:
+    key = (name, max_tokens)
+    if key not in _batchers:
+        _batchers[key] = AdaptiveBatcher(name, max_tokens, **kwargs)
+    return _batchers[key]
+
+
+def aggregate_scores(micro: List[Dict]) -> Dict:
+    """The macro scores of the metrics, which are the average of the segment scores"""
+    macro = {}
+    for key, value in micro[0].items():
+        if isinstance(value, dict):
+            macro[key] = aggregate_scores([scores[key] for scores in micro])
+        else:
+            macro[key] = float(np.mean([scores[key] for scores in micro]))
+    return macro
+
+
+def batched_predict_batch(
+    name: str,
+    inputs: List[Dict],
+    predict_batch: Callable,
+    max_tokens: int = None,
+) -> Tuple[Dict, List[Dict]]:
+    """
+    Runs `predict_batch` on the inputs in order of length, split into batches
+    under the `max_tokens` budget, and returns the (macro, micro) scores with
+    the micro scores in the original order of `inputs`. The budget is reduced
+    if a batch runs out of memory (see `AdaptiveBatcher`). If `max_tokens` is
+    `None`, or the metric is a repro model, which loads the model again for
+    every call, all of the inputs are passed in one call, but in order of
+    length so that the metric's own fixed-size batches have less padding.
+    """
+    if len(inputs) == 0:
+        return {}, []
+
+    lengths = [get_num_tokens(inp) for inp in inputs]
+    micro = [None] * len(inputs)
+
+    def _process_batch(batch: List[int]) -> None:
+        _, batch_micro = predict_batch([inputs[i] for i in batch])
+        for i, scores in zip(batch, batch_micro):
+            micro[i] = scores
+
+    if max_tokens is None or not metrics.is_in_process(name):
+        _process_batch(sorted(range(len(inputs)), key=lambda i: lengths[i], reverse=True))
+        print(
+            f"{name}: {len(inputs)} items ({sum(lengths)} tokens) in one call in order of length, "
+            f"so the padding depends on the metric's own batches"
+        )
+    else:
+        batcher = get_batcher(name, max_tokens)
+        batcher.run(lengths, _process_batch)
+        batcher.print()
+    return aggregate_scores(micro), micro
@@ -0,0 +1,217 @@
+import batching
+import hashlib
+import json
+import math
+import numpy as np
+import os
+import torch
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(json.dumps(value).encode()).hexdigest()
+
+
+def _save_atomic(path: str, save_fn) -> None:
+    # Write to a temporary file first so readers never see a partial file
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as out:
+        save_fn(out)
+    os.replace(temp_path, path)
+
+
+def _greedy_cos_idf(
+    ref_embedding: np.ndarray,
+    ref_idf: np.ndarray,
+    hyp_embedding: np.ndarray,
+    hyp_idf: np.ndarray,
+) -> Tuple[float, float, float]:
+    # The same greedy matching as `bert_score.utils.greedy_cos_idf` for one pair
+    ref_embedding = ref_embedding / np.linalg.norm(ref_embedding, axis=-1, keepdims=True)
+    hyp_embedding = hyp_embedding / np.linalg.norm(hyp_embedding, axis=-1, keepdims=True)
+    sim = hyp_embedding @ ref_embedding.T
+    precision = float((sim.max(axis=1) * hyp_idf / hyp_idf.sum()).sum())
+    recall = float((sim.max(axis=0) * ref_idf / ref_idf.sum()).sum())
+    f1 = 2 * precision * recall / (precision + recall)
+    if math.isnan(f1):
+        f1 = 0.0
+    return precision, recall, f1
+
+
+class CachedBERTScore(object):
+    """
+    Computes BERTScore (Zhang et al., 2020) in-process with the bert_score
+    package and caches the reference token embeddings on disk. The cache is
+    keyed by the model and layer, and each reference is stored by the hash of
+    its text, so any system scored against an already-seen reference only
+    has to encode its candidates.
+
+    The embeddings are saved in append-only chunks of memory-mapped arrays.
+    Every process writes new chunks with unique names, so several jobs can
+    share the cache. The IDF tables are cached by the hash of the reference
+    list they were computed from.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        language: str = "en",
+        device: int = 0,
+        model_type: str = None,
+        num_layers: int = None,
+        idf: bool = False,
+        batch_size: int = 64,
+        max_tokens: int = 8192,
+    ) -> None:
+        from bert_score.utils import get_model, get_tokenizer, lang2model, model2layers
+
+        self.model_type = model_type or lang2model[language.lower()]
+        self.num_layers = num_layers or model2layers[self.model_type]
+        self.tokenizer = get_tokenizer(self.model_type)
+        self.model = get_model(self.model_type, self.num_layers)
+        self.device = f"cuda:{device}" if device >= 0 else "cpu"
+        self.model.to(self.device)
+        self.idf = idf
+        self.batch_size = batch_size
+        # The budget is reduced if a batch runs out of memory
+        self.batcher = batching.AdaptiveBatcher("BERTScore encoder", max_tokens)
+
+        model_name = self.model_type.replace("/", "_")
+        self.cache_dir = os.path.join(cache_dir, f"{model_name}-L{self.num_layers}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Maps the reference hash to its (chunk, start, end) in the cache
+        self.index = {}
+        self.chunks = {}
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".index.json"):
+                chunk = filename[:-len(".index.json")]
+                with open(os.path.join(self.cache_dir, filename), "r") as f:
+                    for key, start, end in json.load(f):
+                        self.index[key] = (chunk, start, end)
+
+    def _encode(self, sentences: List[str]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the token embeddings and token ids of each sentence"""
+        from bert_score.utils import get_bert_embedding, sent_encode
+
+        idf_dict = defaultdict(lambda: 1.0)
+        lengths = [len(sentence.split()) for sentence in sentences]
+        encoded = [None] * len(sentences)
+
+        def _process_batch(indices: List[int]) -> None:
+            batch = [sentences[j] for j in indices]
+            with torch.no_grad():
+                embeddings, masks, _ = get_bert_embedding(
+                    batch, self.model, self.tokenizer, idf_dict, device=self.device
+                )
+            embeddings = embeddings.cpu().numpy()
+            num_tokens = masks.sum(dim=1).tolist()
+            for j, sentence, embedding, length in zip(indices, batch, embeddings, num_tokens):
+                token_ids = np.array(sent_encode(self.tokenizer, sentence), dtype=np.int64)
+                encoded[j] = (embedding[:length], token_ids)
+
+        self.batcher.run(lengths, _process_batch, self.batch_size)
+        self.batcher.print()
+        return encoded
+
+    def _save_chunk(self, sentences: List[str], encoded: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+        chunk = uuid.uuid4().hex
+        embeddings = np.concatenate([embedding for embedding, _ in encoded])
+        token_ids = np.concatenate([ids for _, ids in encoded])
+
+        entries = []
+        start = 0
+        for sentence, (embedding, _) in zip(sentences, encoded):
+            entries.append((_hash(sentence), start, start + len(embedding)))
+            start += len(embedding)
+
+        prefix = os.path.join(self.cache_dir, chunk)
+        _save_atomic(f"{prefix}.emb.npy", lambda out: np.save(out, embeddings))
+        _save_atomic(f"{prefix}.ids.npy", lambda out: np.save(out, token_ids))
+        # The index is written last so the chunk is only visible once it is complete
+        _save_atomic(f"{prefix}.index.json", lambda out: out.write(json.dumps(entries).encode()))
+
+        for key, start, end in entries:
+            self.index[key] = (chunk, start, end)
+
+    def _get_chunk(self, chunk: str) -> Tuple[np.ndarray, np.ndarray]:
+        if chunk not in self.chunks:
+            prefix = os.path.join(self.cache_dir, chunk)
+            self.chunks[chunk] = (
+                np.load(f"{prefix}.emb.npy", mmap_mode="r"),
+                np.load(f"{prefix}.ids.npy", mmap_mode="r"),
+            )
+        return self.chunks[chunk]
+
+    def _get_references(self, references: List[str]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        unique = list(dict.fromkeys(references))
+        missing = [reference for reference in unique if _hash(reference) not in self.index]
+        print(f"Encoding {len(missing)} / {len(unique)} references which are not cached")
+        if len(missing) > 0:
+            self._save_chunk(missing, self._encode(missing))
+
+        reference_dict = {}
+        for reference in unique:
+            chunk, start, end = self.index[_hash(reference)]
+            embeddings, token_ids = self._get_chunk(chunk)
+            reference_dict[reference] = (
+                np.asarray(embeddings[start:end]), np.asarray(token_ids[start:end])
+            )
+        return reference_dict
+
+    def _get_idf_dict(self, references: List[str]) -> Dict[int, float]:
+        if not self.idf:
+            idf_dict = defaultdict(lambda: 1.0)
+            idf_dict[self.tokenizer.sep_token_id] = 0
+            idf_dict[self.tokenizer.cls_token_id] = 0
+            return idf_dict
+
+        # The same IDF weights as `bert_score.utils.get_idf_dict`
+        path = os.path.join(self.cache_dir, f"idf-{_hash(references)}.json")
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            num_docs = data["num_docs"]
+            counts = {int(token_id): count for token_id, count in data["counts"].items()}
+        else:
+            from bert_score.utils import sent_encode
+
+            num_docs = len(references)
+            counts = Counter()
+            for reference in references:
+                counts.update(set(sent_encode(self.tokenizer, reference)))
+            data = {"num_docs": num_docs, "counts": counts}
+            _save_atomic(path, lambda out: out.write(json.dumps(data).encode()))
+
+        idf_dict = defaultdict(lambda: math.log((num_docs + 1) / 1))
+        idf_dict.update({
+            token_id: math.log((num_docs + 1) / (count + 1)) for token_id, count in counts.items()
+        })
+        return idf_dict
+
+    def predict_batch(self, inputs: List[Dict]) -> Tuple[Dict, List[Dict]]:
+        references = [inp["references"][0] for inp in inputs]
+        candidates = [inp["candidate"] for inp in inputs]
+
+        reference_dict = self._get_references(references)
+        idf_dict = self._get_idf_dict(references)
+
+        unique_candidates = list(dict.fromkeys(candidates))
+        candidate_dict = dict(zip(unique_candidates, self._encode(unique_candidates)))
+
+        micro = []
+        for candidate, reference in zip(candidates, references):
+            ref_embedding, ref_ids = reference_dict[reference]
+            hyp_embedding, hyp_ids = candidate_dict[candidate]
+            ref_idf = np.array([idf_dict[token_id] for token_id in ref_ids.tolist()])
+            hyp_idf = np.array([idf_dict[token_id] for token_id in hyp_ids.tolist()])
+            precision, recall, f1 = _greedy_cos_idf(ref_embedding, ref_idf, hyp_embedding, hyp_idf)
+            micro.append({"bertscore": {"precision": precision, "recall": recall, "f1": f1}})
+
+        macro = {"bertscore": {
+            key: float(np.mean([scores["bertscore"][key] for scores in micro]))
+            for key in ["precision", "recall", "f1"]
+        }}
+        return macro, micro
@@ -0,0 +1,93 @@
+import json
+import os
+from typing import Dict, List
+
+import chunked_io
+
+
+def get_file_info(filename: str) -> Dict:
+    """Returns the size and modification time of a file to detect if it has changed"""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+class ProgressManifest(object):
+    """
+    Appends the output of a long job to `output_file` one chunk at a time and
+    records the number of completed chunks in a manifest next to it
+    (`output_file`.progress.json). If the job is restarted with the same
+    `config`, it continues after the last completed chunk, and anything which
+    was written after it is truncated. If `config` has changed (e.g., the
+    input files are different), the output is started over.
+
+    If `output_file` is compressed (see `chunked_io.py`), each chunk is
+    compressed independently, and the index of the compressed chunks is saved
+    with the manifest.
+    """
+
+    def __init__(self, output_file: str, config: Dict) -> None:
+        self.output_file = output_file
+        self.manifest_file = f"{output_file}.progress.json"
+        self.config = config
+        self.num_completed = 0
+        self.output_size = 0
+        self.compressed_chunks = []
+        # Whether the previous run's manifest had the same config
+        self.is_resumed = False
+
+        if os.path.exists(self.manifest_file) and os.path.exists(output_file):
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+            if manifest["config"] == config:
+                self.is_resumed = True
+                self.num_completed = manifest["num_completed"]
+                self.output_size = manifest["output_size"]
+                self.compressed_chunks = manifest.get("compressed_chunks", [])
+
+        if self.num_completed > 0:
+            print(f"Continuing {output_file} after {self.num_completed} completed chunks")
+
+        dirname = os.path.dirname(output_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # "a" cannot write after a truncated position, so the file is opened
+        # for updating and positioned at the end of the last completed chunk
+        mode = "r+b" if os.path.exists(output_file) else "wb"
+        self.out = open(output_file, mode)
+        self.out.seek(self.output_size)
+        self.out.truncate()
+        self._save()
+
+    def _save(self) -> None:
+        manifest = {
+            "config": self.config,
+            "num_completed": self.num_completed,
+            "output_size": self.output_size,
+            "compressed_chunks": self.compressed_chunks,
+        }
+        # The manifest is replaced in one step so it is never partially written
+        with open(self.manifest_file + ".tmp", "w") as out:
+            json.dump(manifest, out)
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+        if chunked_io.is_compressed(self.output_file):
+            chunked_io.save_index(self.output_file, self.compressed_chunks)
+
+    def append(self, lines: List[str]) -> None:
+        """Writes the lines of the next chunk and marks it as completed"""
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        if chunked_io.is_compressed(self.output_file):
+            data = chunked_io.compress(self.output_file, data)
+            first_line = 0
+            if len(self.compressed_chunks) > 0:
+                _, _, last_first_line, last_num_lines = self.compressed_chunks[-1]
+                first_line = last_first_line + last_num_lines
+            self.compressed_chunks.append([self.output_size, len(data), first_line, len(lines)])
+        self.out.write(data)
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.num_completed += 1
+        self.output_size = self.out.tell()
+        self._save()
+
+    def close(self) -> None:
+        self.out.close()
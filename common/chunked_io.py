@@ -0,0 +1,331 @@
+# Reads and writes JSONL and text files which are compressed with gzip (".gz")
+# or zstd (".zst"), and plain files otherwise, based on the file name.
+#
+# Compressed files are written in chunks of lines which are each compressed
+# independently (a gzip member or a zstd frame), so the file is still a normal
+# gzip or zstd file, and the byte range and first line of every chunk are
+# saved next to it in `<file>.index.json`. With the index, the chunks are
+# decompressed in parallel, and a range of lines is read by decompressing only
+# the chunks which contain it. Compressed files without an index (e.g., from
+# other tools) are read as one stream.
+#
+# zstd requires the zstandard package, which is only imported for ".zst" files.
+import gzip
+import io
+import json
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator, List, Optional, Tuple
+
+COMPRESSED_EXTENSIONS = [".gz", ".zst"]
+
+# The number of lines in each compressed chunk
+CHUNK_SIZE = 1000
+
+# The number of threads which decompress chunks. zlib and zstd release the GIL
+NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def is_compressed(filename: str) -> bool:
+    return any(filename.endswith(extension) for extension in COMPRESSED_EXTENSIONS)
+
+
+def _get_index_file(filename: str) -> str:
+    return f"{filename}.index.json"
+
+
+def is_index_file(filename: str) -> bool:
+    """Whether `filename` is the index of a compressed file, which is skipped when listing data files"""
+    return filename.endswith(".index.json") and is_compressed(filename[:-len(".index.json")])
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("Reading or writing .zst files requires the zstandard package")
+    return zstandard
+
+
+def compress(filename: str, data: bytes) -> bytes:
+    """Compresses `data` as one independent chunk in the format of `filename`"""
+    if filename.endswith(".zst"):
+        return _import_zstandard().ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def _decompress(filename: str, data: bytes) -> bytes:
+    if filename.endswith(".zst"):
+        # A frame written by `compress` has its size, but frames from other
+        # tools may not, so they are read as a stream
+        reader = _import_zstandard().ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+        return reader.read()
+    return gzip.decompress(data)
+
+
+def _count_lines(data: bytes) -> int:
+    # A last line without a newline is still a line
+    return data.count(b"\n") + (1 if len(data) > 0 and not data.endswith(b"\n") else 0)
+
+
+def _split_lines(data: bytes) -> List[bytes]:
+    # Only "\n" ends lines so the lines match the line numbers in the index
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    return lines
+
+
+def _get_checksum(filename: str, chunks: List[List[int]]) -> int:
+    # The CRC of the first and last compressed chunks, so a file which was
+    # rewritten with the same size does not match its old index. Unlike the
+    # modification time, it stays the same when the file is copied
+    checksum = 0
+    if len(chunks) > 0:
+        with open(filename, "rb") as f:
+            for offset, size, _, _ in [chunks[0], chunks[-1]]:
+                f.seek(offset)
+                checksum = zlib.crc32(f.read(size), checksum)
+    return checksum
+
+
+def load_index(filename: str) -> Optional[List[List[int]]]:
+    """
+    Returns the chunks of a compressed file as `[offset, size, first_line,
+    num_lines]`, or `None` if the file does not have an index or it was
+    written for a different version of the file
+    """
+    index_file = _get_index_file(filename)
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, "r") as f:
+        index = json.load(f)
+    if index["size"] != os.path.getsize(filename):
+        return None
+    # Indexes without a checksum were written by an older version
+    if index.get("checksum") != _get_checksum(filename, index["chunks"]):
+        return None
+    return index["chunks"]
+
+
+def save_index(filename: str, chunks: List[List[int]]) -> None:
+    """Saves the index of a compressed file, whose chunks must already be written"""
+    index_file = _get_index_file(filename)
+    size = chunks[-1][0] + chunks[-1][1] if len(chunks) > 0 else 0
+    index = {"size": size, "checksum": _get_checksum(filename, chunks), "chunks": chunks}
+    # The index is replaced in one step so it is never partially written
+    with open(index_file + ".tmp", "w") as out:
+        json.dump(index, out)
+    os.replace(index_file + ".tmp", index_file)
+
+
+def _read_chunk(filename: str, fd: int, chunk: List[int]) -> bytes:
+    return _decompress(filename, os.pread(fd, chunk[1], chunk[0]))
+
+
+def iter_chunks(filename: str, chunks: List[List[int]], num_workers: int = NUM_WORKERS) -> Iterator[bytes]:
+    """Yields the decompressed chunks in order while up to `num_workers` chunks are decompressed ahead"""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_read_chunk, filename, fd, chunk))
+                if len(pending) > 2 * num_workers:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+    finally:
+        os.close(fd)
+
+
+class _ChunkReader(io.RawIOBase):
+    """A binary stream over the decompressed chunks of an indexed file"""
+
+    def __init__(self, filename: str, chunks: List[List[int]]) -> None:
+        super().__init__()
+        self.chunks = iter_chunks(filename, chunks)
+        self.buffer = b""
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self.position == len(self.buffer):
+            self.buffer = next(self.chunks, None)
+            self.position = 0
+            if self.buffer is None:
+                self.buffer = b""
+                return 0
+        size = min(len(b), len(self.buffer) - self.position)
+        b[:size] = self.buffer[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def close(self) -> None:
+        self.chunks.close()
+        super().close()
+
+
+def _open_binary(filename: str) -> IO[bytes]:
+    chunks = load_index(filename)
+    if chunks is not None:
+        return io.BufferedReader(_ChunkReader(filename, chunks))
+    if filename.endswith(".zst"):
+        return io.BufferedReader(
+            _import_zstandard().ZstdDecompressor().stream_reader(open(filename, "rb"), read_across_frames=True, closefd=True)
+        )
+    return gzip.open(filename, "rb")
+
+
+class ChunkedWriter(object):
+    """
+    Writes text to a compressed file in independently compressed chunks of
+    about `chunk_size` lines and saves the index of the chunks when it is closed
+    """
+
+    def __init__(self, filename: str, chunk_size: int = CHUNK_SIZE) -> None:
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.out = open(filename, "wb")
+        self.chunks = []
+        self.num_lines = 0
+        self.buffer = []
+        self.buffer_lines = 0
+
+    def write(self, text: str) -> int:
+        self.buffer.append(text)
+        self.buffer_lines += text.count("\n")
+        if self.buffer_lines >= self.chunk_size:
+            # Chunks only end at the end of a line
+            data, _, rest = "".join(self.buffer).rpartition("\n")
+            self._write_chunk((data + "\n").encode("utf-8"))
+            self.buffer = [rest] if len(rest) > 0 else []
+            self.buffer_lines = 0
+        return len(text)
+
+    def _write_chunk(self, data: bytes) -> None:
+        compressed = compress(self.filename, data)
+        num_lines = _count_lines(data)
+        self.chunks.append([self.out.tell(), len(compressed), self.num_lines, num_lines])
+        self.out.write(compressed)
+        self.num_lines += num_lines
+
+    def close(self) -> None:
+        if len(self.buffer) > 0:
+            self._write_chunk("".join(self.buffer).encode("utf-8"))
+        self.buffer = []
+        self.out.close()
+        save_index(self.filename, self.chunks)
+
+    def __enter__(self) -> "ChunkedWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def open_file(filename: str, mode: str = "r"):
+    """
+    Opens a file like `open`, but compressed files are decompressed or
+    compressed in chunks. Compressed files can only be read ("r" or "rb") or
+    written ("w") from the start.
+    """
+    if not is_compressed(filename):
+        return open(filename, mode)
+    if mode == "w":
+        return ChunkedWriter(filename)
+    if mode == "rb":
+        return _open_binary(filename)
+    if mode == "r":
+        return io.TextIOWrapper(_open_binary(filename), encoding="utf-8")
+    raise Exception(f"Unsupported mode for a compressed file: {mode}")
+
+
+def index_lines(filename: str) -> Tuple[List[int], List[int]]:
+    """
+    Returns the position of the start of each line for `LineReader` plus the
+    end of the file, and the byte offset of each line in the uncompressed
+    file. The positions are the byte offsets for plain files and the line
+    numbers for compressed files.
+    """
+    offsets = [0]
+    with open_file(filename, "rb") as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    if is_compressed(filename):
+        return list(range(len(offsets))), offsets
+    return offsets, offsets
+
+
+def iter_positions(filename: str) -> Iterator[Tuple[int, int, str]]:
+    """Yields the start and end positions of each line (see `index_lines`) and the line"""
+    start = 0
+    compressed = is_compressed(filename)
+    with open_file(filename, "rb") as f:
+        for line in f:
+            end = start + (1 if compressed else len(line))
+            yield start, end, line.decode("utf-8")
+            start = end
+
+
+class LineReader(object):
+    """
+    Reads ranges of lines by their positions (see `index_lines`) from one
+    file. The chunks of a compressed file which were decompressed for the last
+    read are kept, so reading nearby lines does not decompress them again.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.compressed = is_compressed(filename)
+        self.f = None
+        self.chunks = None
+        self.cache = {}
+        if not self.compressed:
+            self.f = open(filename, "rb")
+        else:
+            self.chunks = load_index(filename)
+            if self.chunks is None:
+                # Without an index, the whole file is one chunk
+                with open_file(filename, "rb") as f:
+                    data = f.read()
+                self.chunks = [[0, os.path.getsize(filename), 0, _count_lines(data)]]
+                self.cache = {0: _split_lines(data)}
+
+    def read(self, start: int, end: int) -> List[str]:
+        if not self.compressed:
+            self.f.seek(start)
+            # bytes.splitlines also splits on "\r", but the positions only
+            # count "\n"
+            return [line.decode("utf-8") for line in _split_lines(self.f.read(end - start))]
+
+        # Only the chunks which overlap the lines are decompressed
+        indices = [
+            i for i, (_, _, first_line, num_lines) in enumerate(self.chunks)
+            if first_line < end and first_line + num_lines > start
+        ]
+        missing = [i for i in indices if i not in self.cache]
+        cache = {i: self.cache[i] for i in indices if i in self.cache}
+        for i, data in zip(missing, iter_chunks(self.filename, [self.chunks[i] for i in missing])):
+            cache[i] = _split_lines(data)
+        self.cache = cache
+
+        lines = []
+        for i in indices:
+            first_line = self.chunks[i][2]
+            lines.extend(cache[i][max(start - first_line, 0):end - first_line])
+        return [line.decode("utf-8") for line in lines]
+
+    def close(self) -> None:
+        if self.f is not None:
+            self.f.close()
+
+    def __enter__(self) -> "LineReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
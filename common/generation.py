@@ -0,0 +1,138 @@
+import copy
+import numpy as np
+import torch
+from typing import Dict, List
+
+
+def build_sample(model, tokens: List[torch.LongTensor]) -> Dict:
+    """
+    Collates the encoded sentences into a fairseq batch on the model's
+    device. The collater sorts the batch by length, so `sample["id"]` holds
+    the original index of each row.
+    """
+    from fairseq import utils
+
+    lengths = [t.numel() for t in tokens]
+    dataset = model.task.build_dataset_for_inference(tokens, lengths)
+    sample = dataset.collater([dataset[i] for i in range(len(tokens))])
+    return utils.apply_to_sample(lambda t: t.to(model.device), sample)
+
+
+def _get_generation_args(model, beam_size: int, kwargs: Dict):
+    # fairseq 0.10's hub interface has the legacy `args`, and newer versions
+    # have a `cfg` with the generation options in `cfg.generation`
+    cfg = getattr(model, "cfg", None)
+    if cfg is None:
+        gen_args = copy.copy(model.args)
+        gen_args.beam = beam_size
+        for key, value in kwargs.items():
+            setattr(gen_args, key, value)
+        return gen_args
+
+    from omegaconf import open_dict
+    gen_args = copy.deepcopy(cfg.generation)
+    with open_dict(gen_args):
+        gen_args.beam = beam_size
+        for key, value in kwargs.items():
+            setattr(gen_args, key, value)
+    return gen_args
+
+
+def generate_sweep(
+    model,
+    models: List,
+    sample: Dict,
+    beam_sizes: List[int],
+    prefix_tokens: torch.LongTensor = None,
+    **kwargs
+) -> Dict[int, List[List[Dict]]]:
+    """
+    Runs beam search on one batch with every beam size in `beam_sizes`. The
+    encoder is only run once, and its outputs are reused by the search for
+    each beam size. `kwargs` are additional generation arguments, the same
+    as the hub interface's `generate()`. Returns the hypotheses for each beam
+    size in the original order of the batch.
+    """
+    ids = sample["id"].tolist()
+    encoder_outs = None
+    hypotheses = {}
+    for beam_size in beam_sizes:
+        gen_args = _get_generation_args(model, beam_size, kwargs)
+        generator = model.task.build_generator(models, gen_args)
+
+        if encoder_outs is None:
+            with torch.no_grad():
+                encoder_outs = generator.model.forward_encoder(sample["net_input"])
+        # The search reorders (copies) the encoder outputs, so they are not
+        # modified and can be shared by every beam size. The encoder is
+        # restored even if the search fails
+        forward_encoder = generator.model.forward_encoder
+        generator.model.forward_encoder = lambda net_input, outs=encoder_outs: outs
+        try:
+            translations = model.task.inference_step(
+                generator, models, sample, prefix_tokens=prefix_tokens
+            )
+        finally:
+            generator.model.forward_encoder = forward_encoder
+        hypotheses[beam_size] = [
+            hypos for _, hypos in sorted(zip(ids, translations), key=lambda x: x[0])
+        ]
+    return hypotheses
+
+
+def get_details(hypo: Dict) -> Dict:
+    """
+    Returns the model score, token ids, and per-token log-probabilities of a
+    hypothesis from fairseq as NumPy arrays
+    """
+    return {
+        "score": float(hypo["score"]),
+        "tokens": hypo["tokens"].cpu().numpy().astype(np.int32),
+        "positional_scores": hypo["positional_scores"].float().cpu().numpy(),
+    }
+
+
+def save_details(output_file: str, details_list: List[List[Dict]]) -> None:
+    """
+    Saves the details of every hypothesis in the n-best lists into one
+    compressed .npz file of flat arrays. `num_hypotheses` is the length of each
+    n-best list, and `num_tokens` is the length of each hypothesis, which
+    are used to split `tokens` and `positional_scores`.
+    """
+    hypos = [details for nbest in details_list for details in nbest]
+    np.savez_compressed(
+        output_file,
+        num_hypotheses=np.array([len(nbest) for nbest in details_list], dtype=np.int32),
+        scores=np.array([details["score"] for details in hypos], dtype=np.float32),
+        num_tokens=np.array([len(details["tokens"]) for details in hypos], dtype=np.int32),
+        tokens=np.concatenate([details["tokens"] for details in hypos] or [np.zeros(0, dtype=np.int32)]),
+        positional_scores=np.concatenate(
+            [details["positional_scores"] for details in hypos] or [np.zeros(0, dtype=np.float32)]
+        ),
+    )
+
+
+def load_details(input_file: str) -> List[List[Dict]]:
+    """Loads the file written by `save_details` into one list of hypotheses per input"""
+    with np.load(input_file) as data:
+        num_hypotheses_list = data["num_hypotheses"].tolist()
+        scores = data["scores"].tolist()
+        token_offsets = np.concatenate([[0], np.cumsum(data["num_tokens"])])
+        tokens = data["tokens"]
+        positional_scores = data["positional_scores"]
+
+    hypos = []
+    for i, score in enumerate(scores):
+        start, end = token_offsets[i], token_offsets[i + 1]
+        hypos.append({
+            "score": score,
+            "tokens": tokens[start:end],
+            "positional_scores": positional_scores[start:end],
+        })
+
+    details_list = []
+    start = 0
+    for num_hypotheses in num_hypotheses_list:
+        details_list.append(hypos[start:start + num_hypotheses])
+        start += num_hypotheses
+    return details_list
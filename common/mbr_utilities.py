@@ -0,0 +1,175 @@
+import numpy as np
+import re
+from collections import Counter
+from typing import List, Sequence
+
+BLEU_ORDER = 4
+CHRF_ORDER = 6
+CHRF_BETA = 2.0
+
+
+def extract_ngrams(tokens: Sequence, max_order: int) -> List[Counter]:
+    """
+    Counts the n-grams of a list of tokens, or the character n-grams of a
+    string, with one `Counter` per order
+    """
+    ngrams_list = []
+    for n in range(1, max_order + 1):
+        if isinstance(tokens, str):
+            ngrams = Counter(tokens[i:i + n] for i in range(len(tokens) - n + 1))
+        else:
+            ngrams = Counter(zip(*[tokens[k:] for k in range(n)]))
+        ngrams_list.append(ngrams)
+    return ngrams_list
+
+
+class NgramTable(object):
+    """
+    The n-gram counts of a group of candidates (e.g., one n-best list) as one
+    count matrix per order over the n-grams which appear in the group. The
+    clipped matches between every pair of candidates are then computed with
+    matrix products instead of comparing the candidates' n-grams pair by pair.
+    """
+
+    def __init__(self, ngrams_lists: List[List[Counter]], max_order: int) -> None:
+        self.max_order = max_order
+        num_candidates = len(ngrams_lists)
+        self.totals = np.zeros((num_candidates, max_order), dtype=np.float64)
+        self.counts = []
+        for n in range(max_order):
+            keys = []
+            values = []
+            rows = []
+            for i, ngrams_list in enumerate(ngrams_lists):
+                ngrams = ngrams_list[n]
+                keys.extend(ngrams.keys())
+                values.extend(ngrams.values())
+                rows.extend([i] * len(ngrams))
+            vocab = {key: index for index, key in enumerate(dict.fromkeys(keys))}
+
+            counts = np.zeros((num_candidates, len(vocab)), dtype=np.float32)
+            if len(keys) > 0:
+                counts[rows, [vocab[key] for key in keys]] = values
+            self.counts.append(counts)
+            self.totals[:, n] = counts.sum(axis=1)
+
+    def _get_thresholds(self, counts: np.ndarray) -> range:
+        # min(a, b) is the number of thresholds t >= 1 with a >= t and b >= t,
+        # so the clipped counts are a sum of products of binary matrices.
+        # Most n-grams only appear once, so there are very few thresholds
+        return range(1, (int(counts.max()) if counts.size > 0 else 0) + 1)
+
+    def get_matches(self) -> np.ndarray:
+        """
+        Returns the clipped n-gram matches of every pair of candidates, where
+        `matches[n, i, j]` is the number of (n + 1)-grams in both `i` and `j`
+        """
+        num_candidates = self.totals.shape[0]
+        matches = np.zeros((self.max_order, num_candidates, num_candidates), dtype=np.float64)
+        for n, counts in enumerate(self.counts):
+            for t in self._get_thresholds(counts):
+                above = (counts >= t).astype(np.float32)
+                matches[n] += above @ above.T
+        return matches
+
+    def get_matches_to(self, index: int) -> np.ndarray:
+        """Returns the clipped n-gram matches of every candidate with only the candidate `index`"""
+        matches = np.zeros((self.max_order, self.totals.shape[0]), dtype=np.float64)
+        for n, counts in enumerate(self.counts):
+            matches[n] = np.minimum(counts, counts[index]).sum(axis=1)
+        return matches
+
+
+def pairwise_bleu(tokens_list: List[List[str]]) -> np.ndarray:
+    """
+    Computes the sentence-level BLEU of every pair of candidates, where
+    `bleu[i, j]` is the score of `i` with `j` as the reference. The scores are
+    the same as sacrebleu's `sentence_bleu` (exponential smoothing and the
+    effective n-gram order) on the given tokens.
+    """
+    table = NgramTable([extract_ngrams(tokens, BLEU_ORDER) for tokens in tokens_list], BLEU_ORDER)
+    correct = np.moveaxis(table.get_matches(), 0, -1)
+    lengths = np.array([len(tokens) for tokens in tokens_list], dtype=np.float64)
+    total = np.broadcast_to(table.totals[:, None, :], correct.shape)
+
+    # Each order with no matches halves the smoothed precision again
+    has_total = total > 0
+    smooth = 2.0 ** np.cumsum((correct == 0) & has_total, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precisions = np.where(correct > 0, 100.0 * correct / total, 100.0 / (smooth * total))
+        log_precisions = np.where(has_total, np.log(np.where(has_total, precisions, 1.0)), 0.0)
+
+    # Candidates without any n-grams have a score of 0
+    effective_order = has_total.sum(axis=-1)
+    score = np.exp(log_precisions.sum(axis=-1) / np.maximum(effective_order, 1))
+    score = np.where(effective_order > 0, score, 0.0)
+
+    sys_len = lengths[:, None]
+    ref_len = lengths[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bp = np.where(sys_len < ref_len, np.exp(1 - ref_len / sys_len), 1.0)
+    bp = np.where(sys_len > 0, bp, 0.0)
+    return bp * score
+
+
+def _compute_chrf(
+    matches: np.ndarray,
+    hyp_totals: np.ndarray,
+    ref_totals: np.ndarray,
+    beta: float,
+) -> np.ndarray:
+    # The precision and recall are averaged over the orders which both
+    # candidates have n-grams of. The first axis is the order
+    valid = (hyp_totals > 0) & (ref_totals > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(valid, matches / hyp_totals, 0.0).sum(axis=0)
+        recall = np.where(valid, matches / ref_totals, 0.0).sum(axis=0)
+    effective_order = np.maximum(valid.sum(axis=0), 1)
+    precision /= effective_order
+    recall /= effective_order
+
+    beta_square = beta ** 2
+    denominator = beta_square * precision + recall
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = (1 + beta_square) * precision * recall / denominator
+    return np.where(denominator > 0, score, 0.0)
+
+
+def _get_chrf_table(texts: List[str], order: int) -> NgramTable:
+    texts = [re.sub(r"\s+", "", text.strip()) for text in texts]
+    return NgramTable([extract_ngrams(text, order) for text in texts], order)
+
+
+def pairwise_chrf(texts: List[str], order: int = CHRF_ORDER, beta: float = CHRF_BETA) -> np.ndarray:
+    """
+    Computes the sentence-level chrF of every pair of candidates, where
+    `chrf[i, j]` is the score of `i` with `j` as the reference, the same as
+    sacrebleu's `sentence_chrf` (character n-grams without whitespace)
+    """
+    table = _get_chrf_table(texts, order)
+    totals = table.totals.T
+    return _compute_chrf(table.get_matches(), totals[:, :, None], totals[:, None, :], beta)
+
+
+def sentence_chrf(
+    texts: List[str],
+    reference: str,
+    order: int = CHRF_ORDER,
+    beta: float = CHRF_BETA,
+) -> np.ndarray:
+    """Computes the sentence-level chrF of each candidate with the same reference"""
+    table = _get_chrf_table(texts + [reference], order)
+    totals = table.totals.T
+    matches = table.get_matches_to(len(texts))[:, :-1]
+    return _compute_chrf(matches, totals[:, :-1], totals[:, -1:], beta)
+
+
+def expected_utility(utilities: np.ndarray) -> np.ndarray:
+    """
+    Returns the expected utility of each candidate against the other
+    candidates, which are used as pseudo-references with uniform weights
+    """
+    num_candidates = utilities.shape[0]
+    if num_candidates == 1:
+        return np.zeros(1)
+    return (utilities.sum(axis=1) - np.diag(utilities)) / (num_candidates - 1)
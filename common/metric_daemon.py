@@ -0,0 +1,117 @@
+import argparse
+import os
+import sys
+import traceback
+from getpass import getuser
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Tuple
+
+# The metrics are registered by the experiment's `src/metrics.py`. When the
+# daemon is run as a script, it is run from the experiment's directory (e.g.,
+# `mt/`), so that is where the registry is
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.getcwd(), "src"))
+import metrics
+
+_AUTHKEY = b"ref-free-metrics"
+
+# The metric instances which have been constructed by this process,
+# keyed by (metric, language, device)
+_metrics = {}
+
+
+def _get_socket_path() -> str:
+    return os.environ.get(
+        "METRIC_DAEMON_SOCKET", f"/tmp/ref-free-{metrics.EXPERIMENT}-metrics-{getuser()}.sock"
+    )
+
+
+def get_metric(name: str, language: str, device: int):
+    key = (name, language, device)
+    if key not in _metrics:
+        print(f"Loading {name} (language={language}, device={device})")
+        _metrics[key] = metrics.load_backend(name, language, device)
+    return _metrics[key]
+
+
+def _connect():
+    socket_path = _get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        return Client(socket_path, family="AF_UNIX", authkey=_AUTHKEY)
+    except OSError:
+        # A stale socket from a daemon which is no longer running
+        return None
+
+
+def predict_batch(
+    name: str, inputs: List[Dict], language: str = None, device: int = 0
+) -> Tuple[Dict, List[Dict]]:
+    """
+    Scores the inputs with the daemon if one is running and falls back to
+    scoring them in-process otherwise. The return value is the same as the
+    metric's `predict_batch`.
+    """
+    conn = _connect()
+    if conn is None:
+        return get_metric(name, language, device).predict_batch(inputs)
+
+    with conn:
+        conn.send({"metric": name, "language": language, "device": device, "inputs": inputs})
+        response = conn.recv()
+    if "error" in response:
+        raise Exception(f"The metric daemon failed to score {name}:\n{response['error']}")
+    return response["macro"], response["micro"]
+
+
+def serve(socket_path: str) -> None:
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    with Listener(socket_path, family="AF_UNIX", authkey=_AUTHKEY) as listener:
+        os.chmod(socket_path, 0o600)
+        print(f"Listening on {socket_path}")
+        while True:
+            with listener.accept() as conn:
+                request = conn.recv()
+                if request.get("command") == "shutdown":
+                    conn.send({})
+                    break
+
+                try:
+                    metric = get_metric(request["metric"], request["language"], request["device"])
+                    print(f"Scoring {len(request['inputs'])} inputs with {request['metric']}")
+                    macro, micro = metric.predict_batch(request["inputs"])
+                    conn.send({"macro": macro, "micro": micro})
+                except Exception:
+                    conn.send({"error": traceback.format_exc()})
+
+
+def main(args):
+    socket_path = args.socket or _get_socket_path()
+    if args.shutdown:
+        os.environ["METRIC_DAEMON_SOCKET"] = socket_path
+        conn = _connect()
+        if conn is not None:
+            with conn:
+                conn.send({"command": "shutdown"})
+                conn.recv()
+        return
+
+    # Each preloaded metric is specified as "metric:language:device", where
+    # the language may be empty for language-independent metrics
+    for spec in args.preload:
+        name, language, device = spec.split(":")
+        get_metric(name, language or None, int(device))
+
+    serve(socket_path)
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--socket")
+    argp.add_argument("--preload", nargs="+", default=[])
+    argp.add_argument("--shutdown", action="store_true")
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,237 @@
+# A columnar alternative to the n-best JSONL files (`predictions.jsonl` and
+# `scores.jsonl`). A store is a directory of NumPy arrays with one entry per
+# prediction, in the same order as the JSONL file:
+#
+#   meta.json                    the number of segments and the score columns
+#   offsets.npy                  the i-th n-best list is `offsets[i]:offsets[i + 1]`
+#   segment_id.npy, rank.npy     the segment and the rank within its n-best list
+#   prediction.bin/.offsets.npy  the UTF-8 predictions and their byte offsets
+#   instance_id.bin/.offsets.npy the segments' instance IDs (summarization only)
+#   scores/<i>.npy               one column per metric output, int64 if every
+#                                score is an int and float64 otherwise
+#
+# Every array is memory-mapped when the store is opened, so reading the scores
+# does not parse anything and only the predictions which are used are decoded.
+import json
+import numpy as np
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import chunked_io
+import metrics
+
+META_FILE = "meta.json"
+
+
+def is_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class StringColumn(object):
+    """A memory-mapped list of strings which are decoded when they are accessed"""
+
+    def __init__(self, path: str, name: str) -> None:
+        self.offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+        data_file = os.path.join(path, f"{name}.bin")
+        # np.memmap cannot map an empty file
+        if os.path.getsize(data_file) > 0:
+            self.data = np.memmap(data_file, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def get_range(self, start: int, end: int) -> List[str]:
+        """Decodes the strings `start:end` with one copy of their bytes"""
+        data = self.data[self.offsets[start]:self.offsets[end]].tobytes()
+        offsets = self.offsets[start:end + 1] - self.offsets[start]
+        return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(end - start)]
+
+
+def _write_strings(path: str, name: str, strings: Iterator[str]) -> None:
+    lengths = []
+    with open(os.path.join(path, f"{name}.bin"), "wb") as out:
+        for string in strings:
+            data = string.encode("utf-8")
+            out.write(data)
+            lengths.append(len(data))
+    np.save(os.path.join(path, f"{name}.offsets.npy"), np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]))
+
+
+class NbestStore(object):
+    """
+    Opens a store with memory-mapping. `scores` has one array per metric with
+    the metric's main output (see `metrics.METRICS`), and `columns` has every
+    score column, keyed by `(metric, field)`, where `field` is `None` for
+    metrics which are saved as a single number.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.num_segments = self.meta["num_segments"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.segment_ids = np.load(os.path.join(path, "segment_id.npy"), mmap_mode="r")
+        self.ranks = np.load(os.path.join(path, "rank.npy"), mmap_mode="r")
+        self.predictions = StringColumn(path, "prediction")
+        self.instance_ids = None
+        if self.meta["has_instance_ids"]:
+            self.instance_ids = StringColumn(path, "instance_id")
+
+        self.columns = {}
+        self.scores = {}
+        for column in self.meta["columns"]:
+            values = np.load(os.path.join(path, column["file"]), mmap_mode="r")
+            self.columns[(column["metric"], column["field"])] = values
+            if column["is_main"]:
+                self.scores[column["metric"]] = values
+
+    def get_nbest(self, index: int) -> List[str]:
+        return self.predictions.get_range(int(self.offsets[index]), int(self.offsets[index + 1]))
+
+    def iter_nbest_lists(self) -> Iterator[List[str]]:
+        for index in range(self.num_segments):
+            yield self.get_nbest(index)
+
+
+def _is_main(metric: str, field: Optional[str]) -> bool:
+    if field is None:
+        return True
+    return metric in metrics.METRICS and metrics.METRICS[metric].key == field
+
+
+def _get_columns(prediction: Dict) -> List[Tuple[str, Optional[str]]]:
+    columns = []
+    for metric, value in prediction.items():
+        if metric == "prediction":
+            continue
+        if isinstance(value, dict):
+            columns.extend((metric, field) for field in value)
+        else:
+            columns.append((metric, None))
+    return columns
+
+
+def _format_columns(columns) -> str:
+    return ", ".join(sorted(metric if field is None else f"{metric}.{field}" for metric, field in columns))
+
+
+def _get_dtype(values: List) -> type:
+    # The ints are kept so `to_jsonl` writes the same values. Bools are not
+    # counted as ints, so they are saved as floats
+    return np.int64 if all(type(value) is int for value in values) else np.float64
+
+
+def from_jsonl(jsonl_file: str, path: str) -> None:
+    """
+    Converts an n-best JSONL file into a store at `path`. Each line is either
+    a list of predictions (MT) or an instance with an "instance_id" and a list
+    of "predictions" (summarization). Every prediction must have the same
+    scores, and a score is either a number or a dict of numbers.
+    """
+    instance_ids = []
+    lengths = []
+    columns = None
+    values = None
+    column_set = None
+
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    def _iter_predictions() -> Iterator[str]:
+        nonlocal columns, values, column_set
+        with chunked_io.open_file(jsonl_file, "r") as f:
+            for line in f:
+                data = json.loads(line)
+                if isinstance(data, dict):
+                    instance_ids.append(data["instance_id"])
+                    nbest = data["predictions"]
+                else:
+                    nbest = data
+                lengths.append(len(nbest))
+
+                for prediction in nbest:
+                    if columns is None:
+                        columns = _get_columns(prediction)
+                        values = [[] for _ in columns]
+                        column_set = set(columns)
+                    # The fields of the dict scores must also be the same
+                    prediction_columns = set(_get_columns(prediction))
+                    if prediction_columns != column_set:
+                        raise Exception(
+                            f"Every prediction must have the same scores. Segment {len(lengths) - 1} has "
+                            f"{_format_columns(prediction_columns)} instead of {_format_columns(column_set)}"
+                        )
+                    for column_values, (metric, field) in zip(values, columns):
+                        value = prediction[metric]
+                        column_values.append(value if field is None else value[field])
+                    yield prediction["prediction"]
+
+    _write_strings(tmp_path, "prediction", _iter_predictions())
+    if len(instance_ids) > 0:
+        _write_strings(tmp_path, "instance_id", instance_ids)
+
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    segment_ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    np.save(os.path.join(tmp_path, "segment_id.npy"), segment_ids)
+    np.save(os.path.join(tmp_path, "rank.npy"), (np.arange(offsets[-1]) - offsets[segment_ids]).astype(np.int32))
+
+    os.makedirs(os.path.join(tmp_path, "scores"))
+    meta_columns = []
+    for i, ((metric, field), column_values) in enumerate(zip(columns or [], values or [])):
+        filename = os.path.join("scores", f"{i}.npy")
+        np.save(os.path.join(tmp_path, filename), np.array(column_values, dtype=_get_dtype(column_values)))
+        meta_columns.append({"metric": metric, "field": field, "file": filename, "is_main": _is_main(metric, field)})
+
+    with open(os.path.join(tmp_path, META_FILE), "w") as out:
+        out.write(json.dumps({
+            "num_segments": len(lengths),
+            "num_predictions": int(offsets[-1]),
+            "has_instance_ids": len(instance_ids) > 0,
+            "columns": meta_columns,
+        }, indent=2))
+
+    # The store only replaces an existing one once it is complete
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def to_jsonl(path: str, jsonl_file: str) -> None:
+    """Converts a store back into the n-best JSONL format it was created from"""
+    store = NbestStore(path)
+    columns = list(store.columns.items())
+    dirname = os.path.dirname(jsonl_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(jsonl_file, "w") as out:
+        for index in range(store.num_segments):
+            start = int(store.offsets[index])
+            nbest = []
+            for i, prediction in enumerate(store.get_nbest(index)):
+                output = {"prediction": prediction}
+                for (metric, field), values in columns:
+                    # A Python int or float, depending on the column's dtype
+                    value = values[start + i].item()
+                    if field is None:
+                        output[metric] = value
+                    else:
+                        output.setdefault(metric, {})[field] = value
+                nbest.append(output)
+
+            if store.instance_ids is not None:
+                out.write(json.dumps({"instance_id": store.instance_ids[index], "predictions": nbest}) + "\n")
+            else:
+                out.write(json.dumps(nbest) + "\n")
@@ -0,0 +1,160 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Callable, Dict, List, Tuple
+
+# The version of each metric which is part of the cache key. Update the
+# version when a metric's model or implementation changes so that scores
+# from the old version are not reused. The MT and summarization metrics are
+# both listed here
+METRIC_VERSIONS = {
+    "bleurt": "repro==0.1.4",
+    "comet": "repro==0.1.4",
+    "comet-nbest": "unbabel-comet/wmt20-comet-qe-da",
+    "prism": "repro==0.1.4",
+    "prism-nbest": "fairseq/m39v1",
+    "bertscore": "repro==0.1.4",
+    "bertscore-cached": "bert_score",
+    "rouge": "repro==0.1.4",
+    "qaeval": "repro==0.1.4",
+    "questeval": "questeval==0.1.1",
+    "blanc": "repro==0.1.4",
+}
+
+# The maximum number of variables in a single SQLite query
+_MAX_VARIABLES = 500
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(json.dumps(value).encode()).hexdigest()
+
+
+class ScoreCache(object):
+    """
+    An on-disk cache of segment-level metric scores which is shared by all of
+    the scoring scripts. The cache is keyed by the metric name, its version,
+    the language, and the hashes of the candidate, sources, and references,
+    and it stores the metric's per-segment score dict.
+
+    The cache is an SQLite database, so several processes (e.g., different
+    Slurm jobs) can read and write it at the same time. The cache directory
+    should be on a file system which supports POSIX file locking.
+    """
+
+    def __init__(self, cache_dir: str, timeout: float = 600) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(f"{cache_dir}/scores.sqlite", timeout=timeout)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "key TEXT PRIMARY KEY, metric TEXT NOT NULL, "
+                "scores TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS scores_last_access ON scores (last_access)"
+            )
+
+    @staticmethod
+    def get_key(metric: str, language: str, inp: Dict) -> str:
+        return _hash([
+            metric,
+            METRIC_VERSIONS[metric],
+            language,
+            _hash(inp["candidate"]),
+            _hash(inp.get("sources")),
+            _hash(inp.get("references")),
+        ])
+
+    def get_many(self, keys: List[str]) -> List[Dict]:
+        """Returns the cached scores for the keys, or `None` for cache misses"""
+        found = {}
+        now = time.time()
+        with self.conn:
+            for i in range(0, len(keys), _MAX_VARIABLES):
+                batch = keys[i:i + _MAX_VARIABLES]
+                placeholders = ", ".join(["?"] * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, scores FROM scores WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, scores in rows:
+                    found[key] = json.loads(scores)
+                self.conn.execute(
+                    f"UPDATE scores SET last_access = ? WHERE key IN ({placeholders})",
+                    [now] + batch
+                )
+        return [found.get(key) for key in keys]
+
+    def put_many(self, items: List[Tuple[str, str, Dict]]) -> None:
+        """Saves a list of (key, metric, scores) tuples"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scores (key, metric, scores, last_access) VALUES (?, ?, ?, ?)",
+                [(key, metric, json.dumps(scores, default=float), now) for key, metric, scores in items]
+            )
+
+    def evict(self, max_entries: int = None, max_age_days: float = None) -> int:
+        """Removes the least recently used entries and returns how many were removed"""
+        removed = 0
+        with self.conn:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 24 * 60 * 60
+                removed += self.conn.execute(
+                    "DELETE FROM scores WHERE last_access < ?", (cutoff,)
+                ).rowcount
+            if max_entries is not None:
+                removed += self.conn.execute(
+                    "DELETE FROM scores WHERE key IN ("
+                    "SELECT key FROM scores ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,)
+                ).rowcount
+        return removed
+
+
+def cached_predict_batch(
+    cache: ScoreCache,
+    metric: str,
+    language: str,
+    inputs: List[Dict],
+    predict_batch: Callable,
+) -> List[Dict]:
+    """
+    Returns the per-segment scores of the inputs, only running `predict_batch`
+    on the inputs which are not in the cache. If `cache` is `None`, every
+    input is scored.
+    """
+    if cache is None:
+        _, micro = predict_batch(inputs)
+        return micro
+
+    keys = [ScoreCache.get_key(metric, language, inp) for inp in inputs]
+    micro = cache.get_many(keys)
+    missing = [i for i, scores in enumerate(micro) if scores is None]
+    print(f"Found {len(inputs) - len(missing)} / {len(inputs)} cached {metric} scores")
+
+    if len(missing) > 0:
+        _, missing_micro = predict_batch([inputs[i] for i in missing])
+        cache.put_many([
+            (keys[i], metric, scores) for i, scores in zip(missing, missing_micro)
+        ])
+        for i, scores in zip(missing, missing_micro):
+            micro[i] = scores
+    return micro
+
+
+def main(args):
+    cache = ScoreCache(args.cache_dir)
+    removed = cache.evict(args.max_entries, args.max_age_days)
+    print(f"Evicted {removed} entries from {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--cache-dir", required=True)
+    argp.add_argument("--max-entries", type=int)
+    argp.add_argument("--max-age-days", type=float)
+    args = argp.parse_args()
+    main(args)
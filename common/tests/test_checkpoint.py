@@ -0,0 +1,56 @@
+import os
+import pytest
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import checkpoint
+import chunked_io
+
+CONFIG = {"input_file": {"size": 10, "mtime": 1.0}}
+
+
+def _read_lines(filename: str):
+    with chunked_io.open_file(filename, "r") as f:
+        return f.read().splitlines()
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz"])
+def test_resume(tmp_path, extension):
+    output_file = str(tmp_path / f"scores{extension}")
+    manifest = checkpoint.ProgressManifest(output_file, CONFIG)
+    assert not manifest.is_resumed
+    manifest.append(["a", "b"])
+    manifest.append(["c"])
+    # The job is killed while it writes the third chunk
+    manifest.out.write(b"partial")
+    manifest.out.flush()
+
+    manifest = checkpoint.ProgressManifest(output_file, CONFIG)
+    assert manifest.is_resumed
+    assert manifest.num_completed == 2
+    assert os.path.getsize(output_file) == manifest.output_size
+    manifest.append(["d", "e"])
+    manifest.close()
+
+    assert _read_lines(output_file) == ["a", "b", "c", "d", "e"]
+    if chunked_io.is_compressed(output_file):
+        # Every chunk is indexed, so a range can be read without the others
+        assert len(chunked_io.load_index(output_file)) == 3
+        positions, _ = chunked_io.index_lines(output_file)
+        with chunked_io.LineReader(output_file) as reader:
+            assert reader.read(positions[2], positions[4]) == ["c", "d"]
+
+
+def test_config_change(tmp_path):
+    output_file = str(tmp_path / "scores.jsonl")
+    manifest = checkpoint.ProgressManifest(output_file, CONFIG)
+    manifest.append(["a"])
+    manifest.close()
+
+    # A different config starts the output over
+    manifest = checkpoint.ProgressManifest(output_file, {"input_file": {"size": 11, "mtime": 1.0}})
+    assert not manifest.is_resumed
+    assert manifest.num_completed == 0
+    manifest.append(["b"])
+    manifest.close()
+    assert _read_lines(output_file) == ["b"]
@@ -0,0 +1,50 @@
+import gzip
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chunked_io
+import pytest
+
+# Only "\n" ends a line. The other line boundaries of str/bytes.splitlines are
+# part of the lines
+LINES = ["a\rb", "c\x0bd\x0ce", "\x1cf\x1dg\x1eh", "i\x85j k", "", "l"]
+
+
+def _write(filename: str) -> None:
+    data = "".join(line + "\n" for line in LINES).encode("utf-8")
+    if filename.endswith(".gz"):
+        with gzip.open(filename, "wb") as out:
+            out.write(data)
+    else:
+        with open(filename, "wb") as out:
+            out.write(data)
+
+
+@pytest.mark.parametrize("extension", [".txt", ".gz"])
+def test_line_reader(tmp_path, extension):
+    filename = str(tmp_path / f"lines{extension}")
+    _write(filename)
+    positions, _ = chunked_io.index_lines(filename)
+    assert len(positions) == len(LINES) + 1
+
+    with chunked_io.LineReader(filename) as reader:
+        for i, line in enumerate(LINES):
+            assert reader.read(positions[i], positions[i + 1]) == [line]
+        assert reader.read(positions[1], positions[4]) == LINES[1:4]
+        assert reader.read(positions[0], positions[-1]) == LINES
+
+
+def test_index_of_rewritten_file(tmp_path):
+    filename = str(tmp_path / "lines.gz")
+    with chunked_io.ChunkedWriter(filename, chunk_size=2) as out:
+        for line in LINES:
+            out.write(line + "\n")
+    chunks = chunked_io.load_index(filename)
+    assert len(chunks) == 3
+
+    # A file which is rewritten with the same size must not use the old index
+    with open(filename, "r+b") as f:
+        f.seek(chunks[-1][0] + chunks[-1][1] - 1)
+        f.write(b"\xff")
+    assert chunked_io.load_index(filename) is None
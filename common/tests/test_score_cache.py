@@ -0,0 +1,83 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import score_cache
+
+INPUT = {"candidate": "a b", "sources": ["c"], "references": ["d e"]}
+
+
+class _Metric(object):
+    """Counts which inputs are scored"""
+
+    def __init__(self) -> None:
+        self.scored = []
+
+    def predict_batch(self, inputs):
+        self.scored.extend(inp["candidate"] for inp in inputs)
+        micro = [{"prism": float(len(inp["candidate"]))} for inp in inputs]
+        return {}, micro
+
+
+def test_key():
+    key = score_cache.ScoreCache.get_key("prism", "en", INPUT)
+    assert key == score_cache.ScoreCache.get_key("prism", "en", dict(INPUT))
+    for metric, language, inp in [
+        ("comet", "en", INPUT),
+        ("prism", "de", INPUT),
+        ("prism", "en", {**INPUT, "candidate": "a  b"}),
+        ("prism", "en", {**INPUT, "sources": ["c "]}),
+        ("prism", "en", {**INPUT, "references": None}),
+    ]:
+        assert score_cache.ScoreCache.get_key(metric, language, inp) != key
+
+
+def test_cached_predict_batch(tmp_path):
+    cache = score_cache.ScoreCache(str(tmp_path))
+    inputs = [{"candidate": "a"}, {"candidate": "bc"}, {"candidate": "a"}]
+
+    metric = _Metric()
+    micro = score_cache.cached_predict_batch(cache, "prism", "en", inputs[:2], metric.predict_batch)
+    assert micro == [{"prism": 1.0}, {"prism": 2.0}]
+
+    # Only the inputs which are not cached are scored
+    metric = _Metric()
+    micro = score_cache.cached_predict_batch(
+        cache, "prism", "en", inputs + [{"candidate": "def"}], metric.predict_batch
+    )
+    assert micro == [{"prism": 1.0}, {"prism": 2.0}, {"prism": 1.0}, {"prism": 3.0}]
+    assert metric.scored == ["def"]
+
+
+def test_version_change(tmp_path, monkeypatch):
+    cache = score_cache.ScoreCache(str(tmp_path))
+    score_cache.cached_predict_batch(cache, "prism", "en", [INPUT], _Metric().predict_batch)
+
+    # The scores of the old version are not reused
+    monkeypatch.setitem(score_cache.METRIC_VERSIONS, "prism", "repro==0.2.0")
+    metric = _Metric()
+    score_cache.cached_predict_batch(cache, "prism", "en", [INPUT], metric.predict_batch)
+    assert metric.scored == [INPUT["candidate"]]
+
+
+def test_evict(tmp_path, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(score_cache.time, "time", lambda: now[0])
+    cache = score_cache.ScoreCache(str(tmp_path))
+    keys = ["a", "b", "c", "d"]
+    for i, key in enumerate(keys):
+        now[0] = i * 24 * 60 * 60
+        cache.put_many([(key, "prism", {"prism": float(i)})])
+
+    # Reading "a" makes it the most recently used entry
+    now[0] = 4 * 24 * 60 * 60
+    assert cache.get_many(["a"]) == [{"prism": 0.0}]
+
+    # "b" was last used 3 days ago
+    assert cache.evict(max_age_days=2.5) == 1
+    assert cache.get_many(keys) == [{"prism": 0.0}, None, {"prism": 2.0}, {"prism": 3.0}]
+    # Only the most recently used entry is kept
+    now[0] += 1
+    assert cache.get_many(["c"]) == [{"prism": 2.0}]
+    assert cache.evict(max_entries=1) == 2
+    assert cache.get_many(keys) == [None, None, {"prism": 2.0}, None]
@@ -1,5 +1,7 @@
 set -e
 
+cache_dir=${SCORE_CACHE_DIR:-output/prism-optimization/cache}
+
 for lp in "de-en" "fi-en" "kk-en" "lt-en" "ru-en" "zh-en" "en-cs" "en-de" "en-fi" "en-kk" "en-lt" "en-ru" "en-zh" "de-cs" "de-fr" "fr-de"; do
   src=${lp:0:2}
   tgt=${lp:3:5}
@@ -11,6 +13,8 @@ for lp in "de-en" "fi-en" "kk-en" "lt-en" "ru-en" "zh-en" "en-cs" "en-de" "en-fi
   score_file=${output_dir}/scores.json
   mkdir -p ${output_dir}
 
+  # The translations come from repro's Prism, the same as in the paper.
+  # --prism-model-dir switches to the in-process beam search (see the Readme)
   python src/prism-optimization/translate.py \
     --input-file ${source_file} \
     --language ${tgt} \
@@ -25,6 +29,7 @@ for lp in "de-en" "fi-en" "kk-en" "lt-en" "ru-en" "zh-en" "en-cs" "en-de" "en-fi
     --source-file ${source_file} \
     --reference-file ${reference_file} \
     --device ${CUDA_VISIBLE_DEVICES} \
+    --cache-dir ${cache_dir} \
     --bleu \
     --bleurt \
     --comet \
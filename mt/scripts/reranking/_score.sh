@@ -1,11 +1,16 @@
 language=$1
 input_file=$2
-pred_file=$3
-output_file=$4
+# Space-separated lists of the prediction files for every beam size and
+# their output files, which are scored together
+pred_files=$3
+output_files=$4
 
 python src/reranking/score.py \
   --input-file ${input_file} \
-  --pred-file ${pred_file} \
+  --pred-file ${pred_files} \
   --devices 0 1 2 3 4 5 6 7 \
   --language ${language} \
-  --output-file ${output_file}
+  --comet-nbest \
+  --prism-nbest \
+  --prism-model-dir data/prism/m39v1 \
+  --output-file ${output_files}
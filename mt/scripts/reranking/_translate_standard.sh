@@ -7,14 +7,18 @@
 
 lp=$1
 input_file=$2
-output_file=$3
-beam_size=$4
+# Space-separated lists of the output files and their beam sizes, which
+# are all generated by one job
+output_files=$3
+beam_sizes=$4
 
-mkdir -p $(dirname ${output_file})
+for output_file in ${output_files}; do
+  mkdir -p $(dirname ${output_file})
+done
 
 python src/reranking/translate.py \
   --lp ${lp} \
   --input-file ${input_file} \
-  --beam-size ${beam_size} \
+  --beam-size ${beam_sizes} \
   --inference-method standard \
-  --output-file ${output_file}
+  --output-file ${output_files}
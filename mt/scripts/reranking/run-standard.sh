@@ -7,20 +7,30 @@ for lp in "de-en" "en-de" "en-ru" "ru-en"; do
   source_file=data/wmt19/wmt19-submitted-data-v3/txt/sources/newstest2019-${src}${tgt}-src.${src}
   reference_file=data/wmt19/wmt19-submitted-data-v3/txt/references/newstest2019-${src}${tgt}-ref.${tgt}
 
-  for beam_size in 1 2 4 8 16 32 64; do
-    output_dir=output/reranking/${lp}/standard/${beam_size}
-    pred_file=${output_dir}/predictions.jsonl
-    score_file=${output_dir}/scores.jsonl
-    mkdir -p ${output_dir}
+  # All of the beam sizes are generated by one job which loads the models once
+  beam_sizes="1 2 4 8 16 32 64"
+  pred_files=""
+  for beam_size in ${beam_sizes}; do
+    pred_files="${pred_files} output/reranking/${lp}/standard/${beam_size}/predictions.jsonl"
+  done
+
+  log_dir=output/reranking/${lp}/standard/logs
+  log_file=${log_dir}/translate.log
+  mkdir -p ${log_dir}
 
-    log_dir=${output_dir}/logs
-    log_file=${log_dir}/translate.log
-    mkdir -p ${log_dir}
+  sbatch --output ${log_file} --job-name ${lp}-translate-standard \
+    ${DIR}/_translate_standard.sh ${lp} ${source_file} "${pred_files}" "${beam_sizes}"
 
-    sbatch --output ${log_file} --job-name ${lp}-translate-standard-${beam_size} \
-      ${DIR}/_translate_standard.sh ${lp} ${source_file} ${pred_file} ${beam_size}
+  # The hypotheses which are shared by the beam sizes are only scored once
+  score_files=""
+  for beam_size in ${beam_sizes}; do
+    score_files="${score_files} output/reranking/${lp}/standard/${beam_size}/scores.jsonl"
+  done
+  sh ${DIR}/_score.sh ${tgt} ${source_file} "${pred_files}" "${score_files}"
 
-    sh ${DIR}/_score.sh ${tgt} ${source_file} ${pred_file} ${score_file}
+  for beam_size in ${beam_sizes}; do
+    output_dir=output/reranking/${lp}/standard/${beam_size}
+    score_file=${output_dir}/scores.jsonl
 
     sh ${DIR}/_rerank.sh \
       ${score_file} \
@@ -28,7 +38,15 @@ for lp in "de-en" "en-de" "en-ru" "ru-en"; do
       ${output_dir}/prism/predictions.txt \
       ${output_dir}/comet/predictions.txt
 
-    for method in standard prism comet; do
+    # The best possible selections according to the reference
+    python src/reranking/oracle.py \
+      --pred-file ${output_dir}/predictions.jsonl \
+      --reference-file ${reference_file} \
+      --sentence-bleu-file ${output_dir}/oracle-bleu/predictions.txt \
+      --sentence-chrf-file ${output_dir}/oracle-chrf/predictions.txt \
+      --corpus-bleu-file ${output_dir}/oracle-corpus-bleu/predictions.txt
+
+    for method in standard prism comet oracle-bleu oracle-chrf oracle-corpus-bleu; do
       sh ${DIR}/_evaluate.sh \
         ${lp} \
         ${method}-${beam_size} \
@@ -43,4 +61,5 @@ done
 python src/reranking/analyze.py \
   --input-dir output/reranking \
   --output-dir output/reranking/results \
-  --method standard
\ No newline at end of file
+  --method standard \
+  --oracle
\ No newline at end of file
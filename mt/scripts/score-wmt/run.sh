@@ -8,41 +8,12 @@ for lp in "de-en" "fi-en" "gu-en" "kk-en" "lt-en" "ru-en" "zh-en" "en-cs" "en-de
 
   output_dir=output/score-wmt/${lp}
 
-  # Score the submissions
-  submission_output_dir=${output_dir}/submissions
-  mkdir -p ${submission_output_dir}
-  for hyp_file in data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp}/*; do
-    # Extract the system name from the filename
-    filename=$(basename ${hyp_file})
-    filename=${filename%.*}
-    system=$(echo ${filename} | cut -c 14-)
-
-    output_file=${submission_output_dir}/${system}.json
-
-    echo ${lp} ${system}
-
-    python src/score.py \
-      --candidate-file ${hyp_file} \
-      --output-file ${output_file} \
-      --system-name ${system} \
-      --lp ${lp} \
-      --source-file ${source_file} \
-      --reference-file ${reference_file} \
-      --device ${CUDA_VISIBLE_DEVICES} \
-      --bleu \
-      --bleurt \
-      --comet \
-      --comet-src \
-      --prism \
-      --prism-src \
-      --bertscore
-  done
-
-  # Score the reference
+  # Score the submissions and the reference in one run so each
+  # metric is only loaded once per language pair
   python src/score.py \
-    --candidate-file ${reference_file} \
-    --output-file ${output_dir}/reference.json \
-    --system-name "reference" \
+    --candidate-dir data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp} \
+    --output-dir ${output_dir}/submissions \
+    --reference-output-file ${output_dir}/reference.json \
     --lp ${lp} \
     --source-file ${source_file} \
     --reference-file ${reference_file} \
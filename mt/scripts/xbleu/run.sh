@@ -2,25 +2,18 @@ set -e
 
 for lp in "de-en" "fi-en" "kk-en" "lt-en" "ru-en" "zh-en" "en-cs" "en-de" "en-fi" "en-kk" "en-lt" "en-ru" "en-zh" "de-cs" "de-fr" "fr-de"; do
   output_dir=output/xbleu/prism-src/${lp}
-  for hyp_file in data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp}/*; do
-    # Extract the system name from the filename
-    filename=$(basename ${hyp_file})
-    filename=${filename%.*}
-    system=$(echo ${filename} | cut -c 14-)
 
-    # Score using the output from optimizing Prism-src
-    # as the reference
-    python src/score.py \
-      --candidate-file ${hyp_file} \
-      --output-file ${output_dir}/scores/${system}.json \
-      --system-name ${system} \
-      --lp ${lp} \
-      --reference-file output/prism-optimization/${lp}/predictions.txt \
-      --device ${CUDA_VISIBLE_DEVICES} \
-      --bleu \
-      --bleurt \
-      --bertscore
-  done
+  # Score using the output from optimizing Prism-src
+  # as the reference
+  python src/score.py \
+    --candidate-dir data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp} \
+    --output-dir ${output_dir}/scores \
+    --lp ${lp} \
+    --reference-file output/prism-optimization/${lp}/predictions.txt \
+    --device ${CUDA_VISIBLE_DEVICES} \
+    --bleu \
+    --bleurt \
+    --bertscore
 done
 
 for metric in bleu bleurt bertscore; do
@@ -35,25 +28,18 @@ done
 
 for lp in "de-en" "en-de" "en-ru" "ru-en"; do
   output_dir=output/xbleu/comet-src/${lp}
-  for hyp_file in data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp}/*; do
-    # Extract the system name from the filename
-    filename=$(basename ${hyp_file})
-    filename=${filename%.*}
-    system=$(echo ${filename} | cut -c 14-)
 
-    # Score using the output from optimizing COMET-src
-    # as the reference
-    python src/score.py \
-      --candidate-file ${hyp_file} \
-      --output-file ${output_dir}/scores/${system}.json \
-      --system-name ${system} \
-      --lp ${lp} \
-      --reference-file output/reranking/${lp}/standard/64/comet/predictions.txt \
-      --device ${CUDA_VISIBLE_DEVICES} \
-      --bleu \
-      --bleurt \
-      --bertscore
-    done
+  # Score using the output from optimizing COMET-src
+  # as the reference
+  python src/score.py \
+    --candidate-dir data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp} \
+    --output-dir ${output_dir}/scores \
+    --lp ${lp} \
+    --reference-file output/reranking/${lp}/standard/64/comet/predictions.txt \
+    --device ${CUDA_VISIBLE_DEVICES} \
+    --bleu \
+    --bleurt \
+    --bertscore
 done
 
 for metric in bleu bleurt bertscore; do
@@ -68,25 +54,18 @@ done
 
 for lp in "de-en" "en-de" "en-ru" "ru-en"; do
   output_dir=output/xbleu/prism-src-rerank/${lp}
-  for hyp_file in data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp}/*; do
-    # Extract the system name from the filename
-    filename=$(basename ${hyp_file})
-    filename=${filename%.*}
-    system=$(echo ${filename} | cut -c 14-)
 
-    # Score using the output from optimizing Prism-src
-    # as the reference using reranking
-    python src/score.py \
-      --candidate-file ${hyp_file} \
-      --output-file ${output_dir}/scores/${system}.json \
-      --system-name ${system} \
-      --lp ${lp} \
-      --reference-file output/reranking/${lp}/standard/64/prism/predictions.txt \
-      --device ${CUDA_VISIBLE_DEVICES} \
-      --bleu \
-      --bleurt \
-      --bertscore
-    done
+  # Score using the output from optimizing Prism-src
+  # as the reference using reranking
+  python src/score.py \
+    --candidate-dir data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp} \
+    --output-dir ${output_dir}/scores \
+    --lp ${lp} \
+    --reference-file output/reranking/${lp}/standard/64/prism/predictions.txt \
+    --device ${CUDA_VISIBLE_DEVICES} \
+    --bleu \
+    --bleurt \
+    --bertscore
 done
 
 for metric in bleu bleurt bertscore; do
@@ -98,6 +77,22 @@ for metric in bleu bleurt bertscore; do
     --output-dir output/xbleu/results/prism-src-rerank
 done
 
+# Compute the BLEU of every pair of outputs (systems, reference, and the
+# optimized outputs) to compare the possible pseudo-references
+for lp in "de-en" "en-de" "en-ru" "ru-en"; do
+  src=${lp:0:2}
+  tgt=${lp:3:5}
+  python src/xbleu/bleu_matrix.py \
+    --lp ${lp} \
+    --system-dir data/wmt19/wmt19-submitted-data-v3/txt/system-outputs/newstest2019/${lp} \
+    --reference-file data/wmt19/wmt19-submitted-data-v3/txt/references/newstest2019-${src}${tgt}-ref.${tgt} \
+    --extra \
+      prism-src=output/prism-optimization/${lp}/predictions.txt \
+      prism-src-rerank=output/reranking/${lp}/standard/64/prism/predictions.txt \
+      comet-src-rerank=output/reranking/${lp}/standard/64/comet/predictions.txt \
+    --output-file output/xbleu/matrix/${lp}.json
+done
+
 # Rename for Overleaf
 mkdir -p output/xbleu/results/overleaf
 cp output/xbleu/results/comet-src/bleu.subset.pdf output/xbleu/results/overleaf/bleu-comet.pdf
@@ -0,0 +1,212 @@
+import argparse
+import math
+import numpy as np
+import os
+import re
+import sys
+import unicodedata
+from collections import Counter
+from typing import List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import chunked_io
+
+MAX_NGRAM_ORDER = 4
+
+# The compiled regexes for the "intl" tokenizer, which are built the first
+# time they are used because enumerating the Unicode categories is slow
+_intl_regexes = None
+
+# The `CorpusStats` for files which have already been loaded, keyed by
+# (path, mtime, size)
+_stats_cache = {}
+
+
+def _property_chars(prefix: str) -> str:
+    # sacrebleu joins the characters into its character classes without
+    # escaping them, so the backslash escapes the "]" which follows it instead
+    # of being punctuation. It is excluded here to match
+    return "".join(
+        re.escape(chr(x)) for x in range(sys.maxunicode)
+        if unicodedata.category(chr(x)).startswith(prefix) and chr(x) != "\\"
+    )
+
+
+def _get_intl_regexes() -> Tuple:
+    global _intl_regexes
+    if _intl_regexes is None:
+        try:
+            # The `regex` package (a dependency of sacrebleu) supports Unicode
+            # properties directly, which avoids enumerating every character.
+            # Backslash is not punctuation for sacrebleu (see `_property_chars`).
+            # Only characters which were added in a newer version of Unicode
+            # than Python's `unicodedata` can be categorized differently
+            import regex
+            _intl_regexes = (
+                regex.compile(r"([^\d])([^\P{P}\\])"),
+                regex.compile(r"([^\P{P}\\])([^\d])"),
+                regex.compile(r"(\p{S})"),
+            )
+            return _intl_regexes
+        except ImportError:
+            pass
+
+        punctuation = _property_chars("P")
+        _intl_regexes = (
+            re.compile(r"([^\d])([" + punctuation + r"])"),
+            re.compile(r"([" + punctuation + r"])([^\d])"),
+            re.compile(r"([" + _property_chars("S") + r"])"),
+        )
+    return _intl_regexes
+
+
+def tokenize_intl(line: str) -> str:
+    """
+    The international tokenizer from sacrebleu ("-tok intl"), which is the
+    mteval-v14 tokenizer with Unicode punctuation and symbol handling.
+    """
+    nondigit_punct_re, punct_nondigit_re, symbol_re = _get_intl_regexes()
+    line = nondigit_punct_re.sub(r"\1 \2 ", line)
+    line = punct_nondigit_re.sub(r" \1 \2", line)
+    line = symbol_re.sub(r" \1 ", line)
+    return line.strip()
+
+
+def extract_ngrams(tokens: List[str], max_order: int = MAX_NGRAM_ORDER) -> Counter:
+    ngrams = Counter()
+    for n in range(1, max_order + 1):
+        # Counting from an iterator runs in C
+        ngrams.update(zip(*[tokens[k:] for k in range(n)]))
+    return ngrams
+
+
+class CorpusStats(object):
+    """
+    The token lengths and n-gram counts of every segment of a file, tokenized
+    the same way as `sacrebleu -lc -tok intl`. The same statistics can be used
+    for the file as either the candidate or the reference.
+    """
+
+    def __init__(self, lines: List[str]) -> None:
+        self.lengths = []
+        self.ngrams = []
+        for line in lines:
+            tokens = tokenize_intl(line.lower().rstrip()).split()
+            self.lengths.append(len(tokens))
+            self.ngrams.append(extract_ngrams(tokens))
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+
+def load_stats(input_file: str) -> CorpusStats:
+    """Loads the `CorpusStats` for a file, reusing them if the file was already loaded"""
+    stat = os.stat(input_file)
+    key = (os.path.abspath(input_file), stat.st_mtime, stat.st_size)
+    if key not in _stats_cache:
+        with chunked_io.open_file(input_file, "r") as f:
+            _stats_cache[key] = CorpusStats(f.read().splitlines())
+    return _stats_cache[key]
+
+
+def sentence_stats(hyp_ngrams: Counter, hyp_len: int, ref_ngrams: Counter, ref_len: int) -> List[int]:
+    """
+    Computes BLEU's sufficient statistics for one segment, which are
+    [hyp_len, ref_len, correct_1, ..., correct_4, total_1, ..., total_4]
+    """
+    correct = [0] * MAX_NGRAM_ORDER
+    for ngram, count in hyp_ngrams.items():
+        if ngram in ref_ngrams:
+            correct[len(ngram) - 1] += min(count, ref_ngrams[ngram])
+    total = [max(0, hyp_len - n) for n in range(MAX_NGRAM_ORDER)]
+    return [hyp_len, ref_len] + correct + total
+
+
+def corpus_stats(hyp: CorpusStats, ref: CorpusStats) -> List[int]:
+    assert len(hyp) == len(ref), f"Number of lines differ: {len(hyp)} vs {len(ref)}"
+    totals = [0] * (2 + 2 * MAX_NGRAM_ORDER)
+    for i in range(len(hyp)):
+        stats = sentence_stats(hyp.ngrams[i], hyp.lengths[i], ref.ngrams[i], ref.lengths[i])
+        for j, value in enumerate(stats):
+            totals[j] += value
+    return totals
+
+
+def compute_bleu(stats: List[int]) -> float:
+    """Computes BLEU from the sufficient statistics with sacrebleu's default "exp" smoothing"""
+    sys_len, ref_len = stats[0], stats[1]
+    correct = stats[2:2 + MAX_NGRAM_ORDER]
+    total = stats[2 + MAX_NGRAM_ORDER:]
+
+    precisions = [0.0] * MAX_NGRAM_ORDER
+    smooth_mteval = 1.0
+    for n in range(MAX_NGRAM_ORDER):
+        if total[n] == 0:
+            break
+        if correct[n] == 0:
+            smooth_mteval *= 2
+            precisions[n] = 100.0 / (smooth_mteval * total[n])
+        else:
+            precisions[n] = 100.0 * correct[n] / total[n]
+
+    if sys_len < ref_len:
+        bp = math.exp(1 - ref_len / sys_len) if sys_len > 0 else 0.0
+    else:
+        bp = 1.0
+
+    log_precisions = [math.log(p) if p > 0 else -9999999999 for p in precisions]
+    return bp * math.exp(sum(log_precisions) / MAX_NGRAM_ORDER)
+
+
+def compute_bleu_batch(stats: np.ndarray, use_effective_order: bool = False) -> np.ndarray:
+    """
+    Computes BLEU for every row of an array of sufficient statistics at once,
+    the same as `compute_bleu`. With `use_effective_order`, the orders which
+    the candidate has no n-grams of are ignored, the same as sacrebleu's
+    `sentence_bleu`.
+    """
+    stats = np.asarray(stats, dtype=np.float64)
+    sys_len, ref_len = stats[..., 0], stats[..., 1]
+    correct = stats[..., 2:2 + MAX_NGRAM_ORDER]
+    total = stats[..., 2 + MAX_NGRAM_ORDER:]
+
+    # Each order with no matches halves the smoothed precision again, and the
+    # orders after the first one without any n-grams are not used
+    has_total = np.cumprod(total > 0, axis=-1).astype(bool)
+    smooth = 2.0 ** np.cumsum((correct == 0) & has_total, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precisions = np.where(correct > 0, 100.0 * correct / total, 100.0 / (smooth * total))
+        log_precisions = np.where(has_total, np.log(np.where(has_total, precisions, 1.0)), -9999999999)
+
+    if use_effective_order:
+        effective_order = has_total.sum(axis=-1)
+        log_precisions = np.where(has_total, log_precisions, 0.0)
+        score = np.exp(log_precisions.sum(axis=-1) / np.maximum(effective_order, 1))
+        score = np.where(effective_order > 0, score, 0.0)
+    else:
+        score = np.exp(log_precisions.sum(axis=-1) / MAX_NGRAM_ORDER)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bp = np.where(sys_len < ref_len, np.exp(1 - ref_len / sys_len), 1.0)
+    bp = np.where((sys_len < ref_len) & (sys_len == 0), 0.0, bp)
+    return bp * score
+
+
+def corpus_bleu(hyp: CorpusStats, ref: CorpusStats, width: int = 4) -> float:
+    """Equivalent to `sacrebleu -m bleu -lc -tok intl -b -w {width}`"""
+    score = compute_bleu(corpus_stats(hyp, ref))
+    return float(f"{score:.{width}f}")
+
+
+def main(args):
+    ref = load_stats(args.reference_file)
+    for candidate_file in args.candidate_files:
+        print(f"{corpus_bleu(load_stats(candidate_file), ref)}\t{candidate_file}")
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--reference-file", required=True)
+    argp.add_argument("--candidate-files", required=True, nargs="+")
+    args = argp.parse_args()
+    main(args)
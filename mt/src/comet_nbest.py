@@ -0,0 +1,83 @@
+import batching
+import numpy as np
+import torch
+from typing import Dict, List, Tuple
+
+
+class COMETNbest(object):
+    """
+    Runs the reference-free COMET model ("comet-src") in-process with the
+    unbabel-comet library so that each unique sentence is encoded only once.
+    For n-best lists, the pooled embedding of a source is computed once and
+    reused for all of its candidates, and only the small feed-forward
+    estimator is run per (source, candidate) pair.
+    """
+
+    def __init__(
+        self,
+        device: int,
+        model_name: str = "wmt20-comet-qe-da",
+        batch_size: int = 64,
+        max_tokens: int = 8192,
+    ) -> None:
+        from comet import download_model, load_from_checkpoint
+
+        self.device = torch.device(f"cuda:{device}" if device >= 0 else "cpu")
+        self.model = load_from_checkpoint(download_model(model_name))
+        self.model.eval()
+        self.model.to(self.device)
+        self.batch_size = batch_size
+        # The budget is reduced if a batch runs out of memory
+        self.batcher = batching.AdaptiveBatcher("COMET encoder", max_tokens)
+
+    def _embed(self, sentences: List[str]) -> torch.Tensor:
+        if len(sentences) == 0:
+            # torch.stack cannot stack an empty list
+            return torch.empty((0, 0), device=self.device)
+
+        # Encode in order of length under the token budget to minimize padding
+        lengths = [len(sentence.split()) for sentence in sentences]
+        embeddings = [None] * len(sentences)
+
+        def _process_batch(indices: List[int]) -> None:
+            inputs = self.model.encoder.prepare_sample([sentences[j] for j in indices])
+            with torch.no_grad():
+                batch_embeddings = self.model.get_sentence_embedding(
+                    inputs["input_ids"].to(self.device),
+                    inputs["attention_mask"].to(self.device),
+                )
+            for j, embedding in zip(indices, batch_embeddings):
+                embeddings[j] = embedding
+
+        self.batcher.run(lengths, _process_batch, self.batch_size)
+        self.batcher.print()
+        return torch.stack(embeddings)
+
+    def predict_batch(self, inputs: List[Dict]) -> Tuple[Dict, List[Dict]]:
+        sources = [inp["sources"][0] for inp in inputs]
+        candidates = [inp["candidate"] for inp in inputs]
+
+        unique_sources = list(dict.fromkeys(sources))
+        unique_candidates = list(dict.fromkeys(candidates))
+        source_index = {source: i for i, source in enumerate(unique_sources)}
+        candidate_index = {candidate: i for i, candidate in enumerate(unique_candidates)}
+        print(f"Encoding {len(unique_sources)} sources and {len(unique_candidates)} candidates")
+
+        src_embeddings = self._embed(unique_sources)
+        mt_embeddings = self._embed(unique_candidates)
+
+        src_indices = torch.tensor([source_index[source] for source in sources], device=self.device)
+        mt_indices = torch.tensor([candidate_index[candidate] for candidate in candidates], device=self.device)
+
+        scores = []
+        for i in range(0, len(inputs), self.batch_size):
+            src = src_embeddings[src_indices[i:i + self.batch_size]]
+            mt = mt_embeddings[mt_indices[i:i + self.batch_size]]
+            # Same features as the ReferencelessRegression model's forward()
+            features = torch.cat((mt, src, mt * src, torch.abs(mt - src)), dim=1)
+            with torch.no_grad():
+                scores.extend(self.model.estimator(features).view(-1).tolist())
+
+        micro = [{"comet-src": score} for score in scores]
+        macro = {"comet-src": float(np.mean(scores))}
+        return macro, micro
@@ -2,9 +2,14 @@ import argparse
 import gzip
 import json
 import os
+import sys
 from collections import defaultdict
 from glob import glob
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+
 
 def main(args):
     # scores_dict[lp][system][metric]
@@ -12,7 +17,7 @@ def main(args):
 
     # Load the DA scores
     da_file = f"{args.wmt19_dir}/manual-evaluation/DA-syslevel.csv"
-    with open(da_file, "r") as f:
+    with chunked_io.open_file(da_file, "r") as f:
         for i, line in enumerate(f):
             if i == 0:
                 # Header
@@ -39,7 +44,7 @@ def main(args):
     # Save the data
     os.makedirs(args.output_dir)
     for lp in scores_dict.keys():
-        with open(f"{args.output_dir}/{lp}.jsonl", "w") as out:
+        with chunked_io.open_file(f"{args.output_dir}/{lp}.jsonl", "w") as out:
             for system, metrics in scores_dict[lp].items():
                 out.write(json.dumps({"system": system, "metrics": metrics}) + "\n")
 
@@ -0,0 +1,111 @@
+# The registry of metrics which `score.py` can compute. Each metric's flag
+# (e.g., `--comet-src`) is generated from the registry, and the libraries for
+# a backend model are only imported when a requested metric needs it, so runs
+# which only compute cheap metrics like BLEU do not load torch or TensorFlow.
+#
+# To add a metric, add its loader with `register_backend` (if it uses a new
+# model) and describe its inputs and output key with `register_metric`.
+from collections import OrderedDict, namedtuple
+from typing import Callable
+
+# The name of the experiment, which keeps its metric daemon separate from the
+# other experiment's (see `metric_daemon.py`)
+EXPERIMENT = "mt"
+
+# A metric which is written to the score files. `backend` is the model whose
+# `predict_batch` computes the segment scores and `key` is the key of the score
+# in its output. `corpus_score` is used instead of a backend for metrics which
+# are computed at the corpus level, and it is called with the paths to the
+# candidate and reference files. `skip` returns `True` for language pairs
+# which the metric does not support
+Metric = namedtuple(
+    "Metric",
+    ["name", "backend", "key", "sources", "references", "target_language", "skip", "corpus_score"],
+)
+
+# The loaders of the backends, which are called with (language, device)
+_BACKENDS = {}
+
+# The backends which run in this process. The others are repro models, which
+# start a new Docker container and load the model for every `predict_batch` call
+_IN_PROCESS_BACKENDS = set()
+
+METRICS = OrderedDict()
+
+
+def register_backend(name: str, load: Callable, in_process: bool = False) -> None:
+    _BACKENDS[name] = load
+    if in_process:
+        _IN_PROCESS_BACKENDS.add(name)
+
+
+def is_in_process(name: str) -> bool:
+    return name in _IN_PROCESS_BACKENDS
+
+
+def register_metric(
+    name: str,
+    backend: str = None,
+    key: str = None,
+    sources: bool = False,
+    references: bool = False,
+    target_language: bool = False,
+    skip: Callable = None,
+    corpus_score: Callable = None,
+) -> None:
+    assert (backend is None) != (corpus_score is None)
+    METRICS[name] = Metric(
+        name, backend, key or name, sources, references, target_language, skip, corpus_score
+    )
+
+
+def load_backend(name: str, language: str, device: int):
+    if name not in _BACKENDS:
+        raise Exception(f"Unknown metric: {name}")
+    return _BACKENDS[name](language, device)
+
+
+def _load_bleurt(language: str, device: int):
+    from repro.models.sellam2020 import BLEURT
+    return BLEURT(device=device)
+
+
+def _load_comet(language: str, device: int):
+    from repro.models.rei2020 import COMET
+    return COMET(device=device)
+
+
+def _load_prism(language: str, device: int):
+    from repro.models.thompson2020 import Prism
+    return Prism(device=device, language=language)
+
+
+def _load_bertscore(language: str, device: int):
+    from repro.models.zhang2020 import BERTScore
+    return BERTScore(device=device, language=language)
+
+
+def _corpus_bleu(candidate_file: str, reference_file: str) -> float:
+    import bleu
+    # The statistics are memoized, so the reference is only processed once per run
+    return bleu.corpus_bleu(bleu.load_stats(candidate_file), bleu.load_stats(reference_file))
+
+
+register_backend("bleurt", _load_bleurt)
+register_backend("comet", _load_comet)
+register_backend("prism", _load_prism)
+register_backend("bertscore", _load_bertscore)
+
+register_metric("bleu", references=True, corpus_score=_corpus_bleu)
+register_metric("bleurt", "bleurt", references=True)
+register_metric("comet", "comet", sources=True, references=True)
+register_metric("comet-src", "comet", sources=True)
+register_metric(
+    "prism", "prism", references=True, target_language=True,
+    skip=lambda lp: "gu" in lp
+)
+register_metric(
+    "prism-src", "prism", key="prism", sources=True, target_language=True,
+    skip=lambda lp: lp.endswith("gu")
+)
+register_metric("bertscore", "bertscore", references=True, target_language=True)
@@ -0,0 +1,99 @@
+# The models which score n-best lists with the reference-free metrics for
+# `reranking/score.py` and `reranking/cascade.py`. Each metric is computed
+# with either its repro model or an in-process model which shares the work
+# for the candidates of the same source (`--prism-nbest` and `--comet-nbest`).
+# The two backends are cached under different names, so both scripts take the
+# cache names from here to share their scores.
+#
+# The reranked outputs are compared with systems which were scored by the repro
+# models, so the in-process models are first checked against them on a sample
+# (see `check_parity`).
+import batching
+import metric_daemon
+import metrics
+from typing import Dict, List
+
+NBEST_METRICS = ["prism-src", "comet-src"]
+
+# The largest difference from the repro model's score which an in-process
+# model may have on the parity sample
+PARITY_TOLERANCE = 1e-3
+
+
+def get_cache_name(metric: str, args) -> str:
+    if metric == "prism-src":
+        return "prism-nbest" if args.prism_nbest else "prism"
+    if metric == "comet-src":
+        return "comet-nbest" if args.comet_nbest else "comet"
+    raise Exception(f"Unknown n-best metric: {metric}")
+
+
+def is_in_process(metric: str, args) -> bool:
+    return get_cache_name(metric, args) != metrics.METRICS[metric].backend
+
+
+def check_parity(metric: str, inputs: List[Dict], micro: List[Dict], language: str, device: int) -> None:
+    """
+    Raises an exception if the in-process scores `micro` of `inputs` differ
+    from the scores of the metric's repro model by more than `PARITY_TOLERANCE`
+    """
+    if len(inputs) == 0:
+        return
+    metric = metrics.METRICS[metric]
+    _, expected = metric_daemon.predict_batch(metric.backend, inputs, language=language, device=device)
+    difference = max(abs(e[metric.key] - a[metric.key]) for e, a in zip(expected, micro))
+    print(f"{metric.name} parity with repro on {len(inputs)} inputs: max difference {difference:.2e}")
+    if difference > PARITY_TOLERANCE:
+        raise Exception(
+            f"The in-process {metric.name} differs from repro's by {difference:.2e}. "
+            f"Score with the repro model instead"
+        )
+
+
+def check_models_parity(models: Dict, inputs: List[Dict], device: int, args) -> None:
+    """Checks every in-process model in `models` (see `load_models`) against its repro model"""
+    if len(inputs) == 0:
+        return
+    for metric, (_, language, predict_batch) in models.items():
+        if is_in_process(metric, args):
+            _, micro = predict_batch(inputs)
+            check_parity(metric, inputs, micro, language, device)
+
+
+def load_models(device: int, language: str, args, metrics: List[str] = NBEST_METRICS) -> Dict:
+    """
+    Loads the models for `metrics`. Returns a dict from the metric to its cache
+    name, language, and predict_batch function.
+    """
+    # The batch sizes for the in-process models are set by the token budget
+    kwargs = {} if args.max_tokens is None else {"max_tokens": args.max_tokens}
+
+    models = {}
+    if "prism-src" in metrics:
+        if args.prism_nbest:
+            # Encodes each source once for all of its candidates
+            from prism_nbest import PrismNbest
+            prism = PrismNbest(args.prism_model_dir, language, device, **kwargs)
+            predict_batch = prism.predict_batch
+        else:
+            from repro.models.thompson2020 import Prism
+            prism = Prism(device=device, language=language)
+            predict_batch = lambda batch: batching.batched_predict_batch(
+                "prism", batch, prism.predict_batch
+            )
+        models["prism-src"] = (get_cache_name("prism-src", args), language, predict_batch)
+
+    if "comet-src" in metrics:
+        if args.comet_nbest:
+            # Groups the candidates by source so each source is encoded once
+            from comet_nbest import COMETNbest
+            comet = COMETNbest(device, **kwargs)
+            predict_batch = comet.predict_batch
+        else:
+            from repro.models.rei2020 import COMET
+            comet = COMET(device=device)
+            predict_batch = lambda batch: batching.batched_predict_batch(
+                "comet", batch, comet.predict_batch
+            )
+        models["comet-src"] = (get_cache_name("comet-src", args), None, predict_batch)
+    return models
@@ -1,19 +1,97 @@
 import argparse
+import json
 import os
-from repro.models.thompson2020 import Prism
+import sys
+from typing import List
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import chunked_io
+import score_cache
 
-def main(args):
-    inputs = []
-    with open(args.input_file, "r") as f:
-        for line in f:
-            inputs.append({"source": line.strip()})
 
+def _group_by_batch_size(lengths: List[int], max_tokens: int, max_batch_size: int) -> List[List[int]]:
+    # repro's Prism only supports one batch size per call, and each call starts
+    # the model again, so the sentences are grouped by length into buckets which
+    # share a power-of-two batch size under the token budget
+    groups = {}
+    for batch in batching.make_batches(lengths, max_tokens, max_batch_size):
+        batch_size = 1
+        while batch_size * 2 <= len(batch):
+            batch_size *= 2
+        groups.setdefault(batch_size, []).extend(batch)
+    return [(batch_size, groups[batch_size]) for batch_size in sorted(groups)]
+
+
+def _translate(sources: List[str], args) -> List[str]:
+    from repro.models.thompson2020 import Prism
+
+    inputs = [{"source": source.strip()} for source in sources]
     model = Prism(device=args.device)
-    translations = model.translate_batch(args.language, inputs, batch_size=8)
+    lengths = [len(source.split()) for source in sources]
+    report = batching.PaddingReport("Prism translation")
+    translations = [None] * len(inputs)
+    for batch_size, indices in _group_by_batch_size(lengths, args.max_tokens, args.max_batch_size):
+        for i in range(0, len(indices), batch_size):
+            report.add([lengths[j] for j in indices[i:i + batch_size]])
+        batch_translations = model.translate_batch(
+            args.language, [inputs[j] for j in indices], batch_size=batch_size
+        )
+        for j, translation in zip(indices, batch_translations):
+            translations[j] = translation
+    report.print()
+    return translations
+
+
+def _translate_nbest(sources: List[str], args) -> List[str]:
+    # Runs Prism in-process, which returns the n-best lists and their
+    # Prism-src scores from the beam search
+    from prism_nbest import PrismNbest
+
+    model = PrismNbest(args.prism_model_dir, args.language, args.device)
+    nbest_list = model.translate([source.strip() for source in sources], args.beam_size, args.nbest)
+
+    # Same format as the output of reranking/score.py
+    if args.nbest_file is not None:
+        dirname = os.path.dirname(args.nbest_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with chunked_io.open_file(args.nbest_file, "w") as out:
+            for nbest in nbest_list:
+                out.write(json.dumps([
+                    {"prediction": candidate, "prism-src": {"prism": score}}
+                    for candidate, score in nbest
+                ]) + "\n")
+
+    # Save the scores so that scoring these outputs with Prism-src
+    # (e.g., score.py with --prism-model-dir) does not run Prism again
+    if args.cache_dir is not None:
+        cache = score_cache.ScoreCache(args.cache_dir)
+        items = []
+        for source, nbest in zip(sources, nbest_list):
+            for candidate, score in nbest:
+                inp = {"candidate": candidate, "sources": [source]}
+                key = score_cache.ScoreCache.get_key("prism-nbest", args.language, inp)
+                items.append((key, "prism-nbest", {"prism": score}))
+        cache.put_many(items)
+
+    return [nbest[0][0] for nbest in nbest_list]
+
+
+def main(args):
+    with chunked_io.open_file(args.input_file, "r") as f:
+        # The unstripped lines are used for the cache keys, the same as score.py
+        sources = f.read().splitlines()
+
+    if args.prism_model_dir is not None:
+        translations = _translate_nbest(sources, args)
+    else:
+        assert args.nbest_file is None, "The n-best lists require --prism-model-dir"
+        translations = _translate(sources, args)
 
     os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
-    with open(args.output_file, "w") as out:
+    with chunked_io.open_file(args.output_file, "w") as out:
         for translation in translations:
             out.write(translation + "\n")
 
@@ -24,5 +102,15 @@ if __name__ == "__main__":
     argp.add_argument("--language", required=True)
     argp.add_argument("--device", required=True, type=int)
     argp.add_argument("--output-file", required=True)
+    argp.add_argument("--max-tokens", type=int, default=1024)
+    argp.add_argument("--max-batch-size", type=int, default=64)
+    # Translates with the in-process Prism model, which also supports n-best
+    # lists. Its beam search is fairseq's, not repro's, so the translations
+    # may differ from the default ones
+    argp.add_argument("--prism-model-dir")
+    argp.add_argument("--beam-size", type=int, default=5)
+    argp.add_argument("--nbest", type=int)
+    argp.add_argument("--nbest-file")
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
     args = argp.parse_args()
     main(args)
@@ -0,0 +1,196 @@
+import batching
+import numpy as np
+import os
+import torch
+from typing import Dict, List, Tuple
+
+
+class PrismNbest(object):
+    """
+    Runs the Prism model (Thompson & Post, 2020) in-process with fairseq to
+    compute Prism-src, the average token log-probability of a candidate given
+    the source, for n-best lists. Each source is run through the encoder once
+    and the cached encoder states are shared by all of its candidates, which
+    are scored together in one teacher-forced decoder pass.
+
+    `model_dir` is the directory of the released m39v1 model, which contains
+    "checkpoint.pt", the dictionaries, and "spm.model".
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        language: str,
+        device: int,
+        max_tokens: int = 4000,
+    ) -> None:
+        import sentencepiece as spm
+        from fairseq import checkpoint_utils
+
+        self.device = torch.device(f"cuda:{device}" if device >= 0 else "cpu")
+        models, _, self.task = checkpoint_utils.load_model_ensemble_and_task(
+            [os.path.join(model_dir, "checkpoint.pt")],
+            arg_overrides={"data": model_dir + "/"},
+        )
+        self.model = models[0]
+        self.model.eval()
+        self.model.to(self.device)
+
+        self.sp = spm.SentencePieceProcessor()
+        self.sp.Load(os.path.join(model_dir, "spm.model"))
+        self.language = language
+        self.max_tokens = max_tokens
+        # The scoring budget is reduced if a batch runs out of memory, and it
+        # is kept across calls
+        self.batcher = batching.AdaptiveBatcher("Prism scoring", max_tokens)
+
+        self.dictionary = self.task.target_dictionary
+        self.pad = self.dictionary.pad()
+        self.eos = self.dictionary.eos()
+
+    def encode(self, sentence: str, prepend_language: bool) -> torch.LongTensor:
+        pieces = " ".join(self.sp.EncodeAsPieces(sentence))
+        if prepend_language:
+            # The target language is specified by a tag at the start of the output
+            pieces = f"<{self.language}> " + pieces
+        return self.task.source_dictionary.encode_line(pieces, add_if_not_exist=False).long()
+
+    def decode(self, tokens: torch.LongTensor) -> str:
+        # Remove the language tag and end-of-sentence token
+        pieces = self.dictionary.string(tokens[1:])
+        return self.sp.DecodePieces(pieces.split())
+
+    def forward_encoder(self, sources: List[torch.LongTensor]):
+        from fairseq.data import data_utils
+
+        src_tokens = data_utils.collate_tokens(sources, self.pad, self.eos, left_pad=True)
+        src_lengths = torch.LongTensor([source.numel() for source in sources])
+        with torch.no_grad():
+            return self.model.encoder(
+                src_tokens.to(self.device), src_lengths=src_lengths.to(self.device)
+            )
+
+    def score_targets(
+        self, encoder_out, source_indices: List[int], targets: List[torch.LongTensor]
+    ) -> List[float]:
+        """
+        Scores each target against the already-encoded source at the same
+        position in `source_indices` and returns the average token
+        log-probabilities, excluding the language tag.
+        """
+        from fairseq.data import data_utils
+
+        new_order = torch.LongTensor(source_indices).to(self.device)
+        encoder_out = self.model.encoder.reorder_encoder_out(encoder_out, new_order)
+
+        target = data_utils.collate_tokens(targets, self.pad, self.eos, left_pad=False)
+        prev_output_tokens = data_utils.collate_tokens(
+            targets, self.pad, self.eos, left_pad=False, move_eos_to_beginning=True
+        )
+        target = target.to(self.device)
+        with torch.no_grad():
+            net_output = self.model.decoder(
+                prev_output_tokens.to(self.device), encoder_out=encoder_out
+            )
+            lprobs = self.model.get_normalized_probs(net_output, log_probs=True)
+            positional_scores = lprobs.gather(dim=2, index=target.unsqueeze(-1)).squeeze(-1)
+
+        scores = []
+        for i, length in enumerate(target.ne(self.pad).sum(dim=1).tolist()):
+            scores.append(positional_scores[i, 1:length].mean().item())
+        return scores
+
+    def translate(
+        self, sources: List[str], beam_size: int, nbest: int = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Translates the sources into `self.language` with beam search and
+        returns the `nbest` (candidate, Prism-src) pairs for each source. The
+        score is the average token log-probability excluding the language tag,
+        which is the same as scoring the candidate with `predict_batch`, but it
+        comes for free from the search.
+        """
+        from fairseq.data import data_utils
+        from fairseq.sequence_generator import SequenceGenerator
+
+        nbest = nbest or beam_size
+        assert nbest <= beam_size
+        generator = SequenceGenerator([self.model], self.dictionary, beam_size=beam_size)
+        language_tag = self.dictionary.index(f"<{self.language}>")
+
+        sources_bin = [self.encode(source, prepend_language=False) for source in sources]
+        lengths = [source_bin.numel() for source_bin in sources_bin]
+        # Every source is expanded into `beam_size` hypotheses, and the
+        # budget is reduced if a batch runs out of memory
+        batcher = batching.AdaptiveBatcher("Prism translation", max(self.max_tokens // beam_size, 1))
+
+        nbest_list = [None] * len(sources)
+
+        def _process_batch(batch: List[int]) -> None:
+            src_tokens = data_utils.collate_tokens(
+                [sources_bin[i] for i in batch], self.pad, self.eos, left_pad=True
+            )
+            sample = {
+                "net_input": {
+                    "src_tokens": src_tokens.to(self.device),
+                    "src_lengths": torch.LongTensor([lengths[i] for i in batch]).to(self.device),
+                },
+            }
+            # The target language is specified by forcing the tag as the first token
+            prefix_tokens = torch.full((len(batch), 1), language_tag, dtype=torch.long).to(self.device)
+            with torch.no_grad():
+                hypos_list = generator.generate([self.model], sample, prefix_tokens=prefix_tokens)
+
+            for i, hypos in zip(batch, hypos_list):
+                nbest_list[i] = [
+                    (self.decode(hypo["tokens"]), hypo["positional_scores"][1:].mean().item())
+                    for hypo in hypos[:nbest]
+                ]
+
+        batcher.run(lengths, _process_batch)
+        batcher.print()
+        return nbest_list
+
+    def predict_batch(self, inputs: List[Dict]) -> Tuple[Dict, List[Dict]]:
+        # Group the unique candidates by source
+        groups = {}
+        for inp in inputs:
+            candidates = groups.setdefault(inp["sources"][0], {})
+            candidates[inp["candidate"]] = None
+        groups = [(source, list(candidates.keys())) for source, candidates in groups.items()]
+        print(f"Scoring {sum(len(c) for _, c in groups)} candidates for {len(groups)} sources")
+
+        # Each source is batched with all of its candidates, and its length is
+        # the number of candidate tokens, so the budget bounds the decoder's
+        # output (tokens x vocabulary). The number of subword tokens is roughly
+        # twice the number of words
+        lengths = [sum(len(candidate.split()) * 2 for candidate in candidates) for _, candidates in groups]
+
+        scores_dict = {}
+        report = batching.PaddingReport("Prism decoder")
+
+        def _process_batch(batch: List[int]) -> None:
+            sources = [self.encode(groups[i][0], prepend_language=False) for i in batch]
+            encoder_out = self.forward_encoder(sources)
+
+            source_indices, targets, keys = [], [], []
+            for j, i in enumerate(batch):
+                source, candidates = groups[i]
+                for candidate in candidates:
+                    source_indices.append(j)
+                    targets.append(self.encode(candidate, prepend_language=True))
+                    keys.append((source, candidate))
+
+            for key, score in zip(keys, self.score_targets(encoder_out, source_indices, targets)):
+                scores_dict[key] = score
+            # Only the batches which fit are counted
+            report.add([target.numel() for target in targets])
+
+        self.batcher.run(lengths, _process_batch)
+        self.batcher.print()
+        report.print()
+
+        scores = [scores_dict[(inp["sources"][0], inp["candidate"])] for inp in inputs]
+        micro = [{"prism": score} for score in scores]
+        macro = {"prism": float(np.mean(scores))}
+        return macro, micro
@@ -3,10 +3,14 @@ import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import sys
 from collections import defaultdict
 from matplotlib.lines import Line2D
 from typing import Dict, List
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+
 LPS = ["de-en", "en-de", "en-ru", "ru-en"]
 NAMES = {
     "bleu": "BLEU",
@@ -17,6 +21,9 @@ NAMES = {
     "comet-src": "COMET-src"
 }
 
+# The selections of oracle.py, which use the references
+ORACLES = ["oracle-bleu", "oracle-chrf", "oracle-corpus-bleu"]
+
 
 def _load_metrics(
     input_dir: str,
@@ -26,9 +33,8 @@ def _load_metrics(
     metrics = defaultdict(list)
 
     for size in beam_sizes:
-        metrics_dict = json.load(
-            open(f"{input_dir}/{size}/{reranking_metric}/scores.json", "r")
-        )
+        with chunked_io.open_file(f"{input_dir}/{size}/{reranking_metric}/scores.json", "r") as f:
+            metrics_dict = json.load(f)
         for metric, value in metrics_dict["metrics"].items():
             metrics[metric].append(value)
 
@@ -168,10 +174,48 @@ def _run_plot_pairwise(
                 plt.close()
 
 
+def _write_oracle_table(
+    input_dir: str,
+    method: str,
+    reranking_metrics: List[str],
+    lps: List[str],
+    beam_sizes: List[int],
+    output_file: str,
+) -> None:
+    # Puts the BLEU gains of reranking in context by how much of the gain of
+    # each oracle they reach: (reranked - standard) / (oracle - standard)
+    rerankers = [metric for metric in reranking_metrics if metric not in ORACLES]
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w") as out:
+        header = ["lp", "beam_size"] + reranking_metrics
+        for oracle in ORACLES:
+            header += [f"{reranker}/{oracle}" for reranker in rerankers if reranker != "standard"]
+        out.write("\t".join(header) + "\n")
+
+        for lp in lps:
+            bleu = {
+                metric: _load_metrics(f"{input_dir}/{lp}/{method}", beam_sizes, metric)["bleu"]
+                for metric in reranking_metrics
+            }
+            for i, size in enumerate(beam_sizes):
+                row = [lp, str(size)] + [f"{bleu[metric][i]:.2f}" for metric in reranking_metrics]
+                standard = bleu["standard"][i]
+                for oracle in ORACLES:
+                    for reranker in rerankers:
+                        if reranker == "standard":
+                            continue
+                        gain = bleu[oracle][i] - standard
+                        ratio = (bleu[reranker][i] - standard) / gain if gain != 0 else 0.0
+                        row.append(f"{ratio * 100:.1f}%")
+                out.write("\t".join(row) + "\n")
+
+
 def main(args):
     lps = ["de-en", "en-de", "ru-en", "en-ru"]
     beam_sizes = [1, 2, 4, 8, 16, 32, 64]
     reranking_metrics = ["standard", "prism", "comet"]
+    if args.oracle:
+        reranking_metrics += ORACLES
     ref_based_metrics = ["bleu", "bleurt", "prism", "comet"]
     ref_free_metrics = ["prism-src", "comet-src"]
 
@@ -196,7 +240,15 @@ def main(args):
         args.output_dir,
     )
 
-
+    if args.oracle:
+        _write_oracle_table(
+            args.input_dir,
+            args.method,
+            reranking_metrics,
+            lps,
+            beam_sizes,
+            f"{args.output_dir}/oracle.tsv",
+        )
 
 
 if __name__ == "__main__":
@@ -204,5 +256,7 @@ if __name__ == "__main__":
     argp.add_argument("--input-dir", required=True)
     argp.add_argument("--output-dir", required=True)
     argp.add_argument("--method", required=True)
+    # Also plot the oracle selections and compare the reranking gains to them
+    argp.add_argument("--oracle", action="store_true")
     args = argp.parse_args()
     main(args)
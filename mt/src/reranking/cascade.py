@@ -0,0 +1,180 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+import metrics
+import nbest_models
+import nbest_store
+import score_cache
+
+# The n-best lists are in order of the model's score, so the "model" stage
+# keeps the first k translations without running a metric
+MODEL_STAGE = "model"
+
+
+def _parse_stages(specs: List[str]) -> List[Tuple[str, int]]:
+    # Each stage is "name:k", which keeps the k best translations by that metric
+    stages = []
+    for spec in specs:
+        name, k = spec.split(":")
+        if name != MODEL_STAGE and name not in nbest_models.NBEST_METRICS:
+            raise Exception(f"Reranking requires a reference-free metric: {name}")
+        stages.append((name, int(k)))
+    assert stages[-1][0] != MODEL_STAGE, "The last stage must be a metric"
+    return stages
+
+
+def _load_instances(input_file: str, pred_file: str) -> List[Dict]:
+    if nbest_store.is_store(pred_file):
+        nbest_lists = list(nbest_store.NbestStore(pred_file).iter_nbest_lists())
+    else:
+        with chunked_io.open_file(pred_file, "r") as f:
+            nbest_lists = [[pred["prediction"] for pred in json.loads(line)] for line in f]
+
+    instances = []
+    with chunked_io.open_file(input_file, "r") as f:
+        for line, nbest in zip(f, nbest_lists):
+            instances.append({"source": line.strip(), "predictions": nbest})
+    return instances
+
+
+def _score(
+    name: str,
+    instances: List[Dict],
+    candidates_list: List[List[int]],
+    models: Dict,
+    cache: score_cache.ScoreCache,
+) -> List[List[float]]:
+    # Scores the candidates (the indices of the translations) of each instance
+    metric = metrics.METRICS[name]
+    inputs = []
+    for instance, candidates in zip(instances, candidates_list):
+        for j in candidates:
+            inputs.append({"sources": [instance["source"]], "candidate": instance["predictions"][j]})
+
+    # The same models and cache names as reranking/score.py so scores are
+    # shared between them
+    cache_name, language, predict_batch = models[name]
+    micro = score_cache.cached_predict_batch(cache, cache_name, language, inputs, predict_batch)
+
+    scores_list = []
+    index = 0
+    for candidates in candidates_list:
+        scores_list.append([micro[index + i][metric.key] for i in range(len(candidates))])
+        index += len(candidates)
+    return scores_list
+
+
+def _select(candidates: List[int], scores: List[float], k: int) -> List[int]:
+    # Keeps the k best candidates. The sort is stable, so ties are broken by
+    # the model's order
+    order = sorted(range(len(candidates)), key=lambda i: scores[i], reverse=True)
+    return [candidates[i] for i in order[:k]]
+
+
+def main(args):
+    stages = _parse_stages(args.cascade)
+    cache = None
+    if args.cache_dir is not None:
+        cache = score_cache.ScoreCache(args.cache_dir)
+
+    models = nbest_models.load_models(
+        args.device, args.language, args, [name for name, _ in stages if name != MODEL_STAGE]
+    )
+
+    instances = _load_instances(args.input_file, args.pred_file)
+    # The model's best translation of the first sources
+    parity_inputs = [
+        {"sources": [instance["source"]], "candidate": instance["predictions"][0]}
+        for instance in instances[:args.parity_samples] if len(instance["predictions"]) > 0
+    ]
+    nbest_models.check_models_parity(models, parity_inputs, args.device, args)
+    num_translations = sum(len(instance["predictions"]) for instance in instances)
+
+    # Each stage only scores the translations which the previous stages kept
+    candidates_list = [list(range(len(instance["predictions"]))) for instance in instances]
+    report = {"num_instances": len(instances), "num_translations": num_translations, "stages": []}
+    for name, k in stages:
+        num_scored = 0
+        if name == MODEL_STAGE:
+            candidates_list = [candidates[:k] for candidates in candidates_list]
+        else:
+            scores_list = _score(name, instances, candidates_list, models, cache)
+            num_scored = sum(len(candidates) for candidates in candidates_list)
+            candidates_list = [
+                _select(candidates, scores, k)
+                for candidates, scores in zip(candidates_list, scores_list)
+            ]
+        report["stages"].append({"name": name, "k": k, "num_scored": num_scored})
+        print(f"{name}:{k}: scored {num_scored} / {num_translations} translations")
+    choices = [candidates[0] for candidates in candidates_list]
+
+    dirname = os.path.dirname(args.output_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(args.output_file, "w") as out:
+        for instance, choice in zip(instances, choices):
+            out.write(instance["predictions"][choice] + "\n")
+
+    # Compare to reranking every translation with the last stage's metric. With
+    # --cache-dir, the cascade's scores are reused, so only the translations
+    # which the cascade pruned are scored again
+    if args.exhaustive:
+        name = stages[-1][0]
+        all_candidates_list = [list(range(len(instance["predictions"]))) for instance in instances]
+        scores_list = _score(name, instances, all_candidates_list, models, cache)
+        exhaustive_choices = [int(np.argmax(scores)) for scores in scores_list]
+        # An n-best list can have the same translation more than once, so the
+        # translations are compared instead of their indices
+        matches = [
+            instance["predictions"][choice] == instance["predictions"][exhaustive]
+            for instance, choice, exhaustive in zip(instances, choices, exhaustive_choices)
+        ]
+        report["match_rate"] = float(np.mean(matches))
+        report["cascade_score"] = float(np.mean([
+            scores[choice] for scores, choice in zip(scores_list, choices)
+        ]))
+        report["exhaustive_score"] = float(np.mean([
+            scores[choice] for scores, choice in zip(scores_list, exhaustive_choices)
+        ]))
+        print(
+            f"The cascade matched exhaustive {name} reranking on {report['match_rate'] * 100:.1f}% of sources "
+            f"({name}: {report['cascade_score']:.4f} vs. {report['exhaustive_score']:.4f})"
+        )
+
+    if args.report_file is not None:
+        with open(args.report_file, "w") as out:
+            out.write(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--input-file", required=True)
+    argp.add_argument("--pred-file", required=True)
+    # The stages as "name:k", where the name is "model" or a reference-free
+    # metric, e.g., "model:16 prism-src:4 comet-src:1"
+    argp.add_argument("--cascade", required=True, nargs="+")
+    argp.add_argument("--language", required=True)
+    argp.add_argument("--device", required=True, type=int)
+    argp.add_argument("--output-file", required=True)
+    argp.add_argument("--report-file")
+    # Also rerank every translation with the last stage's metric to measure how
+    # often the cascade picks the same translation
+    argp.add_argument("--exhaustive", action="store_true")
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--max-tokens", type=int)
+    # The same backends as reranking/score.py, whose cached scores are reused
+    argp.add_argument("--comet-nbest", action="store_true")
+    argp.add_argument("--prism-nbest", action="store_true")
+    argp.add_argument("--prism-model-dir")
+    # The number of sources whose best translation is scored by both the
+    # in-process and the repro model before the in-process model is used
+    argp.add_argument("--parity-samples", type=int, default=100)
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,24 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import nbest_store
+
+
+def main(args):
+    # The direction is determined by whether the input is already a store
+    if nbest_store.is_store(args.input):
+        nbest_store.to_jsonl(args.input, args.output)
+    else:
+        nbest_store.from_jsonl(args.input, args.output)
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    # An n-best JSONL file (predictions or scores) or an n-best store directory
+    argp.add_argument("--input", required=True)
+    argp.add_argument("--output", required=True)
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,156 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+from typing import Callable, Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import bleu
+import chunked_io
+import mbr_utilities
+import metric_daemon
+import metrics
+import nbest_store
+import score_cache
+
+NGRAM_UTILITIES = ["bleu", "chrf"]
+NEURAL_UTILITIES = ["bertscore", "bleurt"]
+
+
+def _load_nbest_lists(pred_file: str) -> List[List[str]]:
+    if nbest_store.is_store(pred_file):
+        return list(nbest_store.NbestStore(pred_file).iter_nbest_lists())
+    with chunked_io.open_file(pred_file, "r") as f:
+        return [[pred["prediction"] for pred in json.loads(line)] for line in f]
+
+
+def _ngram_utilities(nbest: List[str], utility: str) -> np.ndarray:
+    if utility == "bleu":
+        # Tokenized the same way as the corpus BLEU scores (see bleu.py)
+        return mbr_utilities.pairwise_bleu([bleu.tokenize_intl(text.lower().rstrip()).split() for text in nbest])
+    return mbr_utilities.pairwise_chrf(nbest)
+
+
+def _get_predict_batch(utility: str, args) -> Callable:
+    if utility == "bertscore" and args.embedding_cache_dir is not None:
+        # Each hypothesis is encoded once as a candidate and once as a reference
+        from bertscore_cache import CachedBERTScore
+        kwargs = {} if args.max_tokens is None else {"max_tokens": args.max_tokens}
+        model = CachedBERTScore(args.embedding_cache_dir, args.language, args.device, **kwargs)
+        return model.predict_batch
+    language = args.language if metrics.METRICS[utility].target_language else None
+    # The other utilities are repro models, which are passed all of the pairs
+    # in one call in order of length
+    return lambda batch: batching.batched_predict_batch(
+        utility, batch,
+        lambda inputs: metric_daemon.predict_batch(utility, inputs, language, args.device),
+    )
+
+
+def _neural_utilities(
+    nbest_lists: List[List[str]],
+    utility: str,
+    predict_batch: Callable,
+    cache: score_cache.ScoreCache,
+    args,
+) -> List[np.ndarray]:
+    # Every pair of hypotheses in the n-best lists is scored in one call so the
+    # metric can batch them. Repeated pairs (from duplicate hypotheses) are
+    # scored once, and BERTScore's F1 is symmetric, so it only needs one
+    # direction of each pair
+    metric = metrics.METRICS[utility]
+    symmetric = utility == "bertscore"
+    pair_to_index = {}
+    inputs = []
+    for nbest in nbest_lists:
+        for i, candidate in enumerate(nbest):
+            for j, reference in enumerate(nbest):
+                pair = (candidate, reference)
+                if symmetric:
+                    pair = tuple(sorted(pair))
+                if i != j and pair not in pair_to_index:
+                    pair_to_index[pair] = len(inputs)
+                    inputs.append({"candidate": pair[0], "references": [pair[1]]})
+
+    name = "bertscore-cached" if utility == "bertscore" and args.embedding_cache_dir is not None else metric.backend
+    language = args.language if metric.target_language else None
+    micro = score_cache.cached_predict_batch(cache, name, language, inputs, predict_batch)
+
+    utilities_list = []
+    for nbest in nbest_lists:
+        utilities = np.zeros((len(nbest), len(nbest)))
+        for i, candidate in enumerate(nbest):
+            for j, reference in enumerate(nbest):
+                if i == j:
+                    continue
+                pair = (candidate, reference)
+                if symmetric:
+                    pair = tuple(sorted(pair))
+                value = micro[pair_to_index[pair]][metric.key]
+                utilities[i, j] = value["f1"] if isinstance(value, dict) else value
+        utilities_list.append(utilities)
+    return utilities_list
+
+
+def main(args):
+    # Checked before any of the n-best lists are scored
+    if args.utility in NEURAL_UTILITIES and metrics.METRICS[args.utility].target_language and args.language is None:
+        raise Exception(f"The {args.utility} utility requires --language")
+    nbest_lists = _load_nbest_lists(args.pred_file)
+
+    utilities_list = []
+    if args.utility in NGRAM_UTILITIES:
+        for nbest in nbest_lists:
+            utilities_list.append(_ngram_utilities(nbest, args.utility))
+    else:
+        cache = None
+        if args.cache_dir is not None:
+            cache = score_cache.ScoreCache(args.cache_dir)
+        predict_batch = _get_predict_batch(args.utility, args)
+        for i in range(0, len(nbest_lists), args.chunk_size):
+            utilities_list.extend(_neural_utilities(
+                nbest_lists[i:i + args.chunk_size], args.utility, predict_batch, cache, args
+            ))
+
+    selected = []
+    before = []
+    after = []
+    for utilities in utilities_list:
+        expected = mbr_utilities.expected_utility(utilities)
+        index = int(np.argmax(expected))
+        selected.append(index)
+        before.append(expected[0])
+        after.append(expected[index])
+
+    dirname = os.path.dirname(args.output_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(args.output_file, "w") as out:
+        for nbest, index in zip(nbest_lists, selected):
+            out.write(nbest[index] + "\n")
+
+    num_changed = sum(index != 0 for index in selected)
+    print(f"MBR with {args.utility} changed {num_changed} / {len(selected)} selections")
+    print(f"Expected {args.utility}: {np.mean(before):.4f} -> {np.mean(after):.4f}")
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--pred-file", required=True)
+    argp.add_argument("--utility", required=True, choices=NGRAM_UTILITIES + NEURAL_UTILITIES)
+    argp.add_argument("--output-file", required=True)
+    # The target language and device are only used by the neural utilities,
+    # and the language is required by the ones which depend on it (bertscore)
+    argp.add_argument("--language")
+    argp.add_argument("--device", type=int, default=0)
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--embedding-cache-dir", default=os.environ.get("EMBEDDING_CACHE_DIR"))
+    # The token budget of the cached BERTScore
+    argp.add_argument("--max-tokens", type=int)
+    # The number of n-best lists whose pairs are scored in one call
+    argp.add_argument("--chunk-size", type=int, default=100)
+    args = argp.parse_args()
+    main(args)
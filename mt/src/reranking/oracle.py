@@ -0,0 +1,133 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+from typing import List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import bleu
+import chunked_io
+import mbr_utilities
+import nbest_store
+
+
+def _load_nbest_lists(pred_file: str) -> List[List[str]]:
+    if nbest_store.is_store(pred_file):
+        return list(nbest_store.NbestStore(pred_file).iter_nbest_lists())
+    with chunked_io.open_file(pred_file, "r") as f:
+        return [[pred["prediction"] for pred in json.loads(line)] for line in f]
+
+
+def _get_stats(nbest_lists: List[List[str]], references: List[str]) -> List[np.ndarray]:
+    """
+    Computes BLEU's sufficient statistics of every hypothesis against its
+    reference. Each hypothesis is tokenized and counted once, and the
+    statistics are all that is needed to compute sentence or corpus BLEU
+    for any selection of hypotheses.
+    """
+    assert len(nbest_lists) == len(references), f"Number of lines differ: {len(nbest_lists)} vs {len(references)}"
+    stats_list = []
+    for nbest, reference in zip(nbest_lists, references):
+        ref = bleu.CorpusStats([reference])
+        hyps = bleu.CorpusStats(nbest)
+        stats_list.append(np.array([
+            bleu.sentence_stats(hyps.ngrams[i], hyps.lengths[i], ref.ngrams[0], ref.lengths[0])
+            for i in range(len(nbest))
+        ], dtype=np.int64))
+    return stats_list
+
+
+def sentence_bleu_oracle(stats_list: List[np.ndarray]) -> List[int]:
+    """Selects the hypothesis with the highest sentence BLEU in each n-best list"""
+    return [
+        int(np.argmax(bleu.compute_bleu_batch(stats, use_effective_order=True)))
+        for stats in stats_list
+    ]
+
+
+def sentence_chrf_oracle(nbest_lists: List[List[str]], references: List[str]) -> List[int]:
+    """Selects the hypothesis with the highest sentence chrF in each n-best list"""
+    selected = []
+    for nbest, reference in zip(nbest_lists, references):
+        selected.append(int(np.argmax(mbr_utilities.sentence_chrf(nbest, reference))))
+    return selected
+
+
+def corpus_bleu_oracle(stats_list: List[np.ndarray], selected: List[int], max_passes: int) -> List[int]:
+    """
+    Greedily changes the selected hypotheses to maximize corpus BLEU. Corpus
+    BLEU only depends on the sums of the sufficient statistics, so the
+    effect of swapping one segment's hypothesis is computed in O(1) by
+    updating the totals, and every alternative for a segment is scored at
+    once. Each pass visits every segment, and the search stops when a pass
+    does not change any selection.
+    """
+    selected = list(selected)
+    totals = sum(stats[index] for stats, index in zip(stats_list, selected))
+    for iteration in range(max_passes):
+        num_swaps = 0
+        for i, stats in enumerate(stats_list):
+            if len(stats) == 1:
+                continue
+            candidates = totals - stats[selected[i]] + stats
+            scores = bleu.compute_bleu_batch(candidates)
+            best = int(np.argmax(scores))
+            if scores[best] > scores[selected[i]]:
+                totals = candidates[best]
+                selected[i] = best
+                num_swaps += 1
+        print(f"Pass {iteration + 1}: {num_swaps} swaps, corpus BLEU {bleu.compute_bleu(totals.tolist()):.2f}")
+        if num_swaps == 0:
+            break
+    return selected
+
+
+def _write(output_file: str, nbest_lists: List[List[str]], selected: List[int]) -> None:
+    dirname = os.path.dirname(output_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(output_file, "w") as out:
+        for nbest, index in zip(nbest_lists, selected):
+            out.write(nbest[index] + "\n")
+
+
+def _corpus_bleu(stats_list: List[np.ndarray], selected: List[int]) -> float:
+    return bleu.compute_bleu(sum(stats[index] for stats, index in zip(stats_list, selected)).tolist())
+
+
+def main(args):
+    nbest_lists = _load_nbest_lists(args.pred_file)
+    with chunked_io.open_file(args.reference_file, "r") as f:
+        references = f.read().splitlines()
+    stats_list = _get_stats(nbest_lists, references)
+    print(f"Standard: corpus BLEU {_corpus_bleu(stats_list, [0] * len(stats_list)):.2f}")
+
+    sentence_selected = sentence_bleu_oracle(stats_list)
+    print(f"Sentence BLEU oracle: corpus BLEU {_corpus_bleu(stats_list, sentence_selected):.2f}")
+    if args.sentence_bleu_file is not None:
+        _write(args.sentence_bleu_file, nbest_lists, sentence_selected)
+
+    if args.sentence_chrf_file is not None:
+        selected = sentence_chrf_oracle(nbest_lists, references)
+        print(f"Sentence chrF oracle: corpus BLEU {_corpus_bleu(stats_list, selected):.2f}")
+        _write(args.sentence_chrf_file, nbest_lists, selected)
+
+    if args.corpus_bleu_file is not None:
+        # The search starts from the sentence-level oracle
+        selected = corpus_bleu_oracle(stats_list, sentence_selected, args.max_passes)
+        print(f"Corpus BLEU oracle: corpus BLEU {_corpus_bleu(stats_list, selected):.2f}")
+        _write(args.corpus_bleu_file, nbest_lists, selected)
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--pred-file", required=True)
+    argp.add_argument("--reference-file", required=True)
+    argp.add_argument("--sentence-bleu-file")
+    argp.add_argument("--sentence-chrf-file")
+    argp.add_argument("--corpus-bleu-file")
+    argp.add_argument("--max-passes", type=int, default=10)
+    args = argp.parse_args()
+    main(args)
@@ -1,74 +1,338 @@
 import argparse
-import math
 import json
-from joblib import Parallel, delayed
-from repro.models.thompson2020 import Prism
-from repro.models.rei2020 import COMET
-from typing import List
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import traceback
+from typing import Dict, List, Set, Tuple
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import checkpoint
+import chunked_io
+import nbest_models
+import score_cache
 
-def _score(instances: List, device: int, language: str) -> List:
-    print(f"Scoring {len(instances)} instances on device {device}")
+# The approximate number of bytes of n-best lists in each unit of work when
+# only the in-process models are used
+DEFAULT_UNIT_BYTES = 1000000
 
-    # Convert into inputs for the metrics
+
+def _score(sources: List[str], preds_lists: List[List[List[Dict]]], models: Dict, cache) -> None:
+    """
+    Scores the n-best lists of every beam size for the same sources.
+    `preds_lists[j][i]` is the n-best list for `sources[i]` in the j-th
+    prediction file. The larger beams mostly repeat the hypotheses of the
+    smaller ones, and the n-best lists can contain duplicate strings, so each
+    unique (source, hypothesis) pair is only scored once.
+    """
+    # Convert the unique pairs into inputs for the metrics
+    pair_to_index = {}
     inputs = []
-    for instance in instances:
-        source = instance["source"]
-        for prediction in instance["predictions"]:
-            inputs.append({"sources": [source], "candidate": prediction["prediction"]})
+    num_hypotheses = 0
+    for preds_list in preds_lists:
+        for source, predictions in zip(sources, preds_list):
+            for prediction in predictions:
+                num_hypotheses += 1
+                pair = (source, prediction["prediction"])
+                if pair not in pair_to_index:
+                    pair_to_index[pair] = len(inputs)
+                    inputs.append({"sources": [source], "candidate": prediction["prediction"]})
+    print(f"Scoring {len(inputs)} unique hypotheses out of {num_hypotheses}")
 
     # Score with the metrics
-    prism = Prism(device=device, language=language)
-    _, prism_scores = prism.predict_batch(inputs)
-
-    comet = COMET(device=device)
-    _, comet_scores = comet.predict_batch(inputs)
+    scores = {}
+    for key, (name, language, predict_batch) in models.items():
+        scores[key] = score_cache.cached_predict_batch(cache, name, language, inputs, predict_batch)
 
     # Put the results into the prediction dicts
-    index = 0
-    for instance in instances:
-        for prediction in instance["predictions"]:
-            prediction["prism-src"] = prism_scores[index]
-            prediction["comet-src"] = comet_scores[index]
-            index += 1
+    for preds_list in preds_lists:
+        for source, predictions in zip(sources, preds_list):
+            for prediction in predictions:
+                index = pair_to_index[(source, prediction["prediction"])]
+                for key in models:
+                    prediction[key] = scores[key][index]
+
+
+def _make_units(
+    inp_index: Tuple[List[int], List[int]],
+    pred_indices: List[Tuple[List[int], List[int]]],
+    max_unit_bytes: int,
+) -> List[Tuple[Tuple[int, int], List[Tuple[int, int]]]]:
+    # Splits the lines into ranges of consecutive lines with about the same
+    # number of bytes of predictions, so every unit takes about as long to score.
+    # Each unit is the (start, end) range of its lines in the input file and in
+    # every prediction file (byte offsets, or line numbers for compressed files;
+    # see `chunked_io.index_lines`), so the workers read their own lines and the
+    # parent never parses the n-best lists
+    inp_positions, _ = inp_index
+    num_lines = min(len(positions) for positions, _ in [inp_index] + pred_indices) - 1
+    units = []
+    start = 0
+    for i in range(num_lines):
+        num_bytes = sum(offsets[i + 1] - offsets[start] for _, offsets in pred_indices)
+        if num_bytes >= max_unit_bytes or i + 1 == num_lines:
+            units.append((
+                (inp_positions[start], inp_positions[i + 1]),
+                [(positions[start], positions[i + 1]) for positions, _ in pred_indices],
+            ))
+            start = i + 1
+    return units
+
+
+def _get_max_unit_bytes(pred_indices: List[Tuple[List[int], List[int]]], args) -> int:
+    if args.max_unit_bytes is not None:
+        return args.max_unit_bytes
+    if args.prism_nbest and args.comet_nbest:
+        # The in-process models are loaded once per worker, so small units
+        # only cost the scheduling and lose little work on a restart
+        return DEFAULT_UNIT_BYTES
+    # The repro models start a Docker container and load the model on every
+    # call, so each worker gets one unit with its share of the n-best lists.
+    # A restart then scores the unfinished units from the start again
+    total_bytes = sum(offsets[-1] for _, offsets in pred_indices)
+    return max(-(-total_bytes // len(args.devices)), 1)
+
+
+def _get_shard_file(shard_dir: str, index: int, file_index: int) -> str:
+    return os.path.join(shard_dir, f"{index:06d}.{file_index}.jsonl")
+
+
+def _get_done_file(shard_dir: str, index: int) -> str:
+    # Marks that all of a unit's shards have been completely written
+    return os.path.join(shard_dir, f"{index:06d}.done")
+
+
+def _score_unit(
+    index: int,
+    unit: Tuple,
+    models: Dict,
+    cache,
+    shard_dir: str,
+    inp_reader: chunked_io.LineReader,
+    pred_readers: List[chunked_io.LineReader],
+) -> None:
+    # Reads, scores, and writes one unit with one shard per prediction file.
+    # Nothing but the unit's index is sent back to the parent
+    inp_range, pred_ranges = unit
+    sources = [source.strip() for source in inp_reader.read(*inp_range)]
+    preds_lists = [
+        [json.loads(pred) for pred in pred_reader.read(*pred_range)]
+        for pred_reader, pred_range in zip(pred_readers, pred_ranges)
+    ]
+    print(f"Scoring unit {index} ({len(sources)} instances)")
+    _score(sources, preds_lists, models, cache)
+
+    for file_index, preds_list in enumerate(preds_lists):
+        with open(_get_shard_file(shard_dir, index, file_index), "w") as out:
+            for predictions in preds_list:
+                out.write(json.dumps(predictions) + "\n")
+    open(_get_done_file(shard_dir, index), "w").close()
+
 
-    return instances
+def _append_shards(manifests: List[checkpoint.ProgressManifest], shard_dir: str, index: int) -> None:
+    # An output file may already have the unit if the last run stopped while
+    # the unit's shards were being appended
+    for file_index, manifest in enumerate(manifests):
+        shard_file = _get_shard_file(shard_dir, index, file_index)
+        if manifest.num_completed == index:
+            with open(shard_file, "r") as f:
+                manifest.append(f.read().splitlines())
+    for file_index in range(len(manifests)):
+        os.remove(_get_shard_file(shard_dir, index, file_index))
+    os.remove(_get_done_file(shard_dir, index))
+
+
+def _get_remaining_units(
+    manifests: List[checkpoint.ProgressManifest],
+    shard_dir: str,
+    num_units: int,
+) -> Tuple[int, Set[int], List[int]]:
+    """
+    Returns the number of units which were appended to every output file, the
+    units after them whose shards are finished, and the units to score
+    """
+    num_completed = min(manifest.num_completed for manifest in manifests)
+    finished = set()
+    indices = []
+    for index in range(num_completed, num_units):
+        if os.path.exists(_get_done_file(shard_dir, index)):
+            finished.add(index)
+        else:
+            indices.append(index)
+    return num_completed, finished, indices
+
+
+def _get_parity_inputs(
+    inp_index: Tuple[List[int], List[int]],
+    pred_index: Tuple[List[int], List[int]],
+    args,
+) -> List[Dict]:
+    # The model's best hypothesis for each of the first sources
+    num_lines = min(args.parity_samples, len(inp_index[0]) - 1, len(pred_index[0]) - 1)
+    with chunked_io.LineReader(args.input_file) as reader:
+        sources = [source.strip() for source in reader.read(inp_index[0][0], inp_index[0][num_lines])]
+    with chunked_io.LineReader(args.pred_file[0]) as reader:
+        nbest_lists = [json.loads(line) for line in reader.read(pred_index[0][0], pred_index[0][num_lines])]
+    return [
+        {"sources": [source], "candidate": nbest[0]["prediction"]}
+        for source, nbest in zip(sources, nbest_lists) if len(nbest) > 0
+    ]
+
+
+def _worker(
+    device: int,
+    language: str,
+    shard_dir: str,
+    parity_inputs: List[Dict],
+    args,
+    task_queue,
+    result_queue,
+) -> None:
+    # Each worker loads the models once and scores units from the shared queue
+    # until there are none left, so faster workers take more of the units
+    try:
+        models = nbest_models.load_models(device, language, args)
+        # One worker checks the in-process models against repro before any
+        # of its units are scored
+        nbest_models.check_models_parity(models, parity_inputs, device, args)
+        cache = None
+        if args.cache_dir is not None:
+            cache = score_cache.ScoreCache(args.cache_dir)
+
+        # The readers stay open for all of the worker's units. A compressed
+        # file without an index is decompressed once when it is opened
+        # instead of once per unit
+        inp_reader = chunked_io.LineReader(args.input_file)
+        pred_readers = [chunked_io.LineReader(pred_file) for pred_file in args.pred_file]
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            index, unit = task
+            _score_unit(index, unit, models, cache, shard_dir, inp_reader, pred_readers)
+            result_queue.put((index, None))
+        for reader in [inp_reader] + pred_readers:
+            reader.close()
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
 
 
 def main(args):
-    instances = []
-    with open(args.input_file, "r") as f_inp:
-        with open(args.pred_file, "r") as f_pred:
-            for line_inp, line_pred in zip(f_inp, f_pred):
-                source = line_inp.strip()
-                predictions = json.loads(line_pred)
-                instances.append({"source": source, "predictions": predictions})
-
-    # Divide into batches
-    num_batches = len(args.devices)
-    instances_per_batch = int(math.ceil(len(instances) / num_batches))
-    batches = []
-    for i in range(0, len(instances), instances_per_batch):
-        batches.append(instances[i : i + instances_per_batch])
-
-    # Distribute to the workers
-    instances_list = Parallel(n_jobs=len(args.devices))(
-        delayed(_score)(batch, device, args.language)
-        for batch, device in zip(batches, args.devices)
+    assert len(args.pred_file) == len(args.output_file)
+
+    # Only the line offsets are read here. The workers read and parse their
+    # own lines, so the n-best lists are never copied between processes
+    inp_index = chunked_io.index_lines(args.input_file)
+    pred_indices = [chunked_io.index_lines(pred_file) for pred_file in args.pred_file]
+    max_unit_bytes = _get_max_unit_bytes(pred_indices, args)
+    units = _make_units(inp_index, pred_indices, max_unit_bytes)
+
+    # The units are appended to the output files in order as they finish, so a
+    # restarted run continues after the last unit which was appended. Units
+    # which finished out of order are kept and do not need to be scored again.
+    # Everything which changes the scores is in the config so a different run
+    # starts over
+    config = {
+        "input_file": checkpoint.get_file_info(args.input_file),
+        "pred_files": [checkpoint.get_file_info(pred_file) for pred_file in args.pred_file],
+        "max_unit_bytes": max_unit_bytes,
+        "language": args.language,
+        "prism_nbest": args.prism_nbest,
+        "prism_model_dir": args.prism_model_dir,
+        "comet_nbest": args.comet_nbest,
+        "max_tokens": args.max_tokens,
+    }
+    manifests = [checkpoint.ProgressManifest(output_file, config) for output_file in args.output_file]
+    shard_dir = f"{args.output_file[0]}.shards"
+    if not all(manifest.is_resumed for manifest in manifests) and os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    num_completed, finished, indices = _get_remaining_units(manifests, shard_dir, len(units))
+    print(
+        f"Scoring {len(inp_index[0]) - 1} instances in {len(units)} units on {len(args.devices)} workers "
+        f"({num_completed + len(finished)} units already finished)"
     )
 
-    with open(args.output_file, "w") as out:
-        for instances in instances_list:
-            for instance in instances:
-                out.write(json.dumps(instance["predictions"]) + "\n")
+    # CUDA cannot be used in forked processes
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    for index in indices:
+        task_queue.put((index, units[index]))
+    for _ in args.devices:
+        task_queue.put(None)
+
+    workers = []
+    if len(indices) > 0:
+        parity_inputs = _get_parity_inputs(inp_index, pred_indices[0], args)
+        workers = [
+            context.Process(
+                target=_worker,
+                args=(device, args.language, shard_dir, parity_inputs if i == 0 else [], args, task_queue, result_queue)
+            )
+            for i, device in enumerate(args.devices)
+        ]
+    for worker in workers:
+        worker.start()
+
+    while num_completed < len(units):
+        # Append the shards which are next in order
+        if num_completed in finished:
+            _append_shards(manifests, shard_dir, num_completed)
+            finished.remove(num_completed)
+            num_completed += 1
+            continue
+
+        try:
+            index, error = result_queue.get(timeout=60)
+        except queue.Empty:
+            # A worker which was killed (e.g., by the OOM killer) cannot report an error
+            if any(worker.exitcode not in [None, 0] for worker in workers):
+                error = "A worker exited unexpectedly"
+            else:
+                continue
+        if error is not None:
+            for worker in workers:
+                worker.terminate()
+            for manifest in manifests:
+                manifest.close()
+            raise Exception(f"A scoring worker failed:\n{error}")
+        finished.add(index)
+
+    for worker in workers:
+        worker.join()
+    for manifest in manifests:
+        manifest.close()
+    shutil.rmtree(shard_dir)
 
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser()
     argp.add_argument("--input-file", required=True)
-    argp.add_argument("--pred-file", required=True)
+    # The n-best lists of every beam size for the same inputs can be scored
+    # together, which scores the hypotheses they share once. There is one
+    # output file per prediction file
+    argp.add_argument("--pred-file", required=True, nargs="+")
+    # One worker per device. A device can be repeated (e.g., "-1 -1" for
+    # two CPU workers)
     argp.add_argument("--devices", required=True, type=int, nargs="+")
     argp.add_argument("--language", required=True)
-    argp.add_argument("--output-file", required=True)
+    argp.add_argument("--output-file", required=True, nargs="+")
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--comet-nbest", action="store_true")
+    argp.add_argument("--prism-nbest", action="store_true")
+    argp.add_argument("--prism-model-dir")
+    # The number of sources whose best hypothesis is scored by both the
+    # in-process and the repro model before the in-process model is used
+    argp.add_argument("--parity-samples", type=int, default=100)
+    argp.add_argument("--max-tokens", type=int)
+    # The approximate number of bytes of n-best lists in each unit of work.
+    # By default, DEFAULT_UNIT_BYTES with --prism-nbest and --comet-nbest, and
+    # one unit per device otherwise (see `_get_max_unit_bytes`)
+    argp.add_argument("--max-unit-bytes", type=int)
     args = argp.parse_args()
     main(args)
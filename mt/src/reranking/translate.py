@@ -1,7 +1,28 @@
 import argparse
 import json
+import os
+import sys
 import torch
 from tqdm import tqdm
+from typing import Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import chunked_io
+import generation
+
+
+def _get_generation_args(args) -> Dict:
+    if args.inference_method == "standard":
+        return {}
+    elif args.inference_method == "diverse":
+        assert args.diverse_beam_groups > 0
+        return {"diverse_beam_groups": args.diverse_beam_groups}
+    elif args.inference_method == "sampling":
+        return {"sampling": True, "sampling_topk": args.sampling_topk}
+    else:
+        raise Exception(f"Unknown inference method: {args.inference_method}")
 
 
 def main(args):
@@ -18,36 +39,59 @@ def main(args):
     model.eval()
     model.cuda()
 
-    with open(args.input_file, "r") as f:
+    with chunked_io.open_file(args.input_file, "r") as f:
         sources = f.read().splitlines()
+    sources_bin = [model.encode(source) for source in sources]
+
+    # Several beam sizes can be run in one job so the models are loaded and
+    # every batch is encoded only once
+    assert len(args.beam_size) == len(args.output_file)
+    if args.details_file is not None:
+        assert len(args.beam_size) == len(args.details_file)
+    generation_args = _get_generation_args(args)
+
+    # Every source is expanded into `beam_size` hypotheses, so the budget
+    # is divided by the largest beam size to bound the decoder's memory. It
+    # is reduced further if a batch runs out of memory
+    lengths = [source_bin.numel() for source_bin in sources_bin]
+    max_tokens = max(args.max_tokens // max(args.beam_size), 1)
+    batcher = batching.AdaptiveBatcher("Source batches", max_tokens)
+    progress = tqdm(total=len(sources))
+
+    hypotheses_lists = {beam_size: [None] * len(sources) for beam_size in args.beam_size}
+    details_lists = {beam_size: [None] * len(sources) for beam_size in args.beam_size}
+
+    def _process_batch(batch: List[int]) -> None:
+        sample = generation.build_sample(model, [sources_bin[i] for i in batch])
+        predictions_dict = generation.generate_sweep(
+            model, model.models, sample, args.beam_size, **generation_args
+        )
+        for beam_size, predictions_list in predictions_dict.items():
+            for i, predictions in zip(batch, predictions_list):
+                hypotheses_lists[beam_size][i] = [
+                    {"prediction": model.decode(pred["tokens"])} for pred in predictions
+                ]
+                if args.details_file is not None:
+                    details_lists[beam_size][i] = [generation.get_details(pred) for pred in predictions]
+        progress.update(len(batch))
 
-    with open(args.output_file, "w") as out:
-        for source in tqdm(sources):
-            source_bin = model.encode(source)
+    batcher.run(lengths, _process_batch)
+    progress.close()
+    batcher.print()
 
-            if args.inference_method == "standard":
-                predictions = model.generate(source_bin, beam=args.beam_size)
-            elif args.inference_method == "diverse":
-                assert args.diverse_beam_groups > 0
-                predictions = model.generate(
-                    source_bin,
-                    beam=args.beam_size,
-                    diverse_beam_groups=args.diverse_beam_groups,
-                )
-            elif args.inference_method == "sampling":
-                predictions = model.generate(
-                    source_bin,
-                    beam=args.beam_size,
-                    sampling=True,
-                    sampling_topk=args.sampling_topk,
-                )
-            else:
-                raise Exception(f"Unknown inference method: {args.inference_method}")
+    for beam_size, output_file in zip(args.beam_size, args.output_file):
+        dirname = os.path.dirname(output_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with chunked_io.open_file(output_file, "w") as out:
+            for hypotheses in hypotheses_lists[beam_size]:
+                out.write(json.dumps(hypotheses) + "\n")
 
-            hypotheses = [
-                {"prediction": model.decode(pred["tokens"])} for pred in predictions
-            ]
-            out.write(json.dumps(hypotheses) + "\n")
+    # The model scores, token ids, and token log-probabilities are saved in
+    # the same order as the n-best lists
+    if args.details_file is not None:
+        for beam_size, details_file in zip(args.beam_size, args.details_file):
+            generation.save_details(details_file, details_lists[beam_size])
 
 
 if __name__ == "__main__":
@@ -56,11 +100,15 @@ if __name__ == "__main__":
         "--lp", required=True, choices=["en-de", "de-en", "en-ru", "ru-en"]
     )
     argp.add_argument("--input-file", required=True)
-    argp.add_argument("--beam-size", required=True, type=int)
-    argp.add_argument("--output-file", required=True)
+    # One output file per beam size
+    argp.add_argument("--beam-size", required=True, type=int, nargs="+")
+    argp.add_argument("--output-file", required=True, nargs="+")
+    argp.add_argument("--details-file", nargs="+")
     argp.add_argument(
         "--inference-method", required=True, choices=["standard", "diverse", "sampling"]
     )
+    # The maximum number of source tokens times the beam size in one batch
+    argp.add_argument("--max-tokens", type=int, default=16384)
     # Diverse
     argp.add_argument("--diverse-beam-groups", type=int, default=-1)
     # Sampling
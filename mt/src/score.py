@@ -1,112 +1,261 @@
 import argparse
 import json
 import os
-from repro.models.rei2020 import COMET
-from repro.models.sellam2020 import BLEURT
-from repro.models.thompson2020 import Prism
-from repro.models.zhang2020 import BERTScore
-from subprocess import check_output
+import sys
+from functools import lru_cache
+from glob import glob
+from typing import Callable, Dict, List, Tuple
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import batching
+import chunked_io
+import metric_daemon
+import metrics
+import nbest_models
+import score_cache
 
-def main(args):
+
+def _read_lines(input_file: str) -> List[str]:
+    with chunked_io.open_file(input_file, "r") as f:
+        return f.read().splitlines()
+
+
+def get_system_name(candidate_file: str) -> str:
+    # WMT'19 submissions are named "newstest2019.{system}.{lp}"
+    filename = os.path.basename(candidate_file)
+    filename = os.path.splitext(filename)[0]
+    if filename.startswith("newstest2019."):
+        filename = filename[len("newstest2019."):]
+    return filename
+
+
+def _load_systems(args) -> List[Dict[str, str]]:
+    systems = []
+    if args.candidate_file is not None:
+        assert args.system_name is not None
+        assert args.output_file is not None
+        systems.append({
+            "system": args.system_name,
+            "candidate_file": args.candidate_file,
+            "output_file": args.output_file,
+        })
+    elif args.manifest is not None:
+        with open(args.manifest, "r") as f:
+            for line in f:
+                if line.strip():
+                    systems.append(json.loads(line))
+    else:
+        assert args.output_dir is not None
+        for candidate_file in sorted(glob(f"{args.candidate_dir}/*")):
+            if chunked_io.is_index_file(candidate_file):
+                continue
+            system = get_system_name(candidate_file)
+            systems.append({
+                "system": system,
+                "candidate_file": candidate_file,
+                "output_file": f"{args.output_dir}/{system}.json",
+            })
+
+    if args.reference_output_file is not None:
+        assert args.reference_file is not None
+        systems.append({
+            "system": "reference",
+            "candidate_file": args.reference_file,
+            "output_file": args.reference_output_file,
+        })
+    return systems
+
+
+def _get_unique_inputs(
+    candidates_list: List[List[str]],
+    sources: List[str],
+    references: List[str],
+) -> Tuple[List[Dict], List[List[int]]]:
+    # Identical (candidate, source, reference) triples are shared across
+    # systems (e.g., the reference scored as a system), so they only
+    # need to be scored once
+    index = {}
     inputs = []
-    inputs_src = []
-    inputs_ref = []
-    with open(args.candidate_file, "r") as f:
-        candidates = f.read().splitlines()
-        for candidate in candidates:
-            inputs.append({"candidate": candidate})
-            inputs_src.append({"candidate": candidate})
-            inputs_ref.append({"candidate": candidate})
+    indices_list = []
+    for candidates in candidates_list:
+        indices = []
+        for i, candidate in enumerate(candidates):
+            source = sources[i] if sources is not None else None
+            reference = references[i] if references is not None else None
+            key = (candidate, source, reference)
+            if key not in index:
+                index[key] = len(inputs)
+                inp = {"candidate": candidate}
+                if source is not None:
+                    inp["sources"] = [source]
+                if reference is not None:
+                    inp["references"] = [reference]
+                inputs.append(inp)
+            indices.append(index[key])
+        indices_list.append(indices)
+    return inputs, indices_list
+
+
+@lru_cache()
+def _load_cached_bertscore(cache_dir: str, language: str, device: int, max_tokens: int):
+    from bertscore_cache import CachedBERTScore
+    kwargs = {} if max_tokens is None else {"max_tokens": max_tokens}
+    return CachedBERTScore(cache_dir, language=language, device=device, **kwargs)
+
+
+@lru_cache()
+def _load_prism_nbest(model_dir: str, language: str, device: int, max_tokens: int):
+    from prism_nbest import PrismNbest
+    kwargs = {} if max_tokens is None else {"max_tokens": max_tokens}
+    return PrismNbest(model_dir, language, device, **kwargs)
+
+
+def _get_predict_batch(name: str, language: str, args) -> Callable:
+    if name == "bertscore-cached":
+        metric = _load_cached_bertscore(args.embedding_cache_dir, language, args.device, args.max_tokens)
+        return metric.predict_batch
+    if name == "prism-nbest":
+        # The model is only loaded if some of the inputs are not cached
+        return lambda batch: _load_prism_nbest(
+            args.prism_model_dir, language, args.device, args.max_tokens
+        ).predict_batch(batch)
+    # The registry's metrics are all repro models, which load the model for
+    # every call, so the inputs are passed in one call in order of length
+    return lambda batch: batching.batched_predict_batch(
+        name, batch,
+        lambda inputs: metric_daemon.predict_batch(name, inputs, language=language, device=args.device),
+    )
 
+
+def _check_prism_parity(
+    language: str,
+    args,
+    cache: score_cache.ScoreCache,
+    candidates_list: List[List[str]],
+    sources: List[str],
+) -> None:
+    # The systems which are compared with these scores (e.g., the WMT
+    # submissions) are scored by repro's Prism, so the in-process scores,
+    # including the ones which were cached from decoding, must be the same
+    inputs, _ = _get_unique_inputs(candidates_list, sources, None)
+    inputs = inputs[:args.prism_parity_samples]
+    if len(inputs) == 0:
+        return
+    actual = score_cache.cached_predict_batch(
+        cache, "prism-nbest", language, inputs, _get_predict_batch("prism-nbest", language, args)
+    )
+    nbest_models.check_parity("prism-src", inputs, actual, language, args.device)
+
+
+def _score_systems(
+    name: str,
+    language: str,
+    args,
+    cache: score_cache.ScoreCache,
+    candidates_list: List[List[str]],
+    sources: List[str],
+    references: List[str],
+) -> List[Dict]:
+    inputs, indices_list = _get_unique_inputs(candidates_list, sources, references)
+    total = sum(len(indices) for indices in indices_list)
+    print(f"Scoring {len(inputs)} unique inputs ({total} total) with {name}")
+
+    micro = score_cache.cached_predict_batch(
+        cache, name, language, inputs, _get_predict_batch(name, language, args)
+    )
+    return [batching.aggregate_scores([micro[i] for i in indices]) for indices in indices_list]
+
+
+def main(args):
+    systems = _load_systems(args)
+    candidates_list = [_read_lines(system["candidate_file"]) for system in systems]
+
+    sources = None
     if args.source_file is not None:
-        with open(args.source_file, "r") as f:
-            sources = f.read().splitlines()
-            for inp1, inp2, source in zip(inputs, inputs_src, sources):
-                inp1["sources"] = [source]
-                inp2["sources"] = [source]
+        sources = _read_lines(args.source_file)
 
+    references = None
     if args.reference_file is not None:
-        with open(args.reference_file, "r") as f:
-            references = f.read().splitlines()
-            for inp1, inp2, reference in zip(inputs, inputs_ref, references):
-                inp1["references"] = [reference]
-                inp2["references"] = [reference]
+        references = _read_lines(args.reference_file)
 
-    metrics = {}
+    cache = None
+    if args.cache_dir is not None:
+        cache = score_cache.ScoreCache(args.cache_dir)
 
-    if args.bleu:
-        assert args.reference_file is not None
-        stdout = check_output(
-            f"sacrebleu {args.reference_file} -l {args.lp} -i {args.candidate_file} -m bleu -lc -tok intl -b -w 4",
-            shell=True,
-        )
-        bleu = float(stdout.decode().strip())
-        metrics["bleu"] = bleu
-
-    if args.bleurt:
-        assert args.reference_file is not None
-        metric = BLEURT(device=args.device)
-        bleurt, _ = metric.predict_batch(inputs_ref)
-        metrics["bleurt"] = bleurt["bleurt"]["mean"]
+    metrics_list = [{} for _ in systems]
+    target = args.lp.split("-")[1]
 
-    if args.comet:
-        assert args.source_file is not None
-        assert args.reference_file is not None
-        metric = COMET(device=args.device)
-        comet, _ = metric.predict_batch(inputs)
-        metrics["comet"] = comet["comet"]
+    for metric in metrics.METRICS.values():
+        if not getattr(args, metric.name.replace("-", "_")):
+            continue
+        if metric.skip is not None and metric.skip(args.lp):
+            continue
+        if metric.sources:
+            assert args.source_file is not None
+        if metric.references:
+            assert args.reference_file is not None
 
-    if args.comet_src:
-        assert args.source_file is not None
-        metric = COMET(device=args.device)
-        comet, _ = metric.predict_batch(inputs_src)
-        metrics["comet-src"] = comet["comet-src"]
+        if metric.corpus_score is not None:
+            for system, scores in zip(systems, metrics_list):
+                scores[metric.name] = metric.corpus_score(system["candidate_file"], args.reference_file)
+            continue
 
-    if args.prism and "gu" not in args.lp:
-        assert args.reference_file is not None
-        target = args.lp.split("-")[1]
-        metric = Prism(device=args.device, language=target)
-        prism, _ = metric.predict_batch(inputs_ref)
-        metrics["prism"] = prism["prism"]
-
-    if args.prism_src and not args.lp.endswith("gu"):
-        assert args.source_file is not None
-        target = args.lp.split("-")[1]
-        metric = Prism(device=args.device, language=target)
-        prism, _ = metric.predict_batch(inputs_src)
-        metrics["prism-src"] = prism["prism"]
-
-    if args.bertscore:
-        assert args.reference_file is not None
-        target = args.lp.split("-")[1]
-        metric = BERTScore(device=args.device, language=target)
-        macro, _ = metric.predict_batch(inputs_ref)
-        metrics["bertscore"] = macro["bertscore"]
+        name = metric.backend
+        if name == "bertscore" and args.embedding_cache_dir is not None:
+            # With an embedding cache, the reference embeddings are only computed once
+            name = "bertscore-cached"
+        if name == "prism" and not metric.references and args.prism_model_dir is not None:
+            # Prism-src with the in-process model, whose scores for Prism's own
+            # translations are saved to the cache by prism-optimization/translate.py
+            name = "prism-nbest"
+            _check_prism_parity(target, args, cache, candidates_list, sources)
+        macros = _score_systems(
+            name,
+            target if metric.target_language else None,
+            args,
+            cache,
+            candidates_list,
+            sources if metric.sources else None,
+            references if metric.references else None,
+        )
+        for scores, macro in zip(metrics_list, macros):
+            scores[metric.name] = macro[metric.key]
 
-    dirname = os.path.dirname(args.output_file)
-    if dirname:
-        os.makedirs(dirname, exist_ok=True)
+    for system, scores in zip(systems, metrics_list):
+        dirname = os.path.dirname(system["output_file"])
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
 
-    with open(args.output_file, "w") as out:
-        out.write(json.dumps({"system": args.system_name, "metrics": metrics}) + "\n")
+        with chunked_io.open_file(system["output_file"], "w") as out:
+            out.write(json.dumps({"system": system["system"], "metrics": scores}) + "\n")
 
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser()
-    argp.add_argument("--candidate-file", required=True)
-    argp.add_argument("--output-file", required=True)
-    argp.add_argument("--system-name", required=True)
+    # Exactly one of a single candidate file, a manifest, or a directory
+    # of candidate files for one language pair. The manifest is a jsonl
+    # file with "system", "candidate_file", and "output_file" keys
+    group = argp.add_mutually_exclusive_group(required=True)
+    group.add_argument("--candidate-file")
+    group.add_argument("--manifest")
+    group.add_argument("--candidate-dir")
+    argp.add_argument("--output-file")
+    argp.add_argument("--output-dir")
+    argp.add_argument("--system-name")
+    argp.add_argument("--reference-output-file")
     argp.add_argument("--lp", required=True)
     argp.add_argument("--source-file")
     argp.add_argument("--reference-file")
     argp.add_argument("--device", type=int, required=True)
-    argp.add_argument("--bleu", action="store_true")
-    argp.add_argument("--bleurt", action="store_true")
-    argp.add_argument("--comet", action="store_true")
-    argp.add_argument("--comet-src", action="store_true")
-    argp.add_argument("--prism", action="store_true")
-    argp.add_argument("--prism-src", action="store_true")
-    argp.add_argument("--bertscore", action="store_true")
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--embedding-cache-dir", default=os.environ.get("EMBEDDING_CACHE_DIR"))
+    # The token budget of the in-process models (bertscore-cached and prism-nbest)
+    argp.add_argument("--max-tokens", type=int)
+    argp.add_argument("--prism-model-dir")
+    # The number of inputs which are scored by both the in-process and repro
+    # Prism before the in-process model is used for Prism-src
+    argp.add_argument("--prism-parity-samples", type=int, default=100)
+    for name in metrics.METRICS:
+        argp.add_argument(f"--{name}", action="store_true")
     args = argp.parse_args()
     main(args)
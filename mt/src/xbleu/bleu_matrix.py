@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import sys
+from glob import glob
+from typing import Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import bleu
+import chunked_io
+import score
+
+
+def _load_outputs(args) -> Dict[str, str]:
+    outputs = {}
+    for candidate_file in sorted(glob(f"{args.system_dir}/*")):
+        if chunked_io.is_index_file(candidate_file):
+            continue
+        outputs[score.get_system_name(candidate_file)] = candidate_file
+    if args.reference_file is not None:
+        outputs["reference"] = args.reference_file
+    # Additional outputs, such as the optimized outputs, are "name=path"
+    for spec in args.extra:
+        name, path = spec.split("=", 1)
+        if name in outputs:
+            raise Exception(f"The extra output's name is already used by another output: {name}")
+        outputs[name] = path
+    return outputs
+
+
+def _count_matches(stats1: bleu.CorpusStats, stats2: bleu.CorpusStats) -> List[int]:
+    # The clipped n-gram matches are symmetric in the candidate and reference,
+    # so they are computed once per pair of outputs
+    matches = [0] * bleu.MAX_NGRAM_ORDER
+    for ngrams1, ngrams2 in zip(stats1.ngrams, stats2.ngrams):
+        if len(ngrams2) < len(ngrams1):
+            ngrams1, ngrams2 = ngrams2, ngrams1
+        for ngram, count in ngrams1.items():
+            if ngram in ngrams2:
+                matches[len(ngram) - 1] += min(count, ngrams2[ngram])
+    return matches
+
+
+def _get_totals(stats: bleu.CorpusStats) -> List[int]:
+    return [
+        sum(max(0, length - n) for length in stats.lengths)
+        for n in range(bleu.MAX_NGRAM_ORDER)
+    ]
+
+
+def compute_matrix(outputs: Dict[str, str]) -> List[List[float]]:
+    """
+    Computes BLEU for every pair of outputs, where `matrix[i][j]` is the score
+    of output `i` as the candidate against output `j` as the reference
+    """
+    stats = [bleu.load_stats(path) for path in outputs.values()]
+    for name, s in zip(outputs, stats):
+        # A truncated output would otherwise only be compared on its lines
+        assert len(s) == len(stats[0]), f"Number of lines differ: {name} has {len(s)} vs {len(stats[0])}"
+    lengths = [sum(s.lengths) for s in stats]
+    totals = [_get_totals(s) for s in stats]
+
+    n = len(stats)
+    matrix = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(i, n):
+            matches = _count_matches(stats[i], stats[j])
+            matrix[i][j] = bleu.compute_bleu([lengths[i], lengths[j]] + matches + totals[i])
+            matrix[j][i] = bleu.compute_bleu([lengths[j], lengths[i]] + matches + totals[j])
+    return [[float(f"{score:.4f}") for score in row] for row in matrix]
+
+
+def main(args):
+    outputs = _load_outputs(args)
+    names = list(outputs.keys())
+    print(f"Computing BLEU for {len(names)} x {len(names)} pairs of outputs")
+    matrix = compute_matrix(outputs)
+
+    # The average similarity of the other outputs to each pseudo-reference
+    for j, name in enumerate(names):
+        scores = [matrix[i][j] for i in range(len(names)) if i != j]
+        if len(scores) > 0:
+            print(f"{name}: {sum(scores) / len(scores):.2f}")
+
+    dirname = os.path.dirname(args.output_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(args.output_file, "w") as out:
+        out.write(json.dumps({"lp": args.lp, "names": names, "matrix": matrix}) + "\n")
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    # Only used to label the output file
+    argp.add_argument("--lp")
+    argp.add_argument("--system-dir", required=True)
+    argp.add_argument("--reference-file")
+    argp.add_argument("--extra", nargs="+", default=[])
+    argp.add_argument("--output-file", required=True)
+    args = argp.parse_args()
+    main(args)
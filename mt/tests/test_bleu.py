@@ -0,0 +1,48 @@
+import os
+import random
+import sacrebleu
+import sys
+from sacrebleu.tokenizers.tokenizer_intl import TokenizerV14International
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import bleu
+import pytest
+
+# Backslash, ASCII and Unicode punctuation and symbols, digits, and letters
+ALPHABET = list("ab cd\\\\:/.,-_'\"()[]{}!?@#$%^&*+=<>|~`0123 9") + ["é", "“", "”", "—", "€", "°", "中", "ß", "‰"]
+
+
+def _random_lines(num_lines: int, seed: int):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 30))) for _ in range(num_lines)]
+
+
+@pytest.fixture(params=["regex", "re"])
+def intl_regexes(request, monkeypatch):
+    # The regexes which are built with the `regex` package and without it
+    monkeypatch.setattr(bleu, "_intl_regexes", None)
+    if request.param == "re":
+        monkeypatch.setitem(sys.modules, "regex", None)
+    yield
+    bleu._intl_regexes = None
+
+
+def test_tokenize_intl_backslash(intl_regexes):
+    line = r"a\b c:\path"
+    assert bleu.tokenize_intl(line) == TokenizerV14International()(line)
+
+
+def test_tokenize_intl(intl_regexes):
+    tokenizer = TokenizerV14International()
+    for line in _random_lines(2000, 0):
+        assert bleu.tokenize_intl(line) == tokenizer(line)
+
+
+def test_corpus_bleu(intl_regexes):
+    hyps = _random_lines(500, 1)
+    refs = _random_lines(500, 2)
+    # Mix in copies of the references so the scores are not all 0
+    hyps = [ref if i % 3 == 0 else hyp for i, (hyp, ref) in enumerate(zip(hyps, refs))]
+    expected = sacrebleu.corpus_bleu(hyps, [refs], lowercase=True, tokenize="intl").score
+    actual = bleu.corpus_bleu(bleu.CorpusStats(hyps), bleu.CorpusStats(refs))
+    assert actual == pytest.approx(expected, abs=1e-4)
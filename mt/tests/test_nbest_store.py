@@ -0,0 +1,58 @@
+import json
+import os
+import pytest
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import chunked_io
+import nbest_store
+
+NBEST_LISTS = [
+    [
+        {"prediction": "a b", "bleu": 12.5, "rank": 0, "comet-src": {"comet": -0.25}},
+        {"prediction": "cé", "bleu": 0.0, "rank": 1, "comet-src": {"comet": 0.5}},
+    ],
+    [],
+    [{"prediction": "", "bleu": 100.0, "rank": 0, "comet-src": {"comet": 1.0}}],
+]
+
+
+def _write_jsonl(filename: str, nbest_lists) -> None:
+    with open(filename, "w") as out:
+        for nbest in nbest_lists:
+            out.write(json.dumps(nbest) + "\n")
+
+
+def _read_jsonl(filename: str):
+    with chunked_io.open_file(filename, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz"])
+def test_round_trip(tmp_path, extension):
+    jsonl_file = str(tmp_path / "scores.jsonl")
+    _write_jsonl(jsonl_file, NBEST_LISTS)
+    store_path = str(tmp_path / "store")
+    nbest_store.from_jsonl(jsonl_file, store_path)
+
+    store = nbest_store.NbestStore(store_path)
+    assert list(store.iter_nbest_lists()) == [["a b", "cé"], [], [""]]
+    assert store.columns[("rank", None)].dtype.kind == "i"
+
+    output_file = str(tmp_path / f"output{extension}")
+    nbest_store.to_jsonl(store_path, output_file)
+    assert _read_jsonl(output_file) == NBEST_LISTS
+    # The ints are written as ints, not floats
+    assert all(type(prediction["rank"]) is int for nbest in _read_jsonl(output_file) for prediction in nbest)
+
+
+def test_different_fields(tmp_path):
+    jsonl_file = str(tmp_path / "scores.jsonl")
+    nbest_lists = [
+        [{"prediction": "a", "comet-src": {"comet": 0.5}}],
+        [{"prediction": "b", "comet-src": {"score": 0.5}}],
+    ]
+    _write_jsonl(jsonl_file, nbest_lists)
+    with pytest.raises(Exception, match="Segment 1 has comet-src.score instead of comet-src.comet"):
+        nbest_store.from_jsonl(jsonl_file, str(tmp_path / "store"))
@@ -0,0 +1,108 @@
+import importlib.util
+import os
+import pytest
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import checkpoint
+
+# reranking/score.py is loaded by its path because src/score.py has the same name
+_spec = importlib.util.spec_from_file_location(
+    "reranking_score", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "reranking", "score.py")
+)
+reranking_score = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(reranking_score)
+
+CONFIG = {"max_unit_bytes": 100}
+NUM_UNITS = 3
+NUM_FILES = 2
+
+
+def _open_manifests(tmp_path):
+    return [
+        checkpoint.ProgressManifest(str(tmp_path / f"scores.{file_index}.jsonl"), CONFIG)
+        for file_index in range(NUM_FILES)
+    ]
+
+
+def _write_unit(shard_dir: str, index: int) -> None:
+    # What a worker writes for a unit (see `_score_unit`)
+    for file_index in range(NUM_FILES):
+        with open(reranking_score._get_shard_file(shard_dir, index, file_index), "w") as out:
+            out.write(f"unit {index} file {file_index}\n")
+    open(reranking_score._get_done_file(shard_dir, index), "w").close()
+
+
+def _finish(manifests, shard_dir: str) -> None:
+    # The main loop of `main` without the workers, which finish every unit
+    num_completed, finished, indices = reranking_score._get_remaining_units(manifests, shard_dir, NUM_UNITS)
+    for index in indices:
+        _write_unit(shard_dir, index)
+    for index in range(num_completed, NUM_UNITS):
+        reranking_score._append_shards(manifests, shard_dir, index)
+    for manifest in manifests:
+        manifest.close()
+
+
+def _check_outputs(tmp_path) -> None:
+    for file_index in range(NUM_FILES):
+        with open(tmp_path / f"scores.{file_index}.jsonl", "r") as f:
+            assert f.read().splitlines() == [f"unit {index} file {file_index}" for index in range(NUM_UNITS)]
+
+
+class _Killed(Exception):
+    pass
+
+
+def test_kill_between_outputs(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    os.makedirs(shard_dir)
+    manifests = _open_manifests(tmp_path)
+    _write_unit(shard_dir, 0)
+    _write_unit(shard_dir, 1)
+    reranking_score._append_shards(manifests, shard_dir, 0)
+
+    # The job is killed after unit 1 is appended to the first output only
+    def _kill(lines):
+        raise _Killed()
+    manifests[1].append = _kill
+    with pytest.raises(_Killed):
+        reranking_score._append_shards(manifests, shard_dir, 1)
+    for manifest in manifests:
+        manifest.close()
+
+    manifests = _open_manifests(tmp_path)
+    assert [manifest.num_completed for manifest in manifests] == [2, 1]
+    # Unit 1 is appended to the second output without being scored again
+    assert reranking_score._get_remaining_units(manifests, shard_dir, NUM_UNITS) == (1, {1}, [2])
+    _finish(manifests, shard_dir)
+    _check_outputs(tmp_path)
+
+
+def test_kill_before_done_removal(tmp_path, monkeypatch):
+    shard_dir = str(tmp_path / "shards")
+    os.makedirs(shard_dir)
+    manifests = _open_manifests(tmp_path)
+    _write_unit(shard_dir, 0)
+    _write_unit(shard_dir, 1)
+
+    # The job is killed after unit 0's shards are appended and removed, but
+    # before its ".done" file is removed
+    remove = os.remove
+    def _remove(filename):
+        if filename.endswith(".done"):
+            raise _Killed()
+        remove(filename)
+    monkeypatch.setattr(reranking_score.os, "remove", _remove)
+    with pytest.raises(_Killed):
+        reranking_score._append_shards(manifests, shard_dir, 0)
+    monkeypatch.undo()
+    for manifest in manifests:
+        manifest.close()
+
+    manifests = _open_manifests(tmp_path)
+    assert [manifest.num_completed for manifest in manifests] == [1, 1]
+    # The leftover ".done" file of unit 0 is ignored, and unit 1 is not scored again
+    assert reranking_score._get_remaining_units(manifests, shard_dir, NUM_UNITS) == (1, {1}, [2])
+    _finish(manifests, shard_dir)
+    _check_outputs(tmp_path)
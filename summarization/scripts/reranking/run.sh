@@ -4,23 +4,34 @@ set -e
 for dataset in "fabbri2021" "bhandari2020"; do
   input_file=data/${dataset}/summaries.jsonl
 
-  for beam_size in 1 2 4 8 16; do
+  # All of the beam sizes are generated in one run which loads BART once
+  beam_sizes="1 2 4 8 16"
+  pred_files=""
+  for beam_size in ${beam_sizes}; do
+    pred_files="${pred_files} output/reranking/${dataset}/standard/${beam_size}/predictions.jsonl"
+  done
+
+  python src/reranking/summarize.py \
+    --input-file ${input_file} \
+    --beam-size ${beam_sizes} \
+    --output-file ${pred_files} \
+    --device ${CUDA_VISIBLE_DEVICES}
+
+  # The summaries which are shared by the beam sizes are only scored once
+  score_files=""
+  for beam_size in ${beam_sizes}; do
+    score_files="${score_files} output/reranking/${dataset}/standard/${beam_size}/scores.jsonl"
+  done
+
+  python src/reranking/score.py \
+    --input-file ${input_file} \
+    --pred-file ${pred_files} \
+    --device ${CUDA_VISIBLE_DEVICES} \
+    --output-file ${score_files}
+
+  for beam_size in ${beam_sizes}; do
     output_dir=output/reranking/${dataset}/standard/${beam_size}
-    pred_file=${output_dir}/predictions.jsonl
     score_file=${output_dir}/scores.jsonl
-    mkdir -p ${output_dir}
-
-    python src/reranking/summarize.py \
-      --input-file ${input_file} \
-      --beam-size ${beam_size} \
-      --output-file ${pred_file} \
-      --device ${CUDA_VISIBLE_DEVICES}
-
-    python src/reranking/score.py \
-      --input-file ${input_file} \
-      --pred-file ${pred_file} \
-      --device ${CUDA_VISIBLE_DEVICES} \
-      --output-file ${score_file}
 
     python src/reranking/rerank.py \
       --score-file ${score_file} \
@@ -0,0 +1,118 @@
+# The registry of metrics which `score.py` can compute. Each metric's flag
+# (e.g., `--questeval`) is generated from the registry, and the libraries for
+# a backend model are only imported when a requested metric needs it, so runs
+# which only compute cheap metrics like ROUGE do not load torch or TensorFlow.
+#
+# To add a metric, add its loader with `register_backend` (if it uses a new
+# model) and describe its inputs and output key with `register_metric`.
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict, List, Tuple
+
+# The name of the experiment, which keeps its metric daemon separate from the
+# other experiment's (see `metric_daemon.py`)
+EXPERIMENT = "summ"
+
+# A metric which is written to the score files. `backend` is the model whose
+# `predict_batch` computes the segment scores and `key` is the key of the score
+# in its output, or `None` to save all of the backend's scores
+Metric = namedtuple("Metric", ["name", "backend", "key", "sources", "references"])
+
+# The loaders of the backends, which are called with (language, device)
+_BACKENDS = {}
+
+# The backends which run in this process. The others are repro models, which
+# start a new Docker container and load the model for every `predict_batch` call
+_IN_PROCESS_BACKENDS = set()
+
+METRICS = OrderedDict()
+
+
+def register_backend(name: str, load: Callable, in_process: bool = False) -> None:
+    _BACKENDS[name] = load
+    if in_process:
+        _IN_PROCESS_BACKENDS.add(name)
+
+
+def is_in_process(name: str) -> bool:
+    return name in _IN_PROCESS_BACKENDS
+
+
+def register_metric(
+    name: str,
+    backend: str,
+    key: str,
+    sources: bool = False,
+    references: bool = False,
+) -> None:
+    METRICS[name] = Metric(name, backend, key, sources, references)
+
+
+def load_backend(name: str, language: str, device: int):
+    if name not in _BACKENDS:
+        raise Exception(f"Unknown metric: {name}")
+    return _BACKENDS[name](language, device)
+
+
+class QuestEvalMetric(object):
+    """
+    Wraps QuestEval in the same `predict_batch` interface as the repro models.
+    The source documents are truncated to the first `num_tokens` tokens.
+    """
+
+    def __init__(self, num_tokens: int = 512) -> None:
+        from questeval.questeval_metric import QuestEval
+        self.questeval = QuestEval(task="summarization", do_weighter=True, isCuda=True)
+        self.num_tokens = num_tokens
+
+    def predict_batch(self, inputs: List[Dict]) -> Tuple[Dict, List[Dict]]:
+        import numpy as np
+        from tqdm import tqdm
+
+        micro = []
+        for inp in tqdm(inputs, desc="QuestEval"):
+            source = inp["sources"][0]
+            truncated_source = " ".join(source.split()[:self.num_tokens])
+            score_dict = self.questeval.compute_all(
+                hypothesis=inp["candidate"],
+                source=truncated_source
+            )
+            micro.append({"questeval": score_dict["scores"]["fscore"]})
+        macro = {"questeval": np.mean([scores["questeval"] for scores in micro])}
+        return macro, micro
+
+
+def _load_rouge(language: str, device: int):
+    from repro.models.lin2004 import ROUGE
+    return ROUGE()
+
+
+def _load_bertscore(language: str, device: int):
+    from repro.models.zhang2020 import BERTScore
+    return BERTScore(device=device)
+
+
+def _load_qaeval(language: str, device: int):
+    from repro.models.deutsch2021 import QAEval
+    return QAEval(device=device)
+
+
+def _load_questeval(language: str, device: int):
+    return QuestEvalMetric()
+
+
+def _load_blanc(language: str, device: int):
+    from repro.models.vasilyev2020 import BLANCHelp
+    return BLANCHelp(device=device)
+
+
+register_backend("rouge", _load_rouge)
+register_backend("bertscore", _load_bertscore)
+register_backend("qaeval", _load_qaeval)
+register_backend("questeval", _load_questeval, in_process=True)
+register_backend("blanc", _load_blanc)
+
+register_metric("rouge", "rouge", None, references=True)
+register_metric("bertscore", "bertscore", "bertscore", references=True)
+register_metric("qaeval", "qaeval", "qa-eval", references=True)
+register_metric("questeval", "questeval", "questeval", sources=True)
+register_metric("blanc", "blanc", "blanc-help", sources=True)
@@ -1,11 +1,16 @@
 import argparse
 import json
 import os
+import sys
 from nltk.tokenize import sent_tokenize
 from tqdm import tqdm
 
 from questeval.questeval_metric import QuestEval
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+
 
 def main(args):
     num_tokens = 512
@@ -15,8 +20,8 @@ def main(args):
     seen = set()
 
     os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
-    with open(args.output_file, "w") as out:
-        with open(args.input_file, "r") as f:
+    with chunked_io.open_file(args.output_file, "w") as out:
+        with chunked_io.open_file(args.input_file, "r") as f:
             for line in tqdm(f):
                 instance = json.loads(line)
                 instance_id = instance["instance_id"]
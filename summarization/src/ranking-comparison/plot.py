@@ -3,11 +3,15 @@ import json
 import math
 import matplotlib.pyplot as plt
 import os
+import sys
 from collections import defaultdict
 from glob import glob
 from matplotlib.lines import Line2D
 from typing import Dict, List
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+
 DATASETS = ["fabbri2021", "bhandari2020"]
 NAMES = {
     "fabbri2021": "SummEval",
@@ -41,14 +45,15 @@ def _load_submission_scores(input_dir: str):
     for dataset in DATASETS:
         dataset_file = f"{input_dir}/{dataset}.jsonl"
 
-        with open(dataset_file, "r") as f:
+        with chunked_io.open_file(dataset_file, "r") as f:
             for line in f:
                 data = json.loads(line)
                 system = data["system"]
                 scores_dict[dataset][system] = _get_metrics(data["metrics"], dataset)
 
         ref_file = f"{input_dir}/{dataset}-references-scores.json"
-        data = json.load(open(ref_file, "r"))
+        with chunked_io.open_file(ref_file, "r") as f:
+            data = json.load(f)
         scores_dict[dataset]["reference"] = _get_metrics(data["metrics"], dataset)
 
     return scores_dict
@@ -58,7 +63,8 @@ def _load_questeval_scores(input_dir: str):
     scores_dict = {}
     for dataset_dir in glob(f"{input_dir}/*"):
         dataset = os.path.basename(dataset_dir)
-        data = json.load(open(f"{dataset_dir}/scores.json", "r"))
+        with chunked_io.open_file(f"{dataset_dir}/scores.json", "r") as f:
+            data = json.load(f)
         scores_dict[dataset] = _get_metrics(data["metrics"], dataset)
     return scores_dict
 
@@ -66,9 +72,8 @@ def _load_questeval_scores(input_dir: str):
 def _load_rerank_scores(input_dir: str, metric: str):
     scores_dict = {}
     for dataset in DATASETS:
-        scores = json.load(
-            open(f"{input_dir}/{dataset}/standard/16/{metric}/scores.json", "r")
-        )
+        with chunked_io.open_file(f"{input_dir}/{dataset}/standard/16/{metric}/scores.json", "r") as f:
+            scores = json.load(f)
         scores_dict[dataset] = _get_metrics(scores["metrics"], dataset)
     return scores_dict
 
@@ -0,0 +1,191 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import chunked_io
+import metric_daemon
+import metrics
+import nbest_store
+import score_cache
+
+# The n-best lists are in order of the model's score, so the "model" stage
+# keeps the first k summaries without running a metric
+MODEL_STAGE = "model"
+
+
+def _parse_stages(specs: List[str]) -> List[Tuple[str, int]]:
+    # Each stage is "name:k", which keeps the k best summaries by that metric
+    stages = []
+    for spec in specs:
+        name, k = spec.split(":")
+        if name != MODEL_STAGE:
+            metric = metrics.METRICS.get(name)
+            if metric is None or not metric.sources or metric.references:
+                raise Exception(f"Reranking requires a reference-free metric: {name}")
+        stages.append((name, int(k)))
+    assert stages[-1][0] != MODEL_STAGE, "The last stage must be a metric"
+    return stages
+
+
+def _load_instances(input_file: str, pred_file: str) -> List[Dict]:
+    sources = {}
+    with chunked_io.open_file(input_file, "r") as f:
+        for line in f:
+            data = json.loads(line)
+            instance_id = data["instance_id"]
+            if instance_id in sources:
+                continue
+            if "document" in data:
+                sources[instance_id] = data["document"]["text"]
+            else:
+                sources[instance_id] = data["documents"][0]["text"]
+
+    instances = []
+    if nbest_store.is_store(pred_file):
+        store = nbest_store.NbestStore(pred_file)
+        for instance_id, nbest in zip(store.instance_ids, store.iter_nbest_lists()):
+            instances.append({"instance_id": instance_id, "source": sources[instance_id], "predictions": nbest})
+        return instances
+
+    with chunked_io.open_file(pred_file, "r") as f:
+        for line in f:
+            instance = json.loads(line)
+            instances.append({
+                "instance_id": instance["instance_id"],
+                "source": sources[instance["instance_id"]],
+                "predictions": [pred["prediction"] for pred in instance["predictions"]],
+            })
+    return instances
+
+
+def _score(
+    name: str,
+    instances: List[Dict],
+    candidates_list: List[List[int]],
+    cache: score_cache.ScoreCache,
+    args,
+) -> List[List[float]]:
+    # Scores the candidates (the indices of the summaries) of each instance
+    metric = metrics.METRICS[name]
+    inputs = []
+    for instance, candidates in zip(instances, candidates_list):
+        for j in candidates:
+            inputs.append({"sources": [instance["source"]], "candidate": instance["predictions"][j]})
+
+    # The same cache names as score.py so scores are shared between them
+    micro = score_cache.cached_predict_batch(
+        cache, metric.backend, None, inputs,
+        lambda batch: batching.batched_predict_batch(
+            metric.backend, batch,
+            lambda inputs: metric_daemon.predict_batch(metric.backend, inputs, device=args.device),
+            max_tokens=args.max_tokens,
+        )
+    )
+
+    scores_list = []
+    index = 0
+    for candidates in candidates_list:
+        scores_list.append([micro[index + i][metric.key] for i in range(len(candidates))])
+        index += len(candidates)
+    return scores_list
+
+
+def _select(candidates: List[int], scores: List[float], k: int) -> List[int]:
+    # Keeps the k best candidates. The sort is stable, so ties are broken by
+    # the model's order
+    order = sorted(range(len(candidates)), key=lambda i: scores[i], reverse=True)
+    return [candidates[i] for i in order[:k]]
+
+
+def main(args):
+    stages = _parse_stages(args.cascade)
+    cache = None
+    if args.cache_dir is not None:
+        cache = score_cache.ScoreCache(args.cache_dir)
+
+    instances = _load_instances(args.input_file, args.pred_file)
+    num_summaries = sum(len(instance["predictions"]) for instance in instances)
+
+    # Each stage only scores the summaries which the previous stages kept
+    candidates_list = [list(range(len(instance["predictions"]))) for instance in instances]
+    report = {"num_instances": len(instances), "num_summaries": num_summaries, "stages": []}
+    for name, k in stages:
+        num_scored = 0
+        if name == MODEL_STAGE:
+            candidates_list = [candidates[:k] for candidates in candidates_list]
+        else:
+            scores_list = _score(name, instances, candidates_list, cache, args)
+            num_scored = sum(len(candidates) for candidates in candidates_list)
+            candidates_list = [
+                _select(candidates, scores, k)
+                for candidates, scores in zip(candidates_list, scores_list)
+            ]
+        report["stages"].append({"name": name, "k": k, "num_scored": num_scored})
+        print(f"{name}:{k}: scored {num_scored} / {num_summaries} summaries")
+    choices = [candidates[0] for candidates in candidates_list]
+
+    dirname = os.path.dirname(args.output_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(args.output_file, "w") as out:
+        for instance, choice in zip(instances, choices):
+            out.write(json.dumps({
+                "instance_id": instance["instance_id"],
+                "summarizer_id": "cascade-opt",
+                "summary": instance["predictions"][choice]
+            }) + "\n")
+
+    # Compare to reranking every summary with the last stage's metric. With
+    # --cache-dir, the cascade's scores are reused, so only the summaries
+    # which the cascade pruned are scored again
+    if args.exhaustive:
+        name = stages[-1][0]
+        all_candidates_list = [list(range(len(instance["predictions"]))) for instance in instances]
+        scores_list = _score(name, instances, all_candidates_list, cache, args)
+        exhaustive_choices = [int(np.argmax(scores)) for scores in scores_list]
+        # An n-best list can have the same summary more than once, so the
+        # summaries are compared instead of their indices
+        matches = [
+            instance["predictions"][choice] == instance["predictions"][exhaustive]
+            for instance, choice, exhaustive in zip(instances, choices, exhaustive_choices)
+        ]
+        report["match_rate"] = float(np.mean(matches))
+        report["cascade_score"] = float(np.mean([
+            scores[choice] for scores, choice in zip(scores_list, choices)
+        ]))
+        report["exhaustive_score"] = float(np.mean([
+            scores[choice] for scores, choice in zip(scores_list, exhaustive_choices)
+        ]))
+        print(
+            f"The cascade matched exhaustive {name} reranking on {report['match_rate'] * 100:.1f}% of instances "
+            f"({name}: {report['cascade_score']:.4f} vs. {report['exhaustive_score']:.4f})"
+        )
+
+    if args.report_file is not None:
+        with open(args.report_file, "w") as out:
+            out.write(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--input-file", required=True)
+    argp.add_argument("--pred-file", required=True)
+    # The stages as "name:k", where the name is "model" or a reference-free
+    # metric, e.g., "model:8 blanc:4 questeval:1"
+    argp.add_argument("--cascade", required=True, nargs="+")
+    argp.add_argument("--device", required=True, type=int)
+    argp.add_argument("--output-file", required=True)
+    argp.add_argument("--report-file")
+    # Also rerank every summary with the last stage's metric to measure how
+    # often the cascade picks the same summary
+    argp.add_argument("--exhaustive", action="store_true")
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--max-tokens", type=int)
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,155 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+from typing import Callable, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import chunked_io
+import mbr_utilities
+import metric_daemon
+import metrics
+import nbest_store
+import score_cache
+
+NGRAM_UTILITIES = ["bleu", "chrf"]
+NEURAL_UTILITIES = ["bertscore"]
+
+
+def _load_nbest_lists(pred_file: str) -> Tuple[List[str], List[List[str]]]:
+    if nbest_store.is_store(pred_file):
+        store = nbest_store.NbestStore(pred_file)
+        return list(store.instance_ids), list(store.iter_nbest_lists())
+    instance_ids = []
+    nbest_lists = []
+    with chunked_io.open_file(pred_file, "r") as f:
+        for line in f:
+            instance = json.loads(line)
+            instance_ids.append(instance["instance_id"])
+            nbest_lists.append([pred["prediction"] for pred in instance["predictions"]])
+    return instance_ids, nbest_lists
+
+
+def _ngram_utilities(nbest: List[str], utility: str) -> np.ndarray:
+    if utility == "bleu":
+        return mbr_utilities.pairwise_bleu([text.lower().split() for text in nbest])
+    return mbr_utilities.pairwise_chrf(nbest)
+
+
+def _get_predict_batch(utility: str, args) -> Callable:
+    if utility == "bertscore" and args.embedding_cache_dir is not None:
+        # Each summary is encoded once as a candidate and once as a reference
+        from bertscore_cache import CachedBERTScore
+        model = CachedBERTScore(args.embedding_cache_dir, device=args.device)
+        return model.predict_batch
+    return lambda batch: batching.batched_predict_batch(
+        utility, batch,
+        lambda inputs: metric_daemon.predict_batch(utility, inputs, device=args.device),
+        max_tokens=args.max_tokens,
+    )
+
+
+def _neural_utilities(
+    nbest_lists: List[List[str]],
+    utility: str,
+    predict_batch: Callable,
+    cache: score_cache.ScoreCache,
+    args,
+) -> List[np.ndarray]:
+    # Every pair of summaries in the n-best lists is scored in one call so the
+    # metric can batch them. Repeated pairs (from duplicate summaries) are
+    # scored once, and BERTScore's F1 is symmetric, so it only needs one
+    # direction of each pair
+    metric = metrics.METRICS[utility]
+    symmetric = utility == "bertscore"
+    pair_to_index = {}
+    inputs = []
+    for nbest in nbest_lists:
+        for i, candidate in enumerate(nbest):
+            for j, reference in enumerate(nbest):
+                pair = (candidate, reference)
+                if symmetric:
+                    pair = tuple(sorted(pair))
+                if i != j and pair not in pair_to_index:
+                    pair_to_index[pair] = len(inputs)
+                    inputs.append({"candidate": pair[0], "references": [pair[1]]})
+
+    name = "bertscore-cached" if utility == "bertscore" and args.embedding_cache_dir is not None else metric.backend
+    micro = score_cache.cached_predict_batch(cache, name, None, inputs, predict_batch)
+
+    utilities_list = []
+    for nbest in nbest_lists:
+        utilities = np.zeros((len(nbest), len(nbest)))
+        for i, candidate in enumerate(nbest):
+            for j, reference in enumerate(nbest):
+                if i == j:
+                    continue
+                pair = (candidate, reference)
+                if symmetric:
+                    pair = tuple(sorted(pair))
+                value = micro[pair_to_index[pair]][metric.key]
+                utilities[i, j] = value["f1"] if isinstance(value, dict) else value
+        utilities_list.append(utilities)
+    return utilities_list
+
+
+def main(args):
+    instance_ids, nbest_lists = _load_nbest_lists(args.pred_file)
+
+    utilities_list = []
+    if args.utility in NGRAM_UTILITIES:
+        for nbest in nbest_lists:
+            utilities_list.append(_ngram_utilities(nbest, args.utility))
+    else:
+        cache = None
+        if args.cache_dir is not None:
+            cache = score_cache.ScoreCache(args.cache_dir)
+        predict_batch = _get_predict_batch(args.utility, args)
+        for i in range(0, len(nbest_lists), args.chunk_size):
+            utilities_list.extend(_neural_utilities(
+                nbest_lists[i:i + args.chunk_size], args.utility, predict_batch, cache, args
+            ))
+
+    selected = []
+    before = []
+    after = []
+    for utilities in utilities_list:
+        expected = mbr_utilities.expected_utility(utilities)
+        index = int(np.argmax(expected))
+        selected.append(index)
+        before.append(expected[0])
+        after.append(expected[index])
+
+    dirname = os.path.dirname(args.output_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with chunked_io.open_file(args.output_file, "w") as out:
+        for instance_id, nbest, index in zip(instance_ids, nbest_lists, selected):
+            out.write(json.dumps({
+                "instance_id": instance_id,
+                "summarizer_id": f"mbr-{args.utility}-opt",
+                "summary": nbest[index]
+            }) + "\n")
+
+    num_changed = sum(index != 0 for index in selected)
+    print(f"MBR with {args.utility} changed {num_changed} / {len(selected)} selections")
+    print(f"Expected {args.utility}: {np.mean(before):.4f} -> {np.mean(after):.4f}")
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--pred-file", required=True)
+    argp.add_argument("--utility", required=True, choices=NGRAM_UTILITIES + NEURAL_UTILITIES)
+    argp.add_argument("--output-file", required=True)
+    # The device is only used by the neural utilities
+    argp.add_argument("--device", type=int, default=0)
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--embedding-cache-dir", default=os.environ.get("EMBEDDING_CACHE_DIR"))
+    argp.add_argument("--max-tokens", type=int)
+    # The number of n-best lists whose pairs are scored in one call
+    argp.add_argument("--chunk-size", type=int, default=100)
+    args = argp.parse_args()
+    main(args)
@@ -2,77 +2,186 @@ import argparse
 import json
 import numpy as np
 import os
+import sys
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+import metrics
+import nbest_store
+
+# Selects the first prediction of each n-best list, which is the model's best
+STANDARD = "standard"
+
+# Ties are broken by these metrics' scores and then by the model's ranking,
+# the same as the original script, which sorted each n-best list by
+# QuestEval before sorting it by BLANC
+TIE_BREAKERS = ["questeval"]
+
+# The printed scores are multiplied by these factors, so QuestEval is shown as
+# a percentage. The report file has the unscaled scores
+PRINT_SCALES = {"questeval": 100}
+
+
+def _get_score(prediction: Dict, name: str) -> float:
+    # The scores of metrics with several outputs are saved as dicts
+    value = prediction[name]
+    if isinstance(value, dict):
+        value = value[metrics.METRICS[name].key]
+    return value
+
+
+def _load_scores(score_file: str) -> Tuple[List[str], List[str], np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Reads the n-best lists in one pass into the instance IDs, the flat list
+    of predictions, the offsets of each n-best list (so the i-th list is
+    `offsets[i]:offsets[i + 1]`), and a flat array of scores for every metric.
+    The score file can also be an n-best store (see `nbest_store.py`), whose
+    arrays are memory-mapped
+    """
+    if nbest_store.is_store(score_file):
+        # Nothing is parsed, and only the selected predictions are decoded
+        store = nbest_store.NbestStore(score_file)
+        return store.instance_ids, store.predictions, np.asarray(store.offsets), dict(store.scores)
+
+    instance_ids = []
+    predictions = []
+    lengths = []
+    scores = None
+    with chunked_io.open_file(score_file, "r") as f:
+        for line in f:
+            instance = json.loads(line)
+            nbest = instance["predictions"]
+            assert len(nbest) > 0, "Every n-best list must have at least one prediction"
+            if scores is None:
+                scores = {name: [] for name in nbest[0] if name != "prediction"}
+            instance_ids.append(instance["instance_id"])
+            lengths.append(len(nbest))
+            for prediction in nbest:
+                predictions.append(prediction["prediction"])
+                for name, values in scores.items():
+                    values.append(_get_score(prediction, name))
+
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    scores = {name: np.array(values, dtype=np.float64) for name, values in (scores or {}).items()}
+    return instance_ids, predictions, offsets, scores
+
+
+def _check_segments(offsets: np.ndarray) -> None:
+    if np.any(np.diff(offsets) == 0):
+        raise Exception("Every n-best list must have at least one prediction")
+
+
+def segment_argmax(values: np.ndarray, offsets: np.ndarray, tie_breakers: List[np.ndarray] = ()) -> np.ndarray:
+    """
+    Returns the index of the maximum of each segment of `values`. Ties are
+    broken by the highest value of each of `tie_breakers` in order, and then
+    in favor of the model's ranking (the first index).
+    """
+    _check_segments(offsets)
+    segment_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    # lexsort sorts by the last key first and is stable, so the first index of
+    # each segment in the order is its maximum
+    order = np.lexsort([-key for key in reversed(tie_breakers)] + [-values, segment_ids])
+    return order[offsets[:-1]]
+
+
+def segment_ranks(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Returns the rank of each value within its segment, where 0 is the highest"""
+    segment_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    # lexsort sorts by the last key first and is stable, so tied values are
+    # ranked in the model's order
+    order = np.lexsort((-values, segment_ids))
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[order] = np.arange(len(values)) - offsets[segment_ids[order]]
+    return ranks
+
+
+def _parse_objective(spec: str) -> Tuple[str, Dict[str, float]]:
+    # "standard", a metric ("questeval"), a weighted combination of metrics
+    # ("questeval=0.5,blanc=0.5"), or the average of the metrics' ranks
+    # within each n-best list ("rank:questeval,blanc")
+    if spec == STANDARD:
+        return STANDARD, {}
+    if spec.startswith("rank:"):
+        return "rank", {name: 1.0 for name in spec[len("rank:"):].split(",")}
+    if "=" in spec:
+        weights = {}
+        for item in spec.split(","):
+            name, weight = item.split("=")
+            weights[name] = float(weight)
+        return "weighted", weights
+    return "weighted", {spec: 1.0}
+
+
+def _select(spec: str, offsets: np.ndarray, scores: Dict[str, np.ndarray]) -> np.ndarray:
+    kind, weights = _parse_objective(spec)
+    for name in weights:
+        if name not in scores:
+            raise Exception(f"The score file does not have {name} scores")
+
+    if kind == STANDARD:
+        _check_segments(offsets)
+        return offsets[:-1]
+    if kind == "rank":
+        values = -sum(weight * segment_ranks(scores[name], offsets) for name, weight in weights.items())
+    else:
+        values = sum(weight * scores[name] for name, weight in weights.items())
+    tie_breakers = [scores[name] for name in TIE_BREAKERS if name in scores]
+    return segment_argmax(values, offsets, tie_breakers)
 
 
 def main(args):
-    questeval_before = []
-    questeval_after = []
-    blanc_before = []
-    blanc_after = []
-
-    os.makedirs(os.path.dirname(args.standard_file), exist_ok=True)
-    os.makedirs(os.path.dirname(args.questeval_file), exist_ok=True)
-    os.makedirs(os.path.dirname(args.blanc_file), exist_ok=True)
-
-    with open(args.standard_file, "w") as out_standard:
-        with open(args.questeval_file, "w") as out_questeval:
-            with open(args.blanc_file, "w") as out_blanc:
-                with open(args.score_file, "r") as f:
-                    for line in f:
-                        instance = json.loads(line)
-                        instance_id = instance["instance_id"]
-
-                        predictions = instance["predictions"]
-                        out_standard.write(json.dumps({
-                            "instance_id": instance_id,
-                            "summarizer_id": "standard-opt",
-                            "summary": predictions[0]["prediction"]
-                        }) + "\n")
-                        questeval_before.append(predictions[0]["questeval"])
-                        blanc_before.append(predictions[0]["blanc"])
-
-                        predictions.sort(
-                            key=lambda pred: pred["questeval"], reverse=True
-                        )
-                        out_questeval.write(json.dumps({
-                            "instance_id": instance_id,
-                            "summarizer_id": "questeval-opt",
-                            "summary": predictions[0]["prediction"]
-                        }) + "\n")
-                        questeval_after.append(predictions[0]["questeval"])
-
-                        predictions.sort(
-                            key=lambda pred: pred["blanc"],
-                            reverse=True,
-                        )
-                        out_blanc.write(json.dumps({
-                            "instance_id": instance_id,
-                            "summarizer_id": "blanc-opt",
-                            "summary": predictions[0]["prediction"]
-                        }) + "\n")
-                        blanc_after.append(predictions[0]["blanc"])
-
-    questeval_before = np.mean(questeval_before) * 100
-    questeval_after = np.mean(questeval_after) * 100
-    questeval_improvement = (questeval_after - questeval_before) / questeval_before * 100
-
-    blanc_before = np.mean(blanc_before)
-    blanc_after = np.mean(blanc_after)
-    blanc_improvement = (blanc_after - blanc_before) / blanc_before * 100
-
-    print(
-        f"QuestEval: {np.mean(questeval_before):.4f} -> {np.mean(questeval_after):.4f} (+{questeval_improvement:.2f}%)"
-    )
-    print(
-        f"BLANC: {np.mean(blanc_before):.4f} -> {np.mean(blanc_after):.4f} (+{blanc_improvement:.2f}%)"
-    )
+    objectives = list(args.objective or [])
+    for spec, output_file in [
+        (STANDARD, args.standard_file),
+        ("questeval", args.questeval_file),
+        ("blanc", args.blanc_file),
+    ]:
+        if output_file is not None:
+            objectives.append((spec, output_file))
+
+    instance_ids, predictions, offsets, scores = _load_scores(args.score_file)
+    before = {name: float(np.mean(values[offsets[:-1]])) for name, values in scores.items()}
+
+    report = {}
+    for spec, output_file in objectives:
+        selected = _select(spec, offsets, scores)
+
+        dirname = os.path.dirname(output_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with chunked_io.open_file(output_file, "w") as out:
+            for instance_id, index in zip(instance_ids, selected):
+                out.write(json.dumps({
+                    "instance_id": instance_id,
+                    "summarizer_id": f"{spec}-opt",
+                    "summary": predictions[index]
+                }) + "\n")
+
+        report[spec] = {}
+        for name, values in scores.items():
+            after = float(np.mean(values[selected]))
+            improvement = (after - before[name]) / abs(before[name]) * 100
+            report[spec][name] = {"before": before[name], "after": after}
+            scale = PRINT_SCALES.get(name, 1)
+            print(f"{spec}: {name} {before[name] * scale:.4f} -> {after * scale:.4f} ({improvement:+.2f}%)")
+
+    if args.report_file is not None:
+        with open(args.report_file, "w") as out:
+            out.write(json.dumps(report, indent=2))
 
 
 if __name__ == "__main__":
     argp = argparse.ArgumentParser()
     argp.add_argument("--score-file", required=True)
-    argp.add_argument("--standard-file", required=True)
-    argp.add_argument("--questeval-file", required=True)
-    argp.add_argument("--blanc-file", required=True)
+    # Any number of objectives can be selected from one read of the scores,
+    # each as "--objective SPEC OUTPUT_FILE" (see `_parse_objective`)
+    argp.add_argument("--objective", nargs=2, action="append")
+    argp.add_argument("--standard-file")
+    argp.add_argument("--questeval-file")
+    argp.add_argument("--blanc-file")
+    argp.add_argument("--report-file")
     args = argp.parse_args()
     main(args)
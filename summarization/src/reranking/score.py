@@ -1,71 +1,159 @@
 import argparse
 import json
-from questeval.questeval_metric import QuestEval
-from repro.models.vasilyev2020 import BLANCHelp
+import os
+import sys
 from tqdm import tqdm
-from typing import Dict
+from typing import Dict, Iterator, List, Tuple
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import checkpoint
+import chunked_io
+import metric_daemon
+import score_cache
 
-def _load_sources(input_file: str) -> Dict[str, str]:
-    sources = {}
-    with open(input_file, "r") as f:
-        for line in f:
-            data = json.loads(line)
-            instance_id = data["instance_id"]
-            if instance_id in sources:
-                continue
-            if "document" in data:
-                sources[instance_id] = data["document"]["text"]
-            else:
-                sources[instance_id] = data["documents"][0]["text"]
-    return sources
+# The backend of each score in the output and the field of its scores
+METRICS = {
+    "questeval": ("questeval", "questeval"),
+    "blanc": ("blanc", "blanc-help"),
+}
 
 
-def main(args):
-    num_tokens = 512
-    questeval = QuestEval(task="summarization", do_weighter=True, isCuda=True)
+def _index_sources(input_file: str) -> Dict[str, Tuple[int, int]]:
+    # Only the position of each instance's first line is kept so the
+    # documents are read when they are needed instead of all being in memory
+    positions = {}
+    for start, end, line in chunked_io.iter_positions(input_file):
+        instance_id = json.loads(line)["instance_id"]
+        if instance_id not in positions:
+            positions[instance_id] = (start, end)
+    return positions
 
-    sources = _load_sources(args.input_file)
-    instances = []
-    inputs = []
-    with open(args.pred_file, "r") as f:
-        for line in tqdm(f):
-            instance = json.loads(line)
-            instances.append(instance)
 
-            instance_id = instance["instance_id"]
-            source = sources[instance_id]
-            truncated_source = " ".join(source.split()[:num_tokens])
+def _read_source(reader: chunked_io.LineReader, position: Tuple[int, int]) -> str:
+    data = json.loads(reader.read(*position)[0])
+    if "document" in data:
+        return data["document"]["text"]
+    return data["documents"][0]["text"]
 
-            for pred_dict in instance["predictions"]:
-                prediction = pred_dict["prediction"]
-                score_dict = questeval.compute_all(
-                    hypothesis=prediction,
-                    source=truncated_source
-                )
-                pred_dict["questeval"] = score_dict["scores"]["fscore"]
 
-                inputs.append({"sources": [source], "candidate": pred_dict["prediction"]})
+def _read_chunks(pred_files: List[str], chunk_size: int) -> Iterator[List[List[str]]]:
+    # Yields the next `chunk_size` lines of every prediction file, which are
+    # the n-best lists for the same instances
+    files = [chunked_io.open_file(pred_file, "r") for pred_file in pred_files]
+    chunk = []
+    for lines in zip(*files):
+        chunk.append(lines)
+        if len(chunk) == chunk_size:
+            yield [list(lines) for lines in zip(*chunk)]
+            chunk = []
+    if len(chunk) > 0:
+        yield [list(lines) for lines in zip(*chunk)]
+    for f in files:
+        f.close()
 
-    blanc = BLANCHelp(device=args.device)
-    _, blanc_scores = blanc.predict_batch(inputs)
 
-    index = 0
-    for instance in instances:
-        for prediction in instance["predictions"]:
-            prediction["blanc"] = blanc_scores[index]["blanc-help"]
-            index += 1
+def _score(instances_list: List[List[Dict]], sources: Dict[str, str], cache, args) -> None:
+    """
+    Scores the n-best lists of every beam size for the same instances.
+    `instances_list[j]` are the instances from the j-th prediction file.
+    The larger beams mostly repeat the summaries of the smaller ones, and
+    the n-best lists can contain duplicate summaries, so each unique
+    (instance, summary) pair is only scored once.
+    """
+    pair_to_index = {}
+    inputs = []
+    num_summaries = 0
+    for instances in instances_list:
+        for instance in instances:
+            instance_id = instance["instance_id"]
+            for pred_dict in instance["predictions"]:
+                num_summaries += 1
+                pair = (instance_id, pred_dict["prediction"])
+                if pair not in pair_to_index:
+                    pair_to_index[pair] = len(inputs)
+                    inputs.append({"sources": [sources[instance_id]], "candidate": pred_dict["prediction"]})
+    print(f"Scoring {len(inputs)} unique summaries out of {num_summaries}")
+
+    scores = {}
+    for key, (name, _) in METRICS.items():
+        scores[key] = score_cache.cached_predict_batch(
+            cache, name, None, inputs,
+            lambda batch, name=name: batching.batched_predict_batch(
+                name, batch,
+                lambda inputs: metric_daemon.predict_batch(name, inputs, device=args.device),
+                max_tokens=args.max_tokens,
+            )
+        )
 
-    with open(args.output_file, "w") as out:
+    for instances in instances_list:
         for instance in instances:
-            out.write(json.dumps(instance) + "\n")
+            for prediction in instance["predictions"]:
+                index = pair_to_index[(instance["instance_id"], prediction["prediction"])]
+                for key, (_, field) in METRICS.items():
+                    prediction[key] = scores[key][index][field]
+
+
+def main(args):
+    assert len(args.pred_file) == len(args.output_file)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = score_cache.ScoreCache(args.cache_dir)
+
+    source_positions = _index_sources(args.input_file)
+
+    # Each chunk is appended to the output files once it has been scored, so
+    # a restarted run continues after the last completed chunk. Everything
+    # which changes the scores is in the config so a different run starts over
+    config = {
+        "input_file": checkpoint.get_file_info(args.input_file),
+        "pred_files": [checkpoint.get_file_info(pred_file) for pred_file in args.pred_file],
+        "chunk_size": args.chunk_size,
+        "metrics": [[key, name, field] for key, (name, field) in METRICS.items()],
+        "max_tokens": args.max_tokens,
+    }
+    manifests = [checkpoint.ProgressManifest(output_file, config) for output_file in args.output_file]
+    num_completed = min(manifest.num_completed for manifest in manifests)
+
+    with chunked_io.LineReader(args.input_file) as reader:
+        for index, lines_list in enumerate(tqdm(_read_chunks(args.pred_file, args.chunk_size))):
+            if index < num_completed:
+                continue
+            instances_list = [[json.loads(line) for line in lines] for lines in lines_list]
+            sources = {}
+            for instances in instances_list:
+                for instance in instances:
+                    instance_id = instance["instance_id"]
+                    if instance_id not in sources:
+                        sources[instance_id] = _read_source(reader, source_positions[instance_id])
+
+            _score(instances_list, sources, cache, args)
+            for manifest, instances in zip(manifests, instances_list):
+                # An output file may already have the chunk if the last run
+                # stopped while the chunk was being written
+                if manifest.num_completed == index:
+                    manifest.append([json.dumps(instance) for instance in instances])
+
+    for manifest in manifests:
+        manifest.close()
 
 
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument("--input-file", required=True)
-    argp.add_argument("--pred-file", required=True)
+    # The n-best lists of every beam size for the same inputs can be scored
+    # together, which scores the summaries they share once. There is one
+    # output file per prediction file
+    argp.add_argument("--pred-file", required=True, nargs="+")
     argp.add_argument("--device", required=True, type=int)
-    argp.add_argument("--output-file", required=True)
+    argp.add_argument("--output-file", required=True, nargs="+")
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--max-tokens", type=int)
+    # The number of instances which are scored before they are written. BLANC
+    # starts a Docker container and loads the model for every chunk, so larger
+    # chunks start it less often but lose more work when a run is interrupted
+    argp.add_argument("--chunk-size", type=int, default=100)
     args = argp.parse_args()
     main(args)
\ No newline at end of file
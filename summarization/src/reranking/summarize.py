@@ -1,19 +1,30 @@
 import argparse
 import json
-from repro.models.lewis2020 import BART
+import os
+import sys
+from tqdm import tqdm
+from typing import Dict, List, Tuple
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import batching
+import chunked_io
+import generation
 
-def main(args):
-    model = BART(
-        nbest=args.beam_size,
-        beam_size=args.beam_size,
-        device=args.device
-    )
+# The same generation parameters as repro's BART model for CNN/DailyMail
+_GENERATION_ARGS = {
+    "lenpen": 2.0,
+    "max_len_b": 140,
+    "min_len": 55,
+    "no_repeat_ngram_size": 3,
+}
 
+
+def _load_instances(input_file: str) -> List[Dict]:
     # Keep track of the instance_ids that we've seen
     seen = set()
     instances = []
-    with open(args.input_file, "r") as f:
+    with chunked_io.open_file(input_file, "r") as f:
         for line in f:
             data = json.loads(line)
             instance_id = data["instance_id"]
@@ -30,28 +41,114 @@ def main(args):
                 "instance_id": instance_id,
                 "document": source,
             })
+    return instances
+
+
+def _summarize(instances: List[Dict], beam_size: int, device: int) -> List[List[str]]:
+    from repro.models.lewis2020 import BART
 
+    model = BART(
+        nbest=beam_size,
+        beam_size=beam_size,
+        device=device
+    )
     summaries_list = model.predict_batch(instances)
+    if beam_size == 1:
+        summaries_list = [[summaries] for summaries in summaries_list]
+    return summaries_list
 
-    with open(args.output_file, "w") as out:
-        for instance, summaries in zip(instances, summaries_list):
-            instance_id = instance["instance_id"]
-            if args.beam_size == 1:
-                summaries = [summaries]
 
-            out.write(json.dumps({
-                "instance_id": instance_id,
-                "predictions": [
-                    {"prediction": summary} for summary in summaries
-                ]
-            }) + "\n")
+def _summarize_sweep(
+    instances: List[Dict],
+    beam_sizes: List[int],
+    device: int,
+    max_tokens: int,
+) -> Tuple[Dict[int, List[List[str]]], Dict[int, List[List[Dict]]]]:
+    # Runs BART in-process so it is only loaded once and each batch of
+    # documents is encoded once for all of the beam sizes
+    import torch
+
+    bart = torch.hub.load("pytorch/fairseq", "bart.large.cnn")
+    bart.eval()
+    bart.to(torch.device(f"cuda:{device}" if device >= 0 else "cpu"))
+
+    sources_bin = [bart.encode(instance["document"]) for instance in instances]
+    lengths = [source_bin.numel() for source_bin in sources_bin]
+    # The budget is reduced if a batch runs out of memory
+    batcher = batching.AdaptiveBatcher("Document batches", max(max_tokens // max(beam_sizes), 1))
+    progress = tqdm(total=len(instances))
+
+    summaries_lists = {beam_size: [None] * len(instances) for beam_size in beam_sizes}
+    details_lists = {beam_size: [None] * len(instances) for beam_size in beam_sizes}
+
+    def _process_batch(batch: List[int]) -> None:
+        sample = generation.build_sample(bart, [sources_bin[i] for i in batch])
+        prefix_tokens = sample["net_input"]["src_tokens"].new_full(
+            (len(batch), 1), bart.task.source_dictionary.bos()
+        )
+        predictions_dict = generation.generate_sweep(
+            bart, [bart.model], sample, beam_sizes, prefix_tokens=prefix_tokens, **_GENERATION_ARGS
+        )
+        for beam_size, predictions_list in predictions_dict.items():
+            for i, predictions in zip(batch, predictions_list):
+                summaries_lists[beam_size][i] = [bart.decode(pred["tokens"]) for pred in predictions]
+                details_lists[beam_size][i] = [generation.get_details(pred) for pred in predictions]
+        progress.update(len(batch))
+
+    batcher.run(lengths, _process_batch)
+    progress.close()
+    batcher.print()
+    return summaries_lists, details_lists
+
+
+def main(args):
+    assert len(args.beam_size) == len(args.output_file)
+    if args.details_file is not None:
+        assert len(args.beam_size) == len(args.details_file)
+    instances = _load_instances(args.input_file)
+
+    # repro does not return the model scores, so saving the details
+    # also requires running BART in-process
+    if len(args.beam_size) == 1 and args.details_file is None:
+        summaries_lists = {
+            args.beam_size[0]: _summarize(instances, args.beam_size[0], args.device)
+        }
+    else:
+        summaries_lists, details_lists = _summarize_sweep(
+            instances, args.beam_size, args.device, args.max_tokens
+        )
+
+    for beam_size, output_file in zip(args.beam_size, args.output_file):
+        dirname = os.path.dirname(output_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with chunked_io.open_file(output_file, "w") as out:
+            for instance, summaries in zip(instances, summaries_lists[beam_size]):
+                out.write(json.dumps({
+                    "instance_id": instance["instance_id"],
+                    "predictions": [
+                        {"prediction": summary} for summary in summaries
+                    ]
+                }) + "\n")
+
+    # The model scores, token ids, and token log-probabilities are saved in
+    # the same order as the summaries
+    if args.details_file is not None:
+        for beam_size, details_file in zip(args.beam_size, args.details_file):
+            generation.save_details(details_file, details_lists[beam_size])
 
 
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument("--input-file", required=True)
-    argp.add_argument("--beam-size", required=True, type=int)
+    # One output file per beam size. With more than one beam size, BART is
+    # run in-process and every beam size is generated in the same job
+    argp.add_argument("--beam-size", required=True, type=int, nargs="+")
     argp.add_argument("--device", required=True, type=int)
-    argp.add_argument("--output-file", required=True)
+    argp.add_argument("--output-file", required=True, nargs="+")
+    argp.add_argument("--details-file", nargs="+")
+    # The maximum number of document tokens times the beam size in one batch
+    argp.add_argument("--max-tokens", type=int, default=16384)
     args = argp.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -1,11 +1,17 @@
 import argparse
 import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
 
 
 def main(args):
     seen = set()
-    with open(args.output_file, "w") as out:
-        with open(args.input_file, "r") as f:
+    with chunked_io.open_file(args.output_file, "w") as out:
+        with chunked_io.open_file(args.input_file, "r") as f:
             for line in f:
                 data = json.loads(line)
                 instance_id = data["instance_id"]
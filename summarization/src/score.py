@@ -1,19 +1,22 @@
 import argparse
 import json
-import numpy as np
 import os
+import sys
 from collections import defaultdict
-from questeval.questeval_metric import QuestEval
-from repro.models.deutsch2021 import QAEval
-from repro.models.lin2004 import ROUGE
-from repro.models.vasilyev2020 import BLANCHelp
-from repro.models.zhang2020 import BERTScore
-from typing import Dict, List, Tuple
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import batching
+import chunked_io
+import metric_daemon
+import metrics
+import score_cache
 
 
 def _load_sources(input_file: str) -> Dict[str, str]:
     sources = {}
-    with open(input_file, "r") as f:
+    with chunked_io.open_file(input_file, "r") as f:
         for line in f:
             data = json.loads(line)
             instance_id = data["instance_id"]
@@ -28,7 +31,7 @@ def _load_sources(input_file: str) -> Dict[str, str]:
 
 def _load_references(input_file: str) -> Dict[str, str]:
     references = {}
-    with open(input_file, "r") as f:
+    with chunked_io.open_file(input_file, "r") as f:
         for line in f:
             data = json.loads(line)
             instance_id = data["instance_id"]
@@ -40,7 +43,7 @@ def _load_references(input_file: str) -> Dict[str, str]:
 
 def _load_candidates(input_file: str) -> Dict[str, Dict[str, str]]:
     candidates = defaultdict(dict)
-    with open(input_file, "r") as f:
+    with chunked_io.open_file(input_file, "r") as f:
         for line in f:
             data = json.loads(line)
             system = data["summarizer_id"]
@@ -92,6 +95,36 @@ def _convert_to_inputs(
     return inputs, inputs_ref, inputs_src
 
 
+@lru_cache()
+def _load_cached_bertscore(cache_dir: str, device: int, max_tokens: int):
+    from bertscore_cache import CachedBERTScore
+    kwargs = {} if max_tokens is None else {"max_tokens": max_tokens}
+    return CachedBERTScore(cache_dir, device=device, **kwargs)
+
+
+def _get_predict_batch(name: str, args) -> Callable:
+    if name == "bertscore-cached":
+        return _load_cached_bertscore(args.embedding_cache_dir, args.device, args.max_tokens).predict_batch
+    # The inputs are sorted by length and split under the token budget
+    return lambda batch: batching.batched_predict_batch(
+        name, batch,
+        lambda inputs: metric_daemon.predict_batch(name, inputs, device=args.device),
+        max_tokens=args.max_tokens,
+    )
+
+
+def _score(
+    name: str,
+    args,
+    cache: score_cache.ScoreCache,
+    inputs: List[Dict],
+) -> Dict:
+    micro = score_cache.cached_predict_batch(
+        cache, name, None, inputs, _get_predict_batch(name, args)
+    )
+    return batching.aggregate_scores(micro)
+
+
 def main(args):
     sources = None
     if args.source_file:
@@ -103,60 +136,42 @@ def main(args):
 
     candidates_dict = _load_candidates(args.candidate_file)
 
-    metrics = defaultdict(dict)
+    cache = None
+    if args.cache_dir is not None:
+        cache = score_cache.ScoreCache(args.cache_dir)
+
+    scores = defaultdict(dict)
     for system, candidates in candidates_dict.items():
         inputs, inputs_ref, inputs_src = _convert_to_inputs(
             candidates, references, sources
         )
 
-        if args.rouge:
-            assert references is not None
-            metric = ROUGE()
-            macro, _ = metric.predict_batch(inputs_ref)
-            metrics[system]["rouge"] = macro
-
-        if args.bertscore:
-            assert references is not None
-            metric = BERTScore(device=args.device)
-            macro, _ = metric.predict_batch(inputs_ref)
-            metrics[system]["bertscore"] = macro["bertscore"]
-
-        if args.qaeval:
-            assert references is not None
-            metric = QAEval(device=args.device)
-            macro, _ = metric.predict_batch(inputs_ref)
-            metrics[system]["qaeval"] = macro["qa-eval"]
-
-        if args.questeval:
-            assert sources is not None
-            num_tokens = 512
-            questeval = QuestEval(task="summarization", do_weighter=True, isCuda=True)
-
-            scores = []
-            for inp in inputs_src:
-                candidate = inp["candidate"]
-                source = inp["sources"][0]
-                truncated_source = " ".join(source.split()[:num_tokens])
-                score_dict = questeval.compute_all(
-                    hypothesis=candidate,
-                    source=truncated_source
-                )
-                scores.append(score_dict["scores"]["fscore"])
-            metrics[system]["questeval"] = np.mean(scores)
-            del questeval
-
-        if args.blanc:
-            assert sources is not None
-            metric = BLANCHelp(device=args.device)
-            macro, _ = metric.predict_batch(inputs_src)
-            metrics[system]["blanc"] = macro["blanc-help"]
+        for metric in metrics.METRICS.values():
+            if not getattr(args, metric.name.replace("-", "_")):
+                continue
+            if metric.sources and metric.references:
+                assert sources is not None and references is not None
+                metric_inputs = inputs
+            elif metric.sources:
+                assert sources is not None
+                metric_inputs = inputs_src
+            else:
+                assert references is not None
+                metric_inputs = inputs_ref
+
+            name = metric.backend
+            if name == "bertscore" and args.embedding_cache_dir is not None:
+                # With an embedding cache, the reference embeddings are only computed once
+                name = "bertscore-cached"
+            macro = _score(name, args, cache, metric_inputs)
+            scores[system][metric.name] = macro if metric.key is None else macro[metric.key]
 
     dirname = os.path.dirname(args.output_file)
     if dirname:
         os.makedirs(dirname, exist_ok=True)
 
-    with open(args.output_file, "w") as out:
-        for system, m in metrics.items():
+    with chunked_io.open_file(args.output_file, "w") as out:
+        for system, m in scores.items():
             out.write(json.dumps({"system": system, "metrics": m}) + "\n")
 
 
@@ -165,12 +180,12 @@ if __name__ == '__main__':
     argp.add_argument("--candidate-file", required=True)
     argp.add_argument("--output-file", required=True)
     argp.add_argument("--device", type=int, required=True)
+    argp.add_argument("--cache-dir", default=os.environ.get("SCORE_CACHE_DIR"))
+    argp.add_argument("--embedding-cache-dir", default=os.environ.get("EMBEDDING_CACHE_DIR"))
+    argp.add_argument("--max-tokens", type=int)
     argp.add_argument("--source-file")
     argp.add_argument("--reference-file")
-    argp.add_argument("--rouge", action="store_true")
-    argp.add_argument("--bertscore", action="store_true")
-    argp.add_argument("--qaeval", action="store_true")
-    argp.add_argument("--questeval", action="store_true")
-    argp.add_argument("--blanc", action="store_true")
+    for name in metrics.METRICS:
+        argp.add_argument(f"--{name}", action="store_true")
     args = argp.parse_args()
     main(args)
\ No newline at end of file
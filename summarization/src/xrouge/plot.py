@@ -5,11 +5,15 @@ import matplotlib.pyplot as plt
 import os
 import pandas as pd
 import seaborn as sns
+import sys
 from collections import defaultdict
 from glob import glob
 from scipy.stats import pearsonr
 from typing import Dict, List
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "common"))
+import chunked_io
+
 DATASETS = ["fabbri2021", "bhandari2020"]
 NAMES = {
     "fabbri2021": "SummEval",
@@ -42,7 +46,7 @@ def _load_standard_scores(input_dir: str):
     scores_dict = defaultdict(dict)
     for dataset in DATASETS:
         scores_file = f"{input_dir}/{dataset}.jsonl"
-        with open(scores_file, "r") as f:
+        with chunked_io.open_file(scores_file, "r") as f:
             for line in f:
                 data = json.loads(line)
                 system = data["system"]
@@ -54,7 +58,7 @@ def _load_xrouge_scores(input_dir: str, ref_free_metric: str):
     scores_dict = defaultdict(dict)
     for dataset in DATASETS:
         scores_file = f"{input_dir}/{dataset}/{ref_free_metric}/scores.jsonl"
-        with open(scores_file, "r") as f:
+        with chunked_io.open_file(scores_file, "r") as f:
             for line in f:
                 data = json.loads(line)
                 system = data["system"]
@@ -0,0 +1,68 @@
+import argparse
+import json
+import numpy as np
+import os
+import pytest
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "reranking"))
+import rerank
+
+
+def test_segment_argmax_ties():
+    # Ties are broken in favor of the model's ranking, which is the first index
+    values = np.array([0.5, 0.5, 0.1, 0.2, 0.9, 0.9, 0.9, 0.3])
+    offsets = np.array([0, 3, 4, 7, 8])
+    assert rerank.segment_argmax(values, offsets).tolist() == [0, 3, 4, 7]
+    # Or by the tie breakers first
+    tie_breakers = [np.array([0.1, 0.2, 0.0, 0.0, 0.1, 0.3, 0.3, 0.0])]
+    assert rerank.segment_argmax(values, offsets, tie_breakers).tolist() == [1, 3, 5, 7]
+
+
+def test_segment_argmax_empty():
+    with pytest.raises(Exception):
+        rerank.segment_argmax(np.array([0.5, 0.1]), np.array([0, 1, 1, 2]))
+
+
+def test_select_ties():
+    offsets = np.array([0, 3, 6])
+    scores = {
+        "questeval": np.array([0.2, 0.4, 0.4, 0.3, 0.3, 0.3]),
+        "blanc": np.array([0.1, 0.1, 0.1, 0.5, 0.1, 0.5]),
+    }
+    assert rerank._select("standard", offsets, scores).tolist() == [0, 3]
+    assert rerank._select("questeval", offsets, scores).tolist() == [1, 3]
+    # Tied BLANC scores are broken by QuestEval, the same as the original
+    # script, which sorted by QuestEval before sorting by BLANC
+    assert rerank._select("blanc", offsets, scores).tolist() == [1, 3]
+    assert rerank._select("questeval=1,blanc=1", offsets, scores).tolist() == [1, 3]
+    # Tied scores are ranked in the model's order
+    assert rerank._select("rank:questeval,blanc", offsets, scores).tolist() == [1, 3]
+
+
+def test_main(tmp_path, capsys):
+    score_file = str(tmp_path / "scores.jsonl")
+    with open(score_file, "w") as out:
+        for instance_id, scores in [("a", [(0.2, 0.1), (0.4, 0.3), (0.4, 0.2)]), ("b", [(0.3, 0.5), (0.3, 0.1)])]:
+            predictions = [
+                {"prediction": f"{instance_id}{i}", "questeval": questeval, "blanc": blanc}
+                for i, (questeval, blanc) in enumerate(scores)
+            ]
+            out.write(json.dumps({"instance_id": instance_id, "predictions": predictions}) + "\n")
+
+    questeval_file = str(tmp_path / "questeval.jsonl")
+    rerank.main(argparse.Namespace(
+        score_file=score_file,
+        objective=None,
+        standard_file=None,
+        questeval_file=questeval_file,
+        blanc_file=None,
+        report_file=None,
+    ))
+    with open(questeval_file, "r") as f:
+        assert [json.loads(line)["summary"] for line in f] == ["a1", "b0"]
+
+    # QuestEval is printed as a percentage and BLANC is not
+    output = capsys.readouterr().out
+    assert "questeval: questeval 25.0000 -> 35.0000 (+40.00%)" in output
+    assert "questeval: blanc 0.3000 -> 0.4000 (+33.33%)" in output